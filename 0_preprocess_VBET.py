@@ -1,26 +1,62 @@
 from preprocessing.combine_streams_less_than_50m import combine_streams_less_than_50m
 from preprocessing.segment_stream import split_stream_by_lines
-from preprocessing.add_drainage_area_to_streams import add_drainage_area_to_streams
+from preprocessing.add_drainage_area_to_streams import drainage_area_raster, assign_drainage_area
 from preprocessing.create_perpendiculars import create_smooth_perpendicular_lines
+from preprocessing.pipeline import ArtifactCache, Pipeline
+from processing.vector_io import read_vector
 import os
 
-input_stream_vector = r"Y:\ATD\GIS\Bennett\Valley Bottoms\VBET\streams_100k.gpkg"
-flow_accumulation_raster = r"Y:\ATD\GIS\Bennett\Watershed Stats\flow accumulation.tif"
-output_dir = r"Y:\ATD\GIS\Bennett\Valley Bottoms\VBET"
-stream_spacing = 20
-
-split_streams_gpkg = input_stream_vector.split('.')[0] + f'_segmented_{stream_spacing}m.gpkg'
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-perp_lines = create_smooth_perpendicular_lines(input_stream_vector, line_length=1, 
-                                               spacing=stream_spacing, window=10)
-perpendiculars_path = os.path.join(output_dir, f'Bennett perpendiculars {stream_spacing}m.gpkg')
-perp_lines.to_file(perpendiculars_path, driver='GPKG')
-
-print("Combining streams less than 50m...")
-combined_streams = combine_streams_less_than_50m(input_stream_vector)
-print("Segmenting streams...")
-split_stream_by_lines(combined_streams, perpendiculars_path, split_streams_gpkg)
-print("Adding drainage area to streams...")
-add_drainage_area_to_streams(flow_accumulation_raster, split_streams_gpkg)
\ No newline at end of file
+
+def preprocess(input_stream_vector, flow_accumulation_raster, output_dir, stream_spacing=20, name='Bennett',
+               cache_dir=None):
+    """
+    Prepares a stream network for VBET: splits the streams into segments of roughly equal length and adds the
+    drainage area of each segment. The streams are read once and passed between the steps in memory. Each step's
+    output is kept in a cache keyed on the contents of the input files and the step parameters, so a rerun only
+    repeats the steps whose inputs changed (e.g. a new flow accumulation raster only redoes the drainage area).
+    :param input_stream_vector: stream network
+    :param flow_accumulation_raster: flow accumulation raster
+    :param output_dir: folder for the perpendicular lines
+    :param stream_spacing: segment length
+    :param name: prefix of the perpendicular lines file
+    :param cache_dir: folder for cached step outputs (default: preprocess_cache in output_dir)
+    :return: path to the segmented streams
+    """
+    split_streams_gpkg = input_stream_vector.split('.')[0] + f'_segmented_{stream_spacing}m.gpkg'
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if cache_dir is None:
+        cache_dir = os.path.join(output_dir, 'preprocess_cache')
+
+    pipe = Pipeline(ArtifactCache(cache_dir))
+    pipe.add_file('streams', input_stream_vector, read=read_vector)
+    pipe.add_file('flow_accumulation', flow_accumulation_raster)
+
+    print("Creating perpendicular lines...")
+    pipe.stage('perpendiculars', create_smooth_perpendicular_lines, ['streams'],
+               {'line_length': 1, 'spacing': stream_spacing, 'window': 10})
+    print("Combining streams less than 50m...")
+    pipe.stage('combined', combine_streams_less_than_50m, ['streams'], {'write': False})
+    print("Segmenting streams...")
+    pipe.stage('segmented', split_stream_by_lines, ['combined', 'perpendiculars'], {'min_length': 50.0})
+    print("Adding drainage area to streams...")
+    pipe.stage('drainage_area', drainage_area_raster, ['flow_accumulation'], ext='.tif', read=None, write=None)
+    pipe.stage('segmented_da', assign_drainage_area, ['segmented', 'drainage_area'], {'buffer_distance': 5})
+
+    pipe.export('perpendiculars', os.path.join(output_dir, f'{name} perpendiculars {stream_spacing}m.gpkg'))
+    pipe.export('drainage_area', os.path.splitext(flow_accumulation_raster)[0] + '_da.tif')
+    pipe.export('segmented_da', split_streams_gpkg)
+
+    for line in pipe.report():
+        print(line)
+
+    return split_streams_gpkg
+
+
+if __name__ == '__main__':
+    input_stream_vector = r"Y:\ATD\GIS\Bennett\Valley Bottoms\VBET\streams_100k.gpkg"
+    flow_accumulation_raster = r"Y:\ATD\GIS\Bennett\Watershed Stats\flow accumulation.tif"
+    output_dir = r"Y:\ATD\GIS\Bennett\Valley Bottoms\VBET"
+    stream_spacing = 20
+
+    preprocess(input_stream_vector, flow_accumulation_raster, output_dir, stream_spacing)
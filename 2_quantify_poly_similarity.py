@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
-import geopandas as gpd
 import argparse
 import os
 import sys
 from shapely.geometry import Polygon, MultiPolygon
 
+from processing.vector_io import read_vector
+
 def load_polygon(gpkg_path):
     """
     Loads the first polygon from a GeoPackage.
@@ -20,7 +21,7 @@ def load_polygon(gpkg_path):
         ValueError: If no polygon is found in the GeoPackage.
     """
     try:
-        gdf = gpd.read_file(gpkg_path)
+        gdf = read_vector(gpkg_path)
     except Exception as e:
         raise ValueError(f"Error reading {gpkg_path}: {e}")
 
@@ -0,0 +1,59 @@
+"""
+Compares the VBET slope backends on synthetic DEM windows.
+
+Run from the repository root:
+    python -m benchmarks.bench_slope
+"""
+import numpy as np
+import time
+
+from processing.slope import convolve_slope, sobel_slope, slope_mask
+
+NDVAL = -9999.
+THRESH = 4.
+
+
+def synthetic_window(size, res=1., seed=0):
+    """
+    A valley shaped DEM window with NoData outside a buffer shaped footprint, like a masked segment window
+    """
+    rows, cols = np.indices((size, size))
+    dist = np.abs(rows - size / 2 - 0.1 * size * np.sin(cols / (0.1 * size)))
+    arr = 1000 + 0.01 * cols * res + np.where(dist < size / 5, 0.03 * dist, 0.06 * dist) * res
+    arr += np.random.RandomState(seed).normal(0, 0.02, arr.shape)
+    arr[dist > size / 2.5] = NDVAL
+
+    return arr.astype(np.float32)
+
+
+def best_time(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def main():
+    print('{:>6} {:>10} {:>10} {:>10} {:>10}'.format('size', 'convolve', 'sobel', 'mask', 'agree'))
+    for size in (250, 500, 1000, 2000):
+        arr = synthetic_window(size)
+
+        t_conv = best_time(lambda: convolve_slope(arr, 1., 1.) <= THRESH)
+        t_sobel = best_time(lambda: sobel_slope(arr, 1., 1., NDVAL) <= THRESH)
+        t_mask = best_time(lambda: slope_mask(arr, 1., 1., NDVAL, THRESH))
+
+        # agreement with the original backend on cells away from NoData
+        legacy = convolve_slope(arr, 1., 1.)
+        legacy = (legacy <= THRESH) & (legacy > 0)
+        fused = slope_mask(arr, 1., 1., NDVAL, THRESH)
+        interior = sobel_slope(arr, 1., 1., NDVAL) != NDVAL
+        agree = np.mean(legacy[interior] == fused[interior])
+
+        print('{:>6} {:>9.3f}s {:>9.3f}s {:>9.3f}s {:>10.4f}'.format(size, t_conv, t_sobel, t_mask, agree))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+Measures cold start times of the vbet command line and of importing classVBET, each in a fresh interpreter.
+
+Run from the repository root:
+    python -m benchmarks.bench_startup
+"""
+import subprocess
+import sys
+import time
+
+COMMANDS = [
+    ('vbet --help', [sys.executable, 'vbet.py', '--help']),
+    ('import classVBET', [sys.executable, '-c', 'import classVBET']),
+    ('import geopandas, rasterio', [sys.executable, '-c', 'import geopandas, rasterio']),
+]
+
+
+def best_time(cmd, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def main():
+    print('{:<30} {:>10}'.format('command', 'seconds'))
+    for name, cmd in COMMANDS:
+        print('{:<30} {:>10.3f}'.format(name, best_time(cmd)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,32 @@
 # imports
 import geopandas as gpd
+import pandas as pd
 import rasterio
-import rasterio.mask
-from rasterio.features import shapes
-from shapely.geometry import Point, LineString, Polygon, MultiPolygon
+from rasterio.io import MemoryFile
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.transform import array_bounds
+from rasterio.windows import from_bounds
+from affine import Affine
+from shapely.geometry import Point, LineString, Polygon, MultiPolygon, box
 from shapely.ops import unary_union, cascaded_union
-from rasterstats import zonal_stats
 import numpy as np
-import skimage.morphology as mo
-from scipy.signal import convolve2d
-from scipy.linalg import lstsq
-import json
 import os.path
 from tqdm import tqdm
 from datetime import datetime
+import threading
+import time
+import traceback
+import tracemalloc
+from processing.prefetch import PrefetchPipeline
+from processing.buffers import BufferPool, pack_mask, peak_rss_mb, unpack_mask
+from processing.slope import BACKENDS, convolve_slope, sobel_slope, slope_mask
+from processing.morphology import ENGINES, fill_mask as fast_fill_mask
+from processing.smoothing import METHODS, smooth_polygons
+from processing.cost import COST_BAR, CostModel, profile_name, segment_features
+from processing.vector_io import is_parquet, parquet_supported, read_vector, write_vector
+from processing.polygonize import polygonize
+import shapely
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -24,7 +37,7 @@ class VBET:
     """
     def __init__(self, **kwargs):
 
-        self.network = gpd.read_file(kwargs['network'])
+        self.network = read_vector(kwargs['network'])
         self.streams = kwargs['network']
         self.dem = kwargs['dem']
         self.out = kwargs['out']
@@ -43,6 +56,38 @@ class VBET:
         self.lg_depth = kwargs['lg_depth']
         self.med_depth = kwargs['med_depth']
         self.sm_depth = kwargs['sm_depth']
+        self.avlen = kwargs.get('avlen')  # average segment length, set when running one shard of a larger network
+        self.prefetch = kwargs.get('prefetch', 0)  # number of segment windows to read ahead (0 reads serially)
+        self.read_threads = kwargs.get('read_threads', 1)
+        self.low_memory = kwargs.get('low_memory', False)  # float32 elevations, boolean masks and reused buffers
+        self.memory_stats = kwargs.get('memory_stats', False)  # trace the peak memory of each low memory segment
+        self.slope_backend = kwargs.get('slope_backend', 'convolve')  # 'convolve', 'sobel' or 'mask'
+        self.morphology = kwargs.get('morphology', 'skimage')  # 'skimage' or 'fast' hole filling
+        self.output_mode = kwargs.get('output_mode', 'vector')  # 'vector' or 'raster' segment mosaicking
+        self.detrend_mode = kwargs.get('detrend_mode', 'segment')  # 'segment' or 'global' relative elevation
+        self.rem_reference = kwargs.get('rem_reference', 'plane')  # 'plane' or 'centerline' for global mode
+        self.lg_res = kwargs.get('lg_res')  # processing cell size for each drainage area class (None for DEM cells)
+        self.med_res = kwargs.get('med_res')
+        self.sm_res = kwargs.get('sm_res')
+        self.prescreen = kwargs.get('prescreen', 0)  # DEM decimation factor for the prescreening pass (0 for none)
+        self.prescreen_margin = kwargs.get('prescreen_margin', 0.25)
+        self.prescreen_saturation = kwargs.get('prescreen_saturation', 0.98)
+        self.short_circuit = kwargs.get('short_circuit', False)  # lazily evaluated, cropped per-segment filters
+        self.retry_quarantined = kwargs.get('retry_quarantined', False)  # only rerun segments that failed last run
+        self.segment_store = kwargs.get('segment_store', False)  # save each segment's valley bottom for later reruns
+        self.changed_extent = kwargs.get('changed_extent')  # (minx, miny, maxx, maxy) of a DEM patch
+        self.previous_dem = kwargs.get('previous_dem')  # or the DEM before the patch, to find the changed blocks
+        self.smoothing = kwargs.get('smoothing', 'chaikin')  # 'chaikin' (exterior rings only) or 'bulk'
+        self.smooth_refinements = kwargs.get('smooth_refinements', 5)
+        self.vertex_budget = kwargs.get('vertex_budget')  # maximum number of vertices after bulk smoothing
+        self.smooth_tolerance = kwargs.get('smooth_tolerance')  # simplification tolerance after bulk smoothing
+        self.max_open_tiles = kwargs.get('max_open_tiles', 16)  # open tiles per thread for tiled DEM collections
+        self.raster_store = kwargs.get('raster_store')  # folder of memory mapped rasters shared between runs
+        self.stored_slope = kwargs.get('stored_slope', False)  # take segment slopes from the store
+        self.rem_cache = kwargs.get('rem_cache')  # folder for relative elevation rasters shared by runs (or scratch)
+        self.cost_model = kwargs.get('cost_model')  # segment timings file for the cost model (default in scratch)
+        self.window_budget = kwargs.get('window_budget')  # maximum cells in a segment window (larger ones are split)
+        self.read_clusters = kwargs.get('read_clusters', 0)  # maximum cells in a block read for nearby segments
 
         self.version = '2.1.2'
 
@@ -75,6 +120,55 @@ class VBET:
         self.md.writelines('\nVBET-2 version {}\n'.format(self.version))
         self.md.writelines('\nStarted: {} \n'.format(datetime.now().strftime("%d/%m/%Y %H:%M:%S")))
 
+        if self.slope_backend not in BACKENDS:
+            self.md.writelines('\n Exception: Unsupported slope backend {} \n'.format(self.slope_backend))
+            self.md.close()
+            raise Exception('Unsupported slope backend {}, use one of {}'.format(self.slope_backend, BACKENDS))
+
+        if self.morphology not in ENGINES:
+            self.md.writelines('\n Exception: Unsupported morphology engine {} \n'.format(self.morphology))
+            self.md.close()
+            raise Exception('Unsupported morphology engine {}, use one of {}'.format(self.morphology, ENGINES))
+
+        if self.output_mode not in ('vector', 'raster'):
+            self.md.writelines('\n Exception: Unsupported output mode {} \n'.format(self.output_mode))
+            self.md.close()
+            raise Exception("Unsupported output mode {}, use 'vector' or 'raster'".format(self.output_mode))
+
+        # modules of optional modes are imported where the mode is used, so that importing classVBET stays fast
+        from processing.relative_elevation import REFERENCES
+        if self.detrend_mode not in ('segment', 'global') or self.rem_reference not in REFERENCES:
+            self.md.writelines('\n Exception: Unsupported detrend mode {} / reference {} \n'.format(
+                self.detrend_mode, self.rem_reference))
+            self.md.close()
+            raise Exception("Unsupported detrend mode {} or reference {}, use 'segment' or 'global' and one of {}"
+                            .format(self.detrend_mode, self.rem_reference, REFERENCES))
+
+        if self.smoothing not in METHODS:
+            self.md.writelines('\n Exception: Unsupported smoothing method {} \n'.format(self.smoothing))
+            self.md.close()
+            raise Exception('Unsupported smoothing method {}, use one of {}'.format(self.smoothing, METHODS))
+
+        self.incremental = self.changed_extent is not None or self.previous_dem is not None
+        if self.incremental and (self.output_mode != 'vector' or self.retry_quarantined):
+            self.md.writelines('\n Exception: Incremental runs need vector output mode and cannot retry quarantined '
+                               'segments \n')
+            self.md.close()
+            raise Exception("Incremental runs (changed_extent or previous_dem) need output_mode 'vector' and cannot "
+                            "be combined with retry_quarantined")
+
+        if self.short_circuit and self.low_memory:
+            self.md.writelines('\n Exception: short_circuit and low_memory cannot be used together \n')
+            self.md.close()
+            raise ValueError('short_circuit and low_memory are separate segment pipelines, set only one of them')
+
+        if is_parquet(self.out) and not parquet_supported():
+            self.md.writelines('\n Exception: GeoParquet output without pyarrow \n')
+            self.md.close()
+            raise Exception('Output {} is GeoParquet, which needs pyarrow; install it or use another output format '
+                            '(the network, segment store and quarantine layers follow the output format)'
+                            .format(self.out))
+
         # either use selected drainage area field, or pull drainage area from raster
         if self.da_field is not None:
             if self.da_field not in self.network.columns:
@@ -95,6 +189,37 @@ class VBET:
         else:
             os.mkdir(self.scratch)
 
+        # tiled DEM collections (a directory, a list of tiles or a VRT) are read through a tile index, and a VRT of
+        # the tiles stands in for the DEM everywhere else
+        from processing.tiles import TileIndex, list_tiles
+        self.tiles = None
+        tiles = list_tiles(self.dem)
+        if tiles is not None:
+            try:
+                self.tiles = TileIndex(tiles, max_open=self.max_open_tiles)
+            except Exception as e:
+                self.md.writelines('\n Exception: {} \n'.format(e))
+                self.md.close()
+                raise
+            if not (isinstance(self.dem, str) and self.dem.lower().endswith('.vrt')):
+                self.dem = self.tiles.write_vrt(os.path.join(self.scratch, 'dem_tiles.vrt'))
+            self.md.writelines('\nDEM tiles: {} (VRT {}) \n'.format(len(tiles), self.dem))
+
+        # DEM (and drainage area and slope) decoded once into memory mapped files that concurrent runs share
+        self.store = None
+        self.da_store = None
+        self.slope_store = None
+        if self.raster_store is not None:
+            from processing.raster_store import build as build_store, build_slope as build_slope_store
+            print('Attaching to raster store {}'.format(self.raster_store))
+            self.store = build_store(self.dem, self.raster_store, 'dem',
+                                     sources=self.tiles.paths if self.tiles is not None else None)
+            if self.dr_area:
+                self.da_store = build_store(self.dr_area, self.raster_store, 'drainage_area')
+            if self.stored_slope:
+                self.slope_store = build_slope_store(self.raster_store)
+            self.md.writelines('\nRaster store: {} \n'.format(self.raster_store))
+
         # check that datasets are in projected coordinate system
         if not self.network.crs.is_projected:
             self.md.writelines('\n Exception: All geospatial inputs should have the same projected coordinate '
@@ -142,6 +267,59 @@ class VBET:
             self.md.close()
             raise Exception('There are multipart features in the input stream network')
 
+        # per thread DEM datasets used to read segment windows
+        self._local = threading.local()
+        self._handles = []
+
+        # buffers reused across segments and peak memory per segment in low memory mode
+        self.pool = BufferPool()
+        self.peak_mb = {}
+
+        # DEM cell size, set when the valley bottom run starts
+        self.dem_res = None
+
+        # global valley bottom raster in raster output mode
+        self.mosaic = None
+
+        # segments decided by the prescreening pass
+        self.prescreened = {}
+        self.prescreen_time = 0
+
+        # number of sub-windows of each segment split to fit the window budget
+        self.split_windows = {}
+
+        # DEM blocks read once for clusters of nearby segments
+        self.clusters = None
+
+        # buffer of every segment, built in one call, and the time each segment spends on setting up its window
+        self.buffers = {}
+        self.setup_seconds = {}
+
+        # filter order and skip counters of the short circuit segment evaluation
+        self.stage_graph = None
+
+        # segments that failed (network index: stage, error, traceback) and the layer they are saved to
+        self.quarantine = {}
+        layer_ext = '.parquet' if is_parquet(self.out) else '.gpkg'
+        self.quarantine_path = os.path.splitext(self.out)[0] + '_quarantine' + layer_ext
+
+        # valley bottom polygons of each segment, kept for the segment store
+        self.segment_polys = {}
+        self.store_path = os.path.splitext(self.out)[0] + '_segments' + layer_ext
+
+        # cleaned network with the valley bottom area of each segment, saved next to the output (the input network
+        # is left as it is)
+        self.network_out = os.path.splitext(self.out)[0] + '_network' + layer_ext
+
+        # global relative elevation raster in global detrend mode
+        self.rem = None
+        self._rem_src = None
+
+        # estimated and measured processing time of each segment
+        self.cost = None
+        self.segment_costs = {}
+        self.segment_seconds = {}
+
         # add container for individual valley bottom features and add the minimum buffer into it
         self.polygons = []
 
@@ -187,6 +365,8 @@ class VBET:
         Adds a drainage area attribute to each segment of the drainage network
         :return:
         """
+        from rasterstats import zonal_stats
+
         print('Adding drainage area to network')
         da_list = []
 
@@ -200,7 +380,11 @@ class VBET:
             pt = Point(mid_pt_x, mid_pt_y)
             buf = pt.buffer(50)  # make buffer distance function of resolution (e.g. 5*res)
 
-            zs = zonal_stats(buf, self.dr_area, stats='max')
+            if self.da_store is not None:
+                zs = zonal_stats(buf, self.da_store.data, affine=self.da_store.transform, nodata=self.da_store.nodata,
+                                 stats='max')
+            else:
+                zs = zonal_stats(buf, self.dr_area, stats='max')
             da_val = zs[0].get('max')
 
             da_list.append(da_val)
@@ -219,30 +403,96 @@ class VBET:
             arr = src.read()[0, :, :]
             xres = src.res[0]
             yres = src.res[1]
+            ndval = src.nodata
 
-        x = np.array([[-1 / (8 * xres), 0, 1 / (8 * xres)],
-                      [-2 / (8 * xres), 0, 2 / (8 * xres)],
-                      [-1 / (8 * xres), 0, 1 / (8 * xres)]])
-        y = np.array([[1 / (8 * yres), 2 / (8 * yres), 1 / (8 * yres)],
-                      [0, 0, 0],
-                      [-1 / (8 * yres), -2 / (8 * yres), -1 / (8 * yres)]])
-
-        x_grad = convolve2d(arr, x, mode='same', boundary='fill', fillvalue=1)
-        y_grad = convolve2d(arr, y, mode='same', boundary='fill', fillvalue=1)
-        slope = np.arctan(np.sqrt(x_grad ** 2 + y_grad ** 2)) * (180. / np.pi)
+        if self.slope_backend == 'convolve':
+            slope = convolve_slope(arr, xres, yres)
+        else:
+            slope = sobel_slope(arr, xres, yres, ndval)
         slope = slope.astype(src.dtypes[0])
 
         return slope
 
-    def detrend(self, dem, seg_geom):
-        with rasterio.open(dem) as src:
-            meta = src.profile
+    def slope_threshold_mask(self, dem, thresh):
+        """
+        Finds the cells below a slope threshold directly from the elevation gradients (the 'mask' slope backend)
+        :param dem: path to a digital elevation raster
+        :param thresh: slope threshold in degrees
+        :return: a 2-D array with values of 1 where 0 < slope <= thresh and NoData elsewhere
+        """
+        with rasterio.open(dem, 'r') as src:
             arr = src.read()[0, :, :]
-            res_x = src.res[0]
-            res_y = src.res[1]
-            x_min = src.transform[2]
-            y_max = src.transform[5]
-            y_min = y_max - (src.height*res_y)
+            xres = src.res[0]
+            yres = src.res[1]
+            ndval = src.nodata
+
+        out_array = np.full(arr.shape, ndval)
+        out_array[slope_mask(arr, xres, yres, ndval, thresh)] = 1
+
+        return out_array
+
+    def slope_low_memory(self, arr, xres, yres, ndval):
+        """
+        Finds the slope with the same kernels as slope, in float32 and using pooled buffers. Elevations are taken
+        relative to the centre cell of the window so that float32 keeps enough precision for the gradients.
+        :param arr: 2-D float32 DEM array
+        :param xres: cell size in x
+        :param yres: cell size in y
+        :param ndval: NoData value
+        :return: a 2-D float32 array of slope in degrees (a view of a pooled buffer)
+        """
+        rows, cols = arr.shape
+        ref = arr[rows // 2, cols // 2]
+        if ref == ndval or not np.isfinite(ref):
+            ref = np.float32(0)
+
+        pad = self.pool.array('pad', (rows + 2, cols + 2), np.float32)
+        pad[...] = 1 - ref  # same edge fill value as convolve2d in slope
+        np.subtract(arr, ref, out=pad[1:-1, 1:-1])
+
+        x_grad = self.pool.array('x_grad', arr.shape, np.float32)
+        np.add(pad[:-2, 2:], pad[2:, 2:], out=x_grad)
+        x_grad += pad[1:-1, 2:]
+        x_grad += pad[1:-1, 2:]
+        x_grad -= pad[:-2, :-2]
+        x_grad -= pad[2:, :-2]
+        x_grad -= pad[1:-1, :-2]
+        x_grad -= pad[1:-1, :-2]
+        x_grad *= np.float32(1 / (8 * xres))
+
+        y_grad = self.pool.array('y_grad', arr.shape, np.float32)
+        np.add(pad[:-2, :-2], pad[:-2, 2:], out=y_grad)
+        y_grad += pad[:-2, 1:-1]
+        y_grad += pad[:-2, 1:-1]
+        y_grad -= pad[2:, :-2]
+        y_grad -= pad[2:, 2:]
+        y_grad -= pad[2:, 1:-1]
+        y_grad -= pad[2:, 1:-1]
+        y_grad *= np.float32(1 / (8 * yres))
+
+        slope = np.hypot(x_grad, y_grad, out=x_grad)
+        np.arctan(slope, out=slope)
+        slope *= np.float32(180. / np.pi)
+
+        return slope
+
+    def detrend_fit(self, arr, transform, ndval, seg_geom):
+        """
+        Fits a plane to the minimum elevations around points along a network segment
+        :param arr: 2-D DEM array (or path to a DEM)
+        :param transform: affine transform of the array
+        :param ndval: NoData value
+        :param seg_geom: segment geometry
+        :return: plane coefficients (column, row, intercept) in array coordinates
+        """
+        # imported here so that importing classVBET stays fast
+        from rasterstats import zonal_stats
+        from scipy.linalg import lstsq
+
+        res_x = transform[0]
+        res_y = -transform[4]
+        x_min = transform[2]
+        y_max = transform[5]
 
         # points along network in real coords
         _xs = seg_geom.xy[0][::2]
@@ -252,8 +502,10 @@ class VBET:
 
         for i in range(len(_xs)):
             pt = Point(_xs[i], _ys[i])
-            buf = pt.buffer(5)
-            zonal = zonal_stats(buf, dem, stats='min')
+            # at least one cell when the window is resampled to a resolution coarser than the DEM
+            coarse = self.dem_res is not None and res_x > self.dem_res
+            buf = pt.buffer(max(5, res_x) if coarse else 5)
+            zonal = zonal_stats(buf, arr, affine=transform, nodata=ndval, stats='min')
             val = zonal[0].get('min')
 
             zs[i] = val
@@ -271,24 +523,91 @@ class VBET:
         zs = zs[np.isfinite(zs)]  # its currently possible to use only 2 points..?
 
         # do fit
-        tmp_A = []
-        tmp_b = []
-        for i in range(len(xs)):
-            tmp_A.append([xs[i], ys[i], 1])
-            tmp_b.append(zs[i])
-        b = np.array(tmp_b).T
-        A = np.array(tmp_A)
-        fit = lstsq(A, b)
-
-        trend = np.full((src.height, src.width), src.nodata, dtype=src.dtypes[0])
-        for j in range(trend.shape[0]):
-            for i in range(trend.shape[1]):
-                trend[j, i] = fit[0][0] * i + fit[0][1] * j + fit[0][2]
+        A = np.column_stack([xs, ys, np.ones_like(xs)])
+        fit = lstsq(A, zs)
+
+        return fit[0]
+
+    def detrend(self, dem, seg_geom):
+        with rasterio.open(dem) as src:
+            arr = src.read()[0, :, :]
+            fit = self.detrend_fit(arr, src.transform, src.nodata, seg_geom)
+            dtype = src.dtypes[0]
+
+        rows, cols = np.indices(arr.shape)
+        trend = (fit[0] * cols + fit[1] * rows + fit[2]).astype(dtype)
 
         out_arr = arr - trend
 
         return out_arr
 
+    def detrend_low_memory(self, arr, transform, ndval, seg_geom):
+        """
+        Detrends a DEM window in float32 without allocating a full size trend plane
+        :param arr: 2-D float32 DEM array (reused as the output)
+        :param transform: affine transform of the array
+        :param ndval: NoData value
+        :param seg_geom: segment geometry
+        :return: the detrended array
+        """
+        fit = self.detrend_fit(arr, transform, ndval, seg_geom)
+        rows, cols = arr.shape
+        arr -= (fit[0] * np.arange(cols) + fit[2]).astype(np.float32)[np.newaxis, :]
+        arr -= (fit[1] * np.arange(rows)).astype(np.float32)[:, np.newaxis]
+
+        return arr
+
+    def relative_elevation(self):
+        """
+        Builds the relative elevation raster for the whole DEM (or reuses one built by an earlier run with the same
+        DEM, network and largest buffer)
+        :return:
+        """
+        from processing.relative_elevation import build_rem, rem_key
+        max_buf = max(self.lg_buf, self.med_buf, self.sm_buf)
+        key = rem_key(self.dem, self.network, max_buf, self.rem_reference,
+                      sources=self.tiles.paths if self.tiles is not None else None)
+        if self.rem_cache is not None and not os.path.isdir(self.rem_cache):
+            os.makedirs(self.rem_cache, exist_ok=True)
+        self.rem = os.path.join(self.rem_cache or self.scratch, 'rem_{}.tif'.format(key))
+        if os.path.isfile(self.rem):
+            print('Using existing relative elevation raster {}'.format(self.rem))
+        else:
+            print('Generating relative elevation raster')
+            fits = []
+            if self.rem_reference == 'plane':
+                with rasterio.open(self.dem) as src:
+                    for seg_geom in tqdm(self.network.geometry):
+                        fits.append(self.detrend_fit(self.dem, src.transform, src.nodata, seg_geom))
+            build_rem(self.dem, self.network, fits, max_buf, self.rem, reference=self.rem_reference)
+        self.md.writelines('\nRelative elevation raster: {} \n'.format(self.rem))
+        self._rem_src = rasterio.open(self.rem)
+
+        return
+
+    def rem_window(self, dem_window, transform, out=None):
+        """
+        Reads the relative elevations for a segment window
+        :param dem_window: 2-D masked DEM array of the window (NoData outside the segment buffer)
+        :param transform: affine transform of the window
+        :param out: optional float32 array to read into
+        :return: 2-D float32 array of relative elevations, NoData where the DEM window is NoData
+        """
+        from processing.relative_elevation import grid_window
+        ndval = self._rem_src.nodata
+        window = grid_window(transform, dem_window.shape, self._rem_src.transform)
+        if transform[0] != self._rem_src.transform[0]:
+            # coarser processing resolution
+            bounds = array_bounds(dem_window.shape[0], dem_window.shape[1], transform)
+            window = from_bounds(*bounds, transform=self._rem_src.transform)
+        if out is None:
+            out = np.empty(dem_window.shape, dtype=np.float32)
+        rem = self._rem_src.read(1, window=window, boundless=True, fill_value=ndval, out=out,
+                                 resampling=Resampling.average)
+        rem[dem_window == ndval] = ndval
+
+        return rem
+
     def reclassify(self, array, ndval, thresh):
         """
         Splits an input array into two values: 1 and NODATA based on a threshold value
@@ -298,23 +617,32 @@ class VBET:
         and values > thresh are converted to NoData
         :return: a 2-D array of with values of 1 and NoData
         """
-        rows, cols = array.shape
-
         out_array = np.full(array.shape, ndval)
-
-        for j in range(0, rows - 1):
-            for i in range(0, cols - 1):
-                if array[j, i] == ndval:
-                    out_array[j, i] = ndval
-                elif array[j, i] > thresh:
-                    out_array[j, i] = ndval
-                elif thresh >= array[j, i] > 0:
-                    out_array[j, i] = 1
-                else:
-                    out_array[j, i] = ndval
+        out_array[self.reclassify_mask(array, ndval, thresh)] = 1
 
         return out_array
 
+    def reclassify_mask(self, array, ndval, thresh, out=None):
+        """
+        Boolean version of reclassify
+        :param array: a 2-D array
+        :param ndval: NoData value
+        :param thresh: The threshold value
+        :param out: optional boolean array to write the result into
+        :return: 2-D boolean array, True where thresh >= value > 0 (the last row and column are always False, as
+        in reclassify)
+        """
+        if out is None:
+            out = np.empty(array.shape, dtype=bool)
+        np.less_equal(array, thresh, out=out)
+        out &= array > 0
+        if ndval is not None:
+            out &= array != ndval
+        out[-1, :] = False
+        out[:, -1] = False
+
+        return out
+
     def raster_overlap(self, array1, array2, ndval):
         """
         Finds the overlap between two orthogonal arrays (same dimensions)
@@ -330,42 +658,48 @@ class VBET:
             raise Exception('rasters are not same size')
 
         out_array = np.full(array1.shape, ndval)
-
-        for j in range(0, array1.shape[0] - 1):
-            for i in range(0, array1.shape[1] - 1):
-                if array1[j, i] == 1. and array2[j, i] == 1.:
-                    out_array[j, i] = 1.
-                else:
-                    out_array[j, i] = ndval
+        out_array[:-1, :-1][(array1[:-1, :-1] == 1.) & (array2[:-1, :-1] == 1.)] = 1.
 
         return out_array
 
-    def fill_raster_holes(self, array, thresh, ndval):
+    def fill_raster_holes(self, array, thresh, ndval, closing=7):
         """
         Fills in holes and gaps in an array of 1s and NoData
         :param array: 2-D array of 1s and NoData
         :param thresh: hole size (cells) below which should be filled
         :param ndval: NoData value
+        :param closing: edge length (cells) of the square used to close gaps
         :return: 2-D array like input array but with holes filled
         """
         binary = np.zeros_like(array, dtype=bool)
-        for j in range(0, array.shape[0] - 1):
-            for i in range(0, array.shape[1] - 1):
-                if array[j, i] == 1:
-                    binary[j, i] = 1
+        binary[:-1, :-1] = array[:-1, :-1] == 1
 
-        b = mo.remove_small_holes(binary, thresh, 1)
-        c = mo.binary_closing(b, footprint=np.ones((7, 7)))
-        d = mo.remove_small_holes(c, thresh, 1)
+        d = self.fill_mask(binary, thresh, closing)
 
         out_array = np.full(d.shape, ndval, dtype=np.float32)
-        for j in range(0, d.shape[0] - 1):
-            for i in range(0, d.shape[1] - 1):
-                if d[j, i] == True:
-                    out_array[j, i] = 1.
+        out_array[:-1, :-1][d[:-1, :-1]] = 1.
 
         return out_array
 
+    def fill_mask(self, mask, thresh, closing=7):
+        """
+        Fills in holes and gaps in a boolean array
+        :param mask: 2-D boolean array
+        :param thresh: hole size (cells) below which should be filled
+        :param closing: edge length (cells) of the square used to close gaps
+        :return: 2-D boolean array with holes filled
+        """
+        if self.morphology == 'fast':
+            return fast_fill_mask(mask, thresh, closing)
+
+        import skimage.morphology as mo
+
+        b = mo.remove_small_holes(mask, thresh, 1)
+        c = mo.binary_closing(b, footprint=np.ones((closing, closing)))
+        d = mo.remove_small_holes(c, thresh, 1)
+
+        return d
+
     def array_to_raster(self, array, raster_like, raster_out):
         """
         Save an array as a raster dataset
@@ -385,45 +719,23 @@ class VBET:
 
         return
 
-    def raster_to_shp(self, array, raster_like):
+    def raster_to_shp(self, array, raster_like=None, transform=None, sink=None):
         """
-        Convert the 1 values in an array of 1s and NoData to a polygon
+        Convert the 1 values in an array of 1s and NoData to polygons, which are added to the valley bottom polygons
         :param array: 2-D array of 1s and NoData
-        :param raster_like: a raster from which to take metadata (e.g. spatial reference)
-        :param shp_out: path to store output shapefile
-        :return:
+        :param raster_like: a raster from which to take the affine transform (if transform is not given)
+        :param transform: affine transform of the array
+        :param sink: list the polygons are added to (default: the valley bottom polygons)
+        :return: area of the polygons (number of 1 cells times the cell area)
         """
-        with rasterio.open(raster_like) as src:
-            transform = src.transform
-            crs = src.crs
-
-        results = (
-            {'properties': {'raster_val': v}, 'geometry': s}
-            for i, (s, v)
-            in enumerate(
-                shapes(array, mask=array == 1., transform=transform)))
-
-        geoms = list(results)
-        if len(geoms) == 0:
-            return 0
-
-        else:
-            df = gpd.GeoDataFrame.from_features(geoms)
-            df.crs = crs
-            geom = df['geometry']
-
-            area = []
-
-            for x in range(len(geom)):
-                area.append(geom[x].area)
-                self.polygons.append(geom[x])
-
-            return sum(area)
+        if transform is None:
+            with rasterio.open(raster_like) as src:
+                transform = src.transform
 
-    def getFeatures(self, gdf):
-        """Function to parse features from GeoDataFrame in such a manner that rasterio wants them"""
+        polys, area = polygonize(array == 1, transform)
+        (self.polygons if sink is None else sink).extend(polys)
 
-        return [json.loads(gdf.to_json())['features'][0]['geometry']]
+        return area
 
     def chaikins_corner_cutting(self, coords, refinements=5):
         coords = np.array(coords)
@@ -439,176 +751,961 @@ class VBET:
 
         return coords
 
-    def valley_bottom(self):
+    def dem_handle(self):
         """
-        Run the VBET algorithm
-        :return: saves a valley bottom shapefile
+        Returns an open dataset for the DEM that belongs to the calling thread (rasterio datasets can not be shared
+        between threads)
+        :return: open rasterio dataset
+        """
+        src = getattr(self._local, 'dem', None)
+        if src is None:
+            src = rasterio.open(self.dem)
+            self._local.dem = src
+            self._handles.append(src)
+
+        return src
+
+    def close_dem_handles(self):
+        for src in self._handles:
+            src.close()
+        self._handles = []
+        self._local = threading.local()
+        if self.tiles is not None:
+            self.tiles.close()
+
+    def segment_distance(self, da):
         """
+        Selects the buffer distance for a segment based on its drainage area
+        :param da: drainage area of the segment
+        :return: buffer distance
+        """
+        if da >= self.lg_da:
+            return self.lg_buf
+        elif self.lg_da > da >= self.med_da:
+            return self.med_buf
+        else:
+            return self.sm_buf
 
-        self.clean_network()
+    def bulk_buffers(self):
+        """
+        Buffers every network segment by the buffer distance for its drainage area in one vectorized call, so the
+        segments only look up their buffer when their window is read
+        :return: dict of network index: buffer polygon
+        """
+        da = self.network['Drain_Area'].to_numpy()
+        distance = np.where(da >= self.lg_da, self.lg_buf, np.where(da >= self.med_da, self.med_buf, self.sm_buf))
 
-        print('Generating valley bottom for each network segment')
-        for i in tqdm(self.network.index):
-            #print(f"Processing segment {i} of {len(self.network.index)}")
-            
-            seg = self.network.loc[i]
-            da = seg['Drain_Area']
-            seg_geom = seg.geometry
-            
-            #print(f"Drain area: {da}, Geometry type: {seg_geom.geom_type}")
-
-            # Determine buffer size based on Drain_Area (da)
-            if da >= self.lg_da:
-                buf = seg_geom.buffer(self.lg_buf, cap_style=1)
-                #print("Using large buffer")
-            elif self.lg_da > da >= self.med_da:
-                buf = seg_geom.buffer(self.med_buf, cap_style=1)
-                #print("Using medium buffer")
-            else:
-                buf = seg_geom.buffer(self.sm_buf, cap_style=1)
-                #print("Using small buffer")
+        buffers = shapely.buffer(self.network.geometry.values, distance, cap_style='round', quad_segs=16)
 
-            bufds = gpd.GeoSeries(buf)
-            coords = self.getFeatures(bufds)
+        return dict(zip(self.network.index, buffers))
 
-            # Try reading and masking the DEM
-            try:
-                with rasterio.open(self.dem) as src:
-                    #print("Opened DEM successfully")
-                    out_image, out_transform = rasterio.mask.mask(src, coords, crop=True)
-                    out_meta = src.meta.copy()
-            except Exception as e:
-                #print(f"Error reading or masking DEM: {e}")
-                break  # Optionally stop the loop here if needed
+    def segment_buffers(self):
+        """
+        :return: dict of network index: buffer polygon, built on first use for callers outside valley_bottom (e.g.
+        shard planning)
+        """
+        if len(self.buffers) == 0:
+            self.buffers = self.bulk_buffers()
 
-            # Update metadata and write a subset of the DEM
-            out_meta.update({'driver': 'Gtiff',
-                            'height': out_image.shape[1],
-                            'width': out_image.shape[2],
-                            'transform': out_transform})
+        return self.buffers
 
+    def prescreen_segments(self, segments):
+        """
+        Runs a fast pass on a decimated DEM and records the segments whose valley bottom is almost certainly empty
+        (no valley bottom) or saturated (the whole buffer is valley bottom)
+        :param segments: list of (network index, drainage area, segment geometry)
+        :return: list of the segments that need the full resolution pipeline
+        """
+        from processing.prescreen import EMPTY, SATURATED, classify
+        print('Prescreening segments on the DEM decimated by {}'.format(self.prescreen))
+        start = time.perf_counter()
+        self.prescreened = {EMPTY: 0, SATURATED: 0}
+        uncertain = []
+        src = self.dem_handle()
+        buffers = self.segment_buffers()
+        for segment in tqdm(segments):
+            i, da, seg_geom = segment
+            buf = buffers[i]
+            slope_thresh, depth_thresh, _ = self.segment_thresholds(da)
+            res = max(src.res[0] * self.prescreen, self.segment_resolution(da) or 0)
             try:
-                with rasterio.open(self.scratch + '/dem_sub.tif', 'w', **out_meta) as dest:
-                    dest.write(out_image)
-                    #print(f"DEM subset written to {self.scratch + '/dem_sub.tif'}")
-            except Exception as e:
-                print(f"Error writing DEM subset: {e}")
-                break  # Optionally stop the loop here if needed
+                arr, transform = self.read_resampled(src, buf, res)
+                decision = classify(arr[0], transform, src.nodata, seg_geom, slope_thresh, depth_thresh,
+                                    self.prescreen_margin, self.prescreen_saturation)
+            except Exception:
+                decision = None  # let the full pipeline deal with it
+
+            if decision == EMPTY:
+                self.fp_areas[i] = 0
+            elif decision == SATURATED:
+                if self.mosaic is not None:
+                    self.mosaic.burn_shapes([buf])
+                else:
+                    self.polygons.append(buf)
+                    self.segment_polys[i] = [buf]
+                self.fp_areas[i] = buf.area
+            else:
+                uncertain.append(segment)
+                continue
+            self.prescreened[decision] += 1
+        self.prescreen_time = time.perf_counter() - start
+
+        return uncertain
+
+    def read_segment(self, segment):
+        """
+        Buffers a network segment and reads the DEM window inside the buffer. With a window budget, a segment whose
+        window would hold more cells than the budget is read as overlapping sub-windows along its centerline instead
+        (see processing/subwindows.py).
+        :param segment: tuple of (network index, drainage area, segment geometry)
+        :return: tuple of (network index, drainage area, segment geometry, masked DEM array, DEM window metadata),
+        for a split segment the DEM array is None and the metadata holds the sub-windows and the centerline pieces
+        """
+        i, da, seg_geom = segment
+        if self.window_budget is not None:
+            from processing.subwindows import split_segment
+            distance = self.segment_distance(da)
+            split = split_segment(seg_geom, distance, self.segment_resolution(da) or self.dem_res,
+                                  self.window_budget)
+            if split is not None:
+                contexts, pieces = split
+                self.split_windows[i] = len(pieces)
+                subwindows = [self.read_window(i, da, context, context.buffer(distance, cap_style=1))
+                              for context in contexts]
+                return i, da, seg_geom, None, {'subwindows': subwindows, 'pieces': shapely.STRtree(pieces)}
+
+        return self.read_window(i, da, seg_geom, self.buffers[i])
+
+    def read_window(self, i, da, seg_geom, buf):
+        """
+        Reads the DEM window inside a buffer
+        :param i: network index
+        :param da: drainage area of the segment
+        :param seg_geom: segment geometry (or the part of it the buffer is around)
+        :param buf: buffer polygon
+        :return: tuple of (network index, drainage area, segment geometry, masked DEM array, DEM window metadata)
+        """
+        start = time.perf_counter()
+        src = self.dem_handle()
+        res = self.segment_resolution(da)
+        if res is not None and res > src.res[0]:
+            out_image, out_transform = self.read_resampled(src, buf, res)
+        else:
+            # the buffer is rasterized straight onto the window grid; only the time outside the DEM read counts as
+            # segment setup
+            reading = []
+
+            def timed(read):
+                def run(window):
+                    read_start = time.perf_counter()
+                    arr = read(window)
+                    reading.append(time.perf_counter() - read_start)
+                    return arr
+                return run
+
+            if self.store is not None:
+                source, read = self.store, self.store.read
+            else:
+                source = self.tiles if self.tiles is not None else src
+                read = self.tiles.read if self.tiles is not None else (lambda window: src.read(1, window=window))
+                if self.clusters is not None and i in self.clusters.cluster_of:
+                    direct = read
+                    read = lambda window: self.clusters.read(i, window, direct)
+            out_image, out_transform = self.read_masked(source, buf, read=timed(read))
+            self.setup_seconds[i] = self.setup_seconds.get(i, 0) + time.perf_counter() - start - sum(reading)
+        out_meta = src.meta.copy()
+        out_meta.update({'driver': 'Gtiff',
+                         'height': out_image.shape[1],
+                         'width': out_image.shape[2],
+                         'transform': out_transform})
+
+        return i, da, seg_geom, out_image, out_meta
+
+    def read_masked(self, source, buf, read=None):
+        """
+        Reads the DEM window inside a segment buffer from a tile index or raster store (same result as
+        rasterio.mask.mask with crop=True on the DEM)
+        :param source: TileIndex, StoredRaster or DEM dataset
+        :param buf: segment buffer geometry
+        :param read: optional function reading a window of the source (default: source.read)
+        :return: tuple of (masked DEM array with a band axis, affine transform of the array)
+        """
+        window = geometry_window(source, [buf])
+        arr = (read or source.read)(window)
+        transform = rasterio.windows.transform(window, source.transform)
+        outside = geometry_mask([buf], out_shape=arr.shape, transform=transform)
+        arr[outside] = source.nodata if source.nodata is not None else 0
 
-            dem = self.scratch + "/dem_sub.tif"
+        return arr[np.newaxis, :, :], transform
+
+    def plan_reads(self, segments):
+        """
+        Groups consecutive segments whose DEM windows overlap into clusters, each read as one block (see
+        processing/clusters.py). Segments read at a coarser resolution or split into sub-windows read on their own.
+        :param segments: list of (network index, drainage area, segment geometry) in processing order
+        :return: ClusterReader
+        """
+        from processing.clusters import ClusterReader, plan_clusters
+        from processing.subwindows import window_cells
+        src = self.dem_handle()
+        source = self.tiles if self.tiles is not None else src
+        windows = []
+        buffers = self.segment_buffers()
+        for i, da, seg_geom in segments:
+            res = self.segment_resolution(da)
+            if res is not None and res > self.dem_res:
+                continue
+            buf = buffers[i]
+            if self.window_budget is not None and window_cells(buf, res or self.dem_res) > self.window_budget:
+                continue
             try:
-                demsrc = rasterio.open(dem)
-                demarray = demsrc.read()[0, :, :]
-                ndval = demsrc.nodata
-                #print("DEM subset opened and read successfully")
-            except Exception as e:
-                print(f"Error opening DEM subset: {e}")
-                break  # Optionally stop the loop here if needed
+                windows.append((i, geometry_window(source, [buf])))
+            except Exception:
+                continue  # left to the segment's own read, which quarantines it
+        clusters = plan_clusters(windows, self.read_clusters)
+
+        return ClusterReader(clusters, np.dtype(src.dtypes[0]).itemsize)
 
-            # Calculate slope
+    def segment_resolution(self, da):
+        """
+        Selects the processing resolution for a segment based on its drainage area
+        :param da: drainage area of the segment
+        :return: cell size, or None to use the DEM resolution
+        """
+        if da >= self.lg_da:
+            return self.lg_res
+        elif self.lg_da > da >= self.med_da:
+            return self.med_res
+        else:
+            return self.sm_res
+
+    def read_resampled(self, src, buf, res):
+        """
+        Reads the DEM window inside a segment buffer at a coarser resolution (GDAL uses overviews where the DEM has
+        them, and averages the cells otherwise)
+        :param src: open DEM dataset
+        :param buf: segment buffer geometry
+        :param res: cell size to read at
+        :return: tuple of (masked DEM array with a band axis, affine transform of the array)
+        """
+        window = geometry_window(src, [buf])
+        factor = res / src.res[0]
+        out_shape = (max(int(round(window.height / factor)), 1), max(int(round(window.width / factor)), 1))
+        arr = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.average)
+        transform = src.window_transform(window) * Affine.scale(window.width / out_shape[1],
+                                                                window.height / out_shape[0])
+        outside = geometry_mask([buf], out_shape=out_shape, transform=transform)
+        arr[outside] = src.nodata
+
+        return arr[np.newaxis, :, :], transform
+
+    def segment_thresholds(self, da):
+        """
+        Selects the slope, depth and hole filling thresholds for a segment based on its drainage area
+        :param da: drainage area of the segment
+        :return: tuple of (slope threshold, depth threshold, hole size threshold in cells)
+        """
+        if da >= self.lg_da:
+            return self.lg_slope, self.lg_depth, self.avlen * self.lg_buf * 0.005
+        elif self.lg_da > da >= self.med_da:
+            return self.med_slope, self.med_depth, self.avlen * self.med_buf * 0.005
+        else:
+            return self.sm_slope, self.sm_depth, self.avlen * self.sm_buf * 0.005
+
+    def scale_fill_parameters(self, thresh, transform):
+        """
+        Scales the hole size threshold and closing footprint from DEM cells to the cells of a coarser window
+        :param thresh: hole size threshold in DEM cells
+        :param transform: affine transform of the window
+        :return: tuple of (hole size threshold, closing footprint edge length) in window cells
+        """
+        factor = self.dem_res / transform[0]
+        if factor >= 1:
+            return thresh, 7
+
+        return thresh * factor ** 2, max(3, int(round(7 * factor)) // 2 * 2 + 1)
+
+    def stored_slope_window(self, transform, shape):
+        """
+        :param transform: affine transform of a segment array
+        :param shape: (rows, columns) of the array
+        :return: the slopes of the array's cells from the raster store, or None without a stored slope or if the
+        array is not on the DEM grid
+        """
+        if self.slope_store is None or transform[0] != self.slope_store.res[0]:
+            return None
+        from processing.relative_elevation import grid_window
+
+        return self.slope_store.read(grid_window(transform, shape, self.slope_store.transform))
+
+    def segment_valley_bottom(self, window):
+        """
+        Finds the valley bottom cells within the DEM window of a single segment
+        :param window: a window returned by read_segment
+        :return: tuple of (network index, filled valley bottom array or None if there is no valley bottom, affine
+        transform of the array)
+        """
+        i, da, seg_geom, out_image, out_meta = window
+
+        # write the subset of the DEM to an in memory dataset
+        mem = MemoryFile()
+        with mem.open(**out_meta) as dest:
+            dest.write(out_image)
+        dem = mem.name
+        ndval = out_meta['nodata']
+
+        slope_thresh, depth_thresh, thresh = self.segment_thresholds(da)
+
+        # Calculate slope and reclassify based on Drain_Area (da)
+        stored = self.stored_slope_window(out_meta['transform'], out_image.shape[1:])
+        if stored is not None:
+            slope_sub = self.reclassify(stored, ndval, slope_thresh)
+        elif self.slope_backend == 'mask':
+            slope_sub = self.slope_threshold_mask(dem, slope_thresh)
+        else:
             slope = self.slope(dem)
-            #print("Slope calculated")
-
-            # Reclassify slope based on Drain_Area (da)
-            if da >= self.lg_da:
-                slope_sub = self.reclassify(slope, ndval, self.lg_slope)
-                #print("Reclassified slope for large area")
-            elif self.lg_da > da >= self.med_da:
-                slope_sub = self.reclassify(slope, ndval, self.med_slope)
-                #print("Reclassified slope for medium area")
-            else:
-                slope_sub = self.reclassify(slope, ndval, self.sm_slope)
-                #print("Reclassified slope for small area")
-
-            # Set threshold for hole filling
-            avlen = int(self.seglengths / len(self.network))
-            if da < self.med_da:
-                thresh = avlen * self.sm_buf * 0.005
-                #print(f"Threshold set for small area: {thresh}")
-            elif self.med_da <= da < self.lg_da:
-                thresh = avlen * self.med_buf * 0.005
-                #print(f"Threshold set for medium area: {thresh}")
-            else:  # da >= self.lg_da:
-                thresh = avlen * self.lg_buf * 0.005
-                #print(f"Threshold set for large area: {thresh}")
-
-            # Detrend DEM
+            slope_sub = self.reclassify(slope, ndval, slope_thresh)
+
+        # Detrend DEM (or take the global relative elevations) and reclassify detrended DEM
+        if self.rem is not None:
+            detr = self.rem_window(out_image[0], out_meta['transform'])
+        else:
             detr = self.detrend(dem, seg_geom)
-            #print("DEM detrended")
-
-            # Reclassify detrended DEM
-            if da >= self.lg_da:
-                depth = self.reclassify(detr, ndval, self.lg_depth)
-                #print("Reclassified depth for large area")
-            elif self.lg_da > da >= self.med_da:
-                depth = self.reclassify(detr, ndval, self.med_depth)
-                #print("Reclassified depth for medium area")
+        depth = self.reclassify(detr, ndval, depth_thresh)
+        mem.close()
+
+        # Check overlap and fill raster holes
+        overlap = self.raster_overlap(slope_sub, depth, ndval)
+        if 1 in overlap:
+            thresh, closing = self.scale_fill_parameters(thresh, out_meta['transform'])
+            filled = self.fill_raster_holes(overlap, thresh, ndval, closing)
+            return i, filled, out_meta['transform']
+        else:
+            return i, None, None
+
+    def segment_valley_bottom_low_memory(self, window):
+        """
+        Low memory version of segment_valley_bottom. Elevations are kept in float32, masks are boolean, full size
+        arrays are views of buffers reused across segments and the result is bit-packed while it waits to be written.
+        With memory_stats, records the peak traced memory of the segment.
+        :param window: a window returned by read_segment
+        :return: tuple of (network index, packed valley bottom mask or None if there is no valley bottom, affine
+        transform of the mask)
+        """
+        i, da, seg_geom, out_image, out_meta = window
+        if self.memory_stats:
+            tracemalloc.reset_peak()
+            start_mem = tracemalloc.get_traced_memory()[0]
+
+        ndval = out_meta['nodata']
+        transform = out_meta['transform']
+        shape = out_image.shape[1:]
+        slope_thresh, depth_thresh, thresh = self.segment_thresholds(da)
+
+        arr = self.pool.array('dem', shape, np.float32)
+        arr[...] = out_image[0]
+
+        slope_sub = self.pool.array('slope_mask', shape, bool)
+        stored = self.stored_slope_window(transform, shape)
+        if stored is not None:
+            overlap = self.reclassify_mask(stored, ndval, slope_thresh, out=slope_sub)
+        elif self.slope_backend == 'convolve':
+            slope = self.slope_low_memory(arr, transform[0], -transform[4], ndval)
+            overlap = self.reclassify_mask(slope, ndval, slope_thresh, out=slope_sub)
+        elif self.slope_backend == 'sobel':
+            slope = sobel_slope(arr, transform[0], -transform[4], ndval)
+            overlap = self.reclassify_mask(slope, ndval, slope_thresh, out=slope_sub)
+        else:
+            overlap = slope_mask(arr, transform[0], -transform[4], ndval, slope_thresh, out=slope_sub)
+
+        if self.rem is not None:
+            detr = self.rem_window(out_image[0], transform, out=self.pool.array('rem', shape, np.float32))
+        else:
+            detr = self.detrend_low_memory(arr, transform, ndval, seg_geom)
+        depth = self.reclassify_mask(detr, ndval, depth_thresh, out=self.pool.array('depth_mask', shape, bool))
+        overlap &= depth
+
+        result = None
+        if overlap.any():
+            thresh, closing = self.scale_fill_parameters(thresh, transform)
+            filled = self.fill_mask(overlap, thresh, closing)
+            filled[-1, :] = False
+            filled[:, -1] = False
+            result = pack_mask(filled)
+
+        if self.memory_stats:
+            self.peak_mb[i] = (tracemalloc.get_traced_memory()[1] - start_mem) / 1e6
+
+        return i, result, transform
+
+    def segment_stages(self, window):
+        """
+        Builds the slope and depth filters of a segment window for the stage graph. Each filter only evaluates the
+        box of cells it is given (plus the one cell neighbourhood the slope needs), and gives the same result in that
+        box as running it on the whole window.
+        :param window: a window returned by read_segment
+        :return: list of Stage
+        """
+        from processing.stages import Stage
+        i, da, seg_geom, out_image, out_meta = window
+        arr = out_image[0]
+        ndval = out_meta['nodata']
+        transform = out_meta['transform']
+        xres, yres = transform[0], -transform[4]
+        slope_thresh, depth_thresh, _ = self.segment_thresholds(da)
+
+        def slope_stage(rows, cols):
+            box_transform = transform * Affine.translation(cols.start, rows.start)
+            stored = self.stored_slope_window(box_transform, (rows.stop - rows.start, cols.stop - cols.start))
+            if stored is not None:
+                return (stored <= slope_thresh) & (stored > 0) & (stored != ndval)
+            # grow the box by the kernel radius, clipped to the window so edges are handled as on the whole window
+            r0, c0 = max(rows.start - 1, 0), max(cols.start - 1, 0)
+            r1, c1 = min(rows.stop + 1, arr.shape[0]), min(cols.stop + 1, arr.shape[1])
+            sub = arr[r0:r1, c0:c1]
+            inner = (slice(rows.start - r0, rows.stop - r0), slice(cols.start - c0, cols.stop - c0))
+            if self.slope_backend == 'mask':
+                return slope_mask(sub, xres, yres, ndval, slope_thresh)[inner]
+            if self.slope_backend == 'convolve':
+                slope = convolve_slope(sub, xres, yres).astype(arr.dtype)
             else:
-                depth = self.reclassify(detr, ndval, self.sm_depth)
-                #print("Reclassified depth for small area")
-
-            # Check overlap and fill raster holes
-            overlap = self.raster_overlap(slope_sub, depth, ndval)
-            if 1 in overlap:
-                #print("Overlap found, filling raster holes")
-                filled = self.fill_raster_holes(overlap, thresh, ndval)
-                a = self.raster_to_shp(filled, dem)
-                self.network.loc[i, 'fp_area'] = a
-                #print(f"Filled raster area for segment {i}")
+                slope = sobel_slope(sub, xres, yres, ndval)
+            slope = slope[inner]
+
+            return (slope <= slope_thresh) & (slope > 0) & (slope != ndval)
+
+        def depth_stage(rows, cols):
+            sub = arr[rows, cols]
+            if self.rem is not None:
+                detr = self.rem_window(sub, transform * Affine.translation(cols.start, rows.start))
             else:
-                self.network.loc[i, 'fp_area'] = 0
-                #print(f"No overlap for segment {i}, fp_area set to 0")
+                fit = self.detrend_fit(arr, transform, ndval, seg_geom)
+                grid_r, grid_c = np.ogrid[rows, cols]
+                detr = sub - (fit[0] * grid_c + fit[1] * grid_r + fit[2]).astype(arr.dtype)
+
+            return (detr <= depth_thresh) & (detr > 0) & (detr != ndval)
 
-            demsrc.close()
-        #print(f"Completed processing for segment {i}\n")
-        self.network.to_file(self.streams)
+        # the trend plane fit is the expensive part of segment detrending, reading the global raster is cheap
+        depth_cost = 1. if self.rem is not None else 10.
 
-        # merge all polygons in folder and dissolve
+        return [Stage('slope', slope_stage, cost=2.), Stage('depth', depth_stage, cost=depth_cost)]
+
+    def segment_valley_bottom_staged(self, window):
+        """
+        Short circuit version of segment_valley_bottom. The slope and depth filters are evaluated through the stage
+        graph, so a segment whose first filter leaves no candidate cells is never detrended or filled, and later
+        filters only see the bounding box of the remaining candidates.
+        :param window: a window returned by read_segment
+        :return: tuple of (network index, packed valley bottom mask or None if there is no valley bottom, affine
+        transform of the mask)
+        """
+        i, da, seg_geom, out_image, out_meta = window
+        transform = out_meta['transform']
+        _, _, thresh = self.segment_thresholds(da)
+
+        # the last row and column are never valley bottom (see reclassify and raster_overlap)
+        candidates = np.ones(out_image.shape[1:], dtype=bool)
+        candidates[-1, :] = False
+        candidates[:, -1] = False
+
+        overlap = self.stage_graph.run(self.segment_stages(window), candidates, skip=('fill',))
+        if overlap is None:
+            return i, None, None
+
+        start = time.perf_counter()
+        thresh, closing = self.scale_fill_parameters(thresh, transform)
+        filled = self.fill_mask(overlap, thresh, closing)
+        filled[-1, :] = False
+        filled[:, -1] = False
+        fill = self.stage_graph.counter('fill')
+        fill['runs'] += 1
+        fill['seconds'] += time.perf_counter() - start
+
+        return i, pack_mask(filled), transform
+
+    def compute_split(self, compute):
+        """
+        Wraps a segment compute function so it also takes the sub-windows of a split segment: each sub-window is
+        computed on its own and its valley bottom is kept where it is nearest to the sub-window's centerline piece
+        :param compute: segment compute function
+        :return: function taking a window returned by read_segment
+        """
+        from processing.subwindows import owned_cells
+
+        def run(window):
+            i, _, _, out_image, out_meta = window
+            if out_image is not None:
+                return compute(window)
+
+            parts = []
+            for k, subwindow in enumerate(out_meta['subwindows']):
+                _, filled, transform = compute(subwindow)
+                if filled is None:
+                    continue
+                if isinstance(filled, tuple):
+                    mask = unpack_mask(*filled)
+                else:
+                    mask = filled == 1
+                owned_cells(mask, transform, out_meta['pieces'], k)
+                if mask.any():
+                    parts.append((mask.view(np.uint8), transform))
+
+            return i, parts, None
+
+        return run
+
+    def quarantine_segment(self, stage, item, e):
+        """
+        Records a segment that failed so the run can carry on with the next one
+        :param stage: 'read', 'compute' or 'write'
+        :param item: the segment, window or result that failed (the network index is its first element)
+        :param e: the exception
+        :return:
+        """
+        i = item[0]
+        tb = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+        self.quarantine[i] = (stage, str(e), tb)
+        self.fp_areas.pop(i, None)
+        if self.clusters is not None:
+            # a segment that failed before its read would otherwise keep its cluster's DEM block in memory
+            self.clusters.release(i)
+        print(f"Segment {i} quarantined after a {stage} error: {e}")
+
+        return
+
+    def save_quarantine(self):
+        """
+        Saves the failed segments, with the stage that failed, the error and its traceback, as a layer next to the
+        output (or removes the layer of an earlier run if nothing failed)
+        :return:
+        """
+        if len(self.quarantine) == 0:
+            if os.path.isfile(self.quarantine_path):
+                os.remove(self.quarantine_path)
+            return
+
+        failed = list(self.quarantine.keys())
+        q = self.network.loc[failed, ['geometry']].copy()
+        q['seg_index'] = failed
+        q['stage'] = [self.quarantine[i][0] for i in failed]
+        q['error'] = [self.quarantine[i][1] for i in failed]
+        q['traceback'] = [self.quarantine[i][2] for i in failed]
+        write_vector(q, self.quarantine_path)
+
+        q_report = '{} segments quarantined, see {}'.format(len(failed), self.quarantine_path)
+        print(q_report)
+        self.md.writelines('\n{} \n'.format(q_report))
+
+        return
+
+    def quarantined_segments(self):
+        """
+        Finds the network segments saved in the quarantine layer of an earlier run. Segments are matched by geometry
+        because the network is renumbered when it is cleaned.
+        :return: list of network indices
+        """
+        if not os.path.isfile(self.quarantine_path):
+            self.md.writelines('\n Exception: No quarantined segments to retry ({} does not exist) \n'.format(
+                self.quarantine_path))
+            self.md.close()
+            raise Exception('No quarantined segments to retry, {} does not exist'.format(self.quarantine_path))
+
+        failed = set(g.wkb for g in read_vector(self.quarantine_path).geometry)
+
+        return [i for i, g in zip(self.network.index, self.network.geometry) if g.wkb in failed]
+
+    def write_segment(self, result):
+        """
+        Converts the valley bottom array of a segment to polygons (or burns it into the valley bottom raster) and
+        records the valley bottom area of the segment
+        :param result: a result returned by segment_valley_bottom
+        :return:
+        """
+        i, filled, transform = result
+        # a split segment has a valley bottom array for each sub-window
+        parts = filled if isinstance(filled, list) else [(filled, transform)] if filled is not None else []
+        parts = [(unpack_mask(*f).view(np.uint8) if isinstance(f, tuple) else f, t) for f, t in parts]
+
+        # nothing is added to the output until every part has been converted, so a segment that fails here is
+        # quarantined without leaving part of its valley bottom behind
+        if self.mosaic is not None:
+            self.fp_areas[i] = self.mosaic.burn_parts([(f == 1, t) for f, t in parts]) * self.mosaic.cell_area
+            return
+
+        if len(parts) > 1:
+            # sub-windows on one grid are traced as one mask, giving the polygons of the unsplit segment
+            from processing.subwindows import mosaic_parts
+            mosaic = mosaic_parts(parts)
+            parts = parts if mosaic is None else [mosaic]
+        polys = []
+        area = sum(self.raster_to_shp(f, transform=t, sink=polys) for f, t in parts)
+        if len(parts) > 1:
+            # dissolve the polygons of sub-windows resampled to their own grids and drop the vertices left along the
+            # seams, which traced polygons do not have
+            merged = shapely.simplify(unary_union(polys), 0)
+            polys = list(getattr(merged, 'geoms', [merged]))
+        self.polygons.extend(polys)
+        if len(parts) > 0:
+            self.segment_polys[i] = polys
+        self.fp_areas[i] = area
+
+        return
+
+    def changed_segments(self, segments, store):
+        """
+        Finds the segments to recompute after the DEM was patched: those whose buffer intersects the changed region
+        and those that are not in the segment store
+        :param segments: list of (network index, drainage area, segment geometry)
+        :param store: segment store of the earlier run
+        :return: tuple of (list of segments to recompute, polygon around the recomputed segments' buffers or None)
+        """
+        from processing.incremental import changed_region, segment_id
+        if self.changed_extent is not None:
+            region = box(*self.changed_extent)
+        else:
+            print('Comparing {} with {}'.format(self.previous_dem, self.dem))
+            region = changed_region(self.previous_dem, self.dem)
+
+        changed = []
+        buffers = []
+        segment_buffers = self.segment_buffers()
+        for segment in segments:
+            i, da, seg_geom = segment
+            buf = segment_buffers[i]
+            if segment_id(seg_geom) not in store.index or (region is not None and buf.intersects(region)):
+                changed.append(segment)
+                buffers.append(buf)
+        zone = unary_union(buffers) if len(buffers) > 0 else None
+
+        return changed, zone
+
+    def save_segment_store(self, store=None):
+        """
+        Saves the valley bottom area and polygons (with the minimum buffer) of every segment, replacing the entries
+        of the recomputed segments in the store of an earlier run
+        :param store: segment store of an earlier run, or None to start a new one
+        :return: the saved store
+        """
+        from processing.incremental import segment_id, write_store
+        ids = [segment_id(g) for g in self.network.loc[list(self.fp_areas.keys())].geometry]
+        geoms = []
+        for i in self.fp_areas.keys():
+            min_buf = self.network.loc[i].geometry.buffer(self.min_buf)
+            geoms.append(unary_union(self.segment_polys.get(i, []) + [min_buf]))
+        fresh = gpd.GeoDataFrame({'seg_id': ids, 'fp_area': list(self.fp_areas.values())}, geometry=geoms,
+                                 crs=self.crs_out).set_index('seg_id')
+
+        if store is not None:
+            current = set(segment_id(g) for g in self.network.geometry)
+            store = store[[k in current and k not in fresh.index for k in store.index]]
+            fresh = pd.concat([store, fresh])
+        write_store(self.store_path, fresh)
+
+        return fresh
+
+    def clean_valley_bottom(self, polygons):
+        """
+        Merges valley bottom polygons, simplifies them, removes the features that do not touch the network and
+        smooths them
+        :param polygons: list of valley bottom polygons
+        :return: list of smoothed polygons
+        """
+        # merge all polygons and dissolve
         print("Merging valley bottom segments")
-        vb = gpd.GeoSeries(unary_union(self.polygons))  #
-        vb.crs = self.crs_out
-        vb.to_file(self.scratch + "/tempvb.shp")
-        del vb
+        vb = gpd.GeoSeries(unary_union(polygons), crs=self.crs_out)
 
         # simplify and smooth polygon
         print("Cleaning valley bottom")
-        vbc = gpd.read_file(self.scratch + "/tempvb.shp")
-        vbc = vbc.simplify(3, preserve_topology=True)  # make number a function of dem resolution
-        vbc.to_file(self.scratch + "/tempvb.shp")
-        del vbc
+        vbc = vb.simplify(3, preserve_topology=True)  # make number a function of dem resolution
+        del vb
 
         # get rid of small unattached polygons
-        self.network.to_file(self.scratch + "/dissnetwork.shp")
-        network2 = gpd.read_file(self.scratch + "/dissnetwork.shp")
-        network2['dissolve'] = 1
-        network2 = network2.dissolve('dissolve')
-        vb1 = gpd.read_file(self.scratch + "/tempvb.shp")
-        vbm2s = vb1.explode(ignore_index=True)
+        network2 = unary_union(list(self.network.geometry))
+        vbm2s = gpd.GeoDataFrame(geometry=vbc, crs=self.crs_out).explode(ignore_index=True)
         print('Removing valley bottom features that do not intersect stream network')
         print('Started with {} valley bottom features'.format(len(vbm2s)))
-        del vb1
-        sub = []
-        for i in vbm2s.index:
-            segs = 0
-            for j in network2.index:
-                if network2.loc[j].geometry.intersects(vbm2s.loc[i].geometry):
-                    segs += 1
-            if segs > 0:
-                sub.append(True)
-            else:
-                sub.append(False)
+        del vbc
 
-        vbcut = vbm2s[sub].reset_index(drop=True)
+        vbcut = vbm2s[vbm2s.intersects(network2)].reset_index(drop=True)
         print('Cleaned to {} valley bottom features'.format(len(vbcut)))
         del vbm2s
-        vbcut.to_file(self.scratch + "/tempvb.shp")
+
+        if self.smoothing == 'bulk':
+            return smooth_polygons(list(vbcut.geometry), self.smooth_refinements, self.vertex_budget,
+                                   self.smooth_tolerance)
 
         polys = []
         for i in vbcut.index:
             coords = list(vbcut.loc[i].geometry.exterior.coords)  # vbcut WAS vbc when using shapely simplify.
-            new_coords = self.chaikins_corner_cutting(coords)
+            new_coords = self.chaikins_corner_cutting(coords, self.smooth_refinements)
             polys.append(Polygon(new_coords))
 
+        return polys
+
+    def splice_valley_bottom(self, store, zone):
+        """
+        Rebuilds the valley bottom of an incremental run around the recomputed segments only. The merge,
+        simplification and smoothing are redone for the contributions that reach into the recomputed segments'
+        buffers (grown by a margin so the smoothing settles before the edge), and that part replaces the
+        earlier output inside the zone. Everything outside the zone is left exactly as it was.
+        :param store: updated segment store
+        :param zone: polygon around the recomputed segments' buffers (None if no segment was recomputed)
+        :return: list of valley bottom polygons
+        """
+        from processing.incremental import splice
+        previous = list(read_vector(self.out).geometry)
+        if zone is None:
+            return previous
+
+        # minimum buffers (of the whole input network) and recomputed segments, then the stored segments
+        zone = zone.buffer(4 * max(self.dem_res, 3))
+        contributions = [g for g in self.polygons + list(store.geometry) if g is not None and g.intersects(zone)]
+        rebuilt = self.clean_valley_bottom(contributions)
+
+        return splice(previous, rebuilt, zone)
+
+    def estimate_costs(self, segments):
+        """
+        Estimates the processing time of each segment from the cells and vertices of its buffer with the cost model
+        calibrated by earlier runs with the same processing options
+        :param segments: list of (network index, drainage area, segment geometry)
+        :return: dict of network index: (cells, vertices)
+        """
+        profile = profile_name(self.short_circuit, self.low_memory, self.detrend_mode, self.output_mode)
+        self.cost = CostModel(self.cost_model or os.path.join(self.scratch, 'cost_model.json'), profile)
+        with rasterio.open(self.dem) as src:
+            dem_res = src.res[0]
+        features = {}
+        buffers = self.segment_buffers()
+        for i, da, seg_geom in segments:
+            res = self.segment_resolution(da) or dem_res
+            features[i] = segment_features(buffers[i], res)
+            self.segment_costs[i] = self.cost.predict(*features[i])
+
+        return features
+
+    def timed(self, func):
+        """
+        Wraps a segment read, compute or write function to add its run time to the segment's total
+        :param func: function taking a segment, window or result (each starting with the network index)
+        :return: wrapped function
+        """
+        def run(item):
+            start = time.perf_counter()
+            try:
+                return func(item)
+            finally:
+                self.segment_seconds[item[0]] = self.segment_seconds.get(item[0], 0.) + time.perf_counter() - start
+
+        return run
+
+    def save_costs(self, features):
+        """
+        Records the timings of the segments processed without errors, refits the cost model and saves it. The first
+        segment of a run also pays for opening the DEM and lazy imports, so its timing is left out.
+        :param features: dict of network index: (cells, vertices)
+        :return:
+        """
+        for i, seconds in list(self.segment_seconds.items())[1:]:
+            if i not in self.quarantine and i in features:
+                self.cost.record(features[i][0], features[i][1], seconds)
+        self.cost.save()
+        predicted = sum(self.segment_costs[i] for i in self.segment_seconds if i in self.segment_costs)
+        cost_report = '{}; this run {:.1f} s of segment time, {:.1f} s estimated beforehand'.format(
+            self.cost.report(), sum(self.segment_seconds.values()), predicted)
+        print(cost_report)
+        self.md.writelines('\n{} \n'.format(cost_report))
+
+        return
+
+    def valley_bottom(self):
+        """
+        Run the VBET algorithm
+        :return: saves a valley bottom shapefile
+        """
+
+        self.clean_network()
+
+        with rasterio.open(self.dem) as src:
+            self.dem_res = src.res[0]
+
+        # average segment length scales the hole filling threshold
+        if self.avlen is None:
+            self.avlen = int(self.seglengths / len(self.network))
+
+        buffer_start = time.perf_counter()
+        self.buffers = self.bulk_buffers()
+        buffer_time = time.perf_counter() - buffer_start
+
+        if self.detrend_mode == 'global':
+            self.relative_elevation()
+
+        print('Generating valley bottom for each network segment')
+        segments = list(zip(self.network.index, self.network['Drain_Area'], self.network.geometry))
+        self.fp_areas = {}
+        if self.retry_quarantined:
+            retry = self.quarantined_segments()
+            print('Retrying {} quarantined segments'.format(len(retry)))
+            self.md.writelines('\nRetrying {} quarantined segments \n'.format(len(retry)))
+            segments = [seg for seg in segments if seg[0] in retry]
+            self.polygons = list(self.network.loc[retry].geometry.buffer(self.min_buf))
+        store, zone = None, None
+        if self.incremental:
+            if not os.path.isfile(self.store_path) or not os.path.isfile(self.out):
+                self.md.writelines('\n Exception: Incremental run without the output and segment store of an earlier '
+                                   'run \n')
+                self.md.close()
+                raise Exception('Incremental runs need the output and segment store ({}) of an earlier run with '
+                                'segment_store: True'.format(self.store_path))
+            from processing.incremental import read_store
+            store = read_store(self.store_path)
+            total_segments = len(segments)
+            segments, zone = self.changed_segments(segments, store)
+            inc_report = 'Incremental run: recomputing {} of {} segments'.format(len(segments), total_segments)
+            print(inc_report)
+            self.md.writelines('\n{} \n'.format(inc_report))
+        if self.output_mode == 'raster':
+            from processing.mosaic import ValleyBottomMosaic
+            self.mosaic = ValleyBottomMosaic(self.dem, self.scratch)
+        if self.short_circuit:
+            from processing.stages import StageGraph
+            self.stage_graph = StageGraph()
+            compute = self.segment_valley_bottom_staged
+        elif self.low_memory:
+            compute = self.segment_valley_bottom_low_memory
+            # tracing slows down every allocation, so it only runs when per-segment memory is asked for
+            if self.memory_stats and not tracemalloc.is_tracing():
+                tracemalloc.start()
+        else:
+            compute = self.segment_valley_bottom
+        if self.window_budget is not None:
+            compute = self.compute_split(compute)
+        if self.prescreen > 1:
+            total = len(segments)
+            segments = self.prescreen_segments(segments)
+        features = self.estimate_costs(segments)
+        if self.read_clusters and self.store is None:
+            self.clusters = self.plan_reads(segments)
+        loop_start = time.perf_counter()
+        if self.prefetch > 0:
+            pipeline = PrefetchPipeline(self.timed(self.read_segment), self.timed(compute),
+                                        self.timed(self.write_segment), depth=self.prefetch,
+                                        readers=self.read_threads, on_error=self.quarantine_segment,
+                                        weight=lambda item: self.segment_costs[item[0]])
+            pipeline.run(segments)
+            print(pipeline.report())
+            self.md.writelines('\n{} \n'.format(pipeline.report()))
+        else:
+            with tqdm(total=sum(self.segment_costs.values()), smoothing=0, bar_format=COST_BAR) as progress:
+                for segment in segments:
+                    stage = 'read'
+                    start = time.perf_counter()
+                    try:
+                        window = self.read_segment(segment)
+                        stage = 'compute'
+                        result = compute(window)
+                        stage = 'write'
+                        self.write_segment(result)
+                    except Exception as e:
+                        self.quarantine_segment(stage, segment, e)
+                    self.segment_seconds[segment[0]] = time.perf_counter() - start
+                    progress.update(self.segment_costs[segment[0]])
+        loop_time = time.perf_counter() - loop_start
+        self.save_costs(features)
+        if self.tiles is not None:
+            print(self.tiles.report())
+            self.md.writelines('\n{} \n'.format(self.tiles.report()))
+        if len(self.setup_seconds) > 0:
+            setup = list(self.setup_seconds.values())
+            setup_report = 'Segment setup (window and buffer mask): {:.2f} ms per segment on average, {:.2f} ms at ' \
+                           'most; {} buffers built in {:.2f} s'.format(1000 * sum(setup) / len(setup),
+                                                                       1000 * max(setup), len(self.buffers),
+                                                                       buffer_time)
+            print(setup_report)
+            self.md.writelines('\n{} \n'.format(setup_report))
+        if self.clusters is not None:
+            print(self.clusters.report())
+            self.md.writelines('\n{} \n'.format(self.clusters.report()))
+            self.clusters = None
+        self.close_dem_handles()
+        if self._rem_src is not None:
+            self._rem_src.close()
+            self._rem_src = None
+        if self.segment_store or self.incremental:
+            store = self.save_segment_store(store)
+        if self.incremental:
+            from processing.incremental import segment_id
+            self.network['fp_area'] = [store.loc[segment_id(g), 'fp_area'] if segment_id(g) in store.index
+                                       else np.nan for g in self.network.geometry]
+        elif self.retry_quarantined and (os.path.isfile(self.network_out) or 'fp_area' in self.network.columns):
+            if os.path.isfile(self.network_out):
+                previous = read_vector(self.network_out)
+                areas = dict(zip([g.wkb for g in previous.geometry], previous['fp_area']))
+                self.network['fp_area'] = [areas.get(g.wkb, np.nan) for g in self.network.geometry]
+            done = list(self.fp_areas.keys())
+            self.network.loc[done, 'fp_area'] = [self.fp_areas[i] for i in done]
+        else:
+            self.network['fp_area'] = self.network.index.map(self.fp_areas)  # NaN for quarantined segments
+        self.save_quarantine()
+
+        if self.prescreen > 1:
+            from processing.prescreen import EMPTY, SATURATED
+            skipped = total - len(segments)
+            saved = skipped * loop_time / max(len(segments), 1) - self.prescreen_time
+            screen_report = 'Prescreen skipped {} of {} segments ({} empty, {} saturated), prescreen took {:.1f} s, ' \
+                            'estimated time saved {:.1f} s'.format(skipped, total, self.prescreened[EMPTY],
+                                                                   self.prescreened[SATURATED], self.prescreen_time,
+                                                                   saved)
+            print(screen_report)
+            self.md.writelines('\n{} \n'.format(screen_report))
+
+        if len(self.split_windows) > 0:
+            split_report = 'Split {} segment windows larger than {} cells into {} sub-windows'.format(
+                len(self.split_windows), self.window_budget, sum(self.split_windows.values()))
+            print(split_report)
+            self.md.writelines('\n{} \n'.format(split_report))
+
+        if self.short_circuit:
+            print('Segment stages:')
+            self.md.writelines('\nSegment stages: \n')
+            for line in self.stage_graph.report():
+                print('  ' + line)
+                self.md.writelines('  {} \n'.format(line))
+
+        if self.low_memory:
+            rss = peak_rss_mb()
+            mem_report = 'Low memory mode: pooled buffers {:.1f} MB{}'.format(
+                self.pool.nbytes() / 1e6, '' if rss is None else ', process peak memory {:.1f} MB'.format(rss))
+            if self.memory_stats:
+                tracemalloc.stop()
+                self.network['peak_mb'] = self.network.index.map(self.peak_mb)
+                peaks = list(self.peak_mb.values())
+                if len(peaks) > 0:
+                    mem_report += ', peak segment memory {:.1f} MB (mean {:.1f} MB)'.format(max(peaks),
+                                                                                          sum(peaks) / len(peaks))
+            print(mem_report)
+            self.md.writelines('\n{} \n'.format(mem_report))
+
+        write_vector(self.network, self.network_out)
+        self.md.writelines('\nNetwork with valley bottom areas: {} \n'.format(self.network_out))
+
+        # polygonize the valley bottom raster once, with the minimum buffers burned in
+        if self.mosaic is not None:
+            print('Polygonizing valley bottom raster')
+            self.mosaic.burn_shapes(self.polygons)
+            self.polygons = self.mosaic.polygonize()
+            vb_raster = os.path.splitext(self.out)[0] + '_vb.tif'
+            if self.retry_quarantined and os.path.isfile(vb_raster):
+                self.mosaic.burn_raster(vb_raster)
+            self.mosaic.save(vb_raster)
+            self.mosaic.close()
+            self.mosaic = None
+
+        if self.incremental:
+            polys = self.splice_valley_bottom(store, zone)
+        else:
+            polys = self.clean_valley_bottom(self.polygons)
+
         if len(polys) > 1:
             p = MultiPolygon(polys)
         else:
@@ -621,7 +1718,19 @@ class VBET:
             areas.append(vbf.loc[i].geometry.area/1000000.)
         vbf['Area_km2'] = areas
 
-        vbf.to_file(self.out, driver='GPKG')
+        # add the retried segments to the valley bottom of the earlier run
+        if self.retry_quarantined and os.path.isfile(self.out):
+            previous = read_vector(self.out)
+            vbf = gpd.GeoDataFrame(geometry=[unary_union(list(previous.geometry) + list(vbf.geometry))],
+                                   crs=self.crs_out).explode(ignore_index=True)
+            vbf['Area_km2'] = vbf.geometry.area / 1000000.
+
+        write_start = time.perf_counter()
+        write_vector(vbf, self.out, driver='GPKG')
+        write_report = 'Valley bottom output: {} polygons, {} vertices, written in {:.1f} s'.format(
+            len(vbf), int(shapely.get_num_coordinates(vbf.geometry.values).sum()), time.perf_counter() - write_start)
+        print(write_report)
+        self.md.writelines('\n{} \n'.format(write_report))
 
         print(f"Saved valley bottom to {self.out}")
         # close metadata text tile
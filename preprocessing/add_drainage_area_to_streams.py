@@ -7,13 +7,17 @@ from rasterio.enums import Resampling
 import os
 import fiona
 
+from processing.vector_io import read_vector, write_vector
 
 
-def add_drainage_area_to_streams(flow_accum_path, segmented_CL_path, output_gpkg = None, drainage_area_path = None):
-    # Define buffer distance in meters
-    buffer_distance = 5  # 5 meters
 
-    # Step 1: Compute Drainage Area Raster
+def drainage_area_raster(flow_accum_path, out_path):
+    """
+    Converts a flow accumulation raster (cells) to a drainage area raster (square kilometers)
+    :param flow_accum_path: flow accumulation raster
+    :param out_path: output drainage area raster
+    :return: out_path
+    """
     with rasterio.open(flow_accum_path) as src:
         # Read flow accumulation data
         flow_accum = src.read(1, masked=True)
@@ -35,24 +39,23 @@ def add_drainage_area_to_streams(flow_accum_path, segmented_CL_path, output_gpkg
             "nodata": np.nan
         })
         
-        if drainage_area_path is None:
-            # Use a default path if not provided
-            drainage_area_path = os.path.splitext(flow_accum_path)[0] + "_da.tif"
         # Save the drainage area raster
-        with rasterio.open(drainage_area_path, 'w', **drainage_meta) as dst:
+        with rasterio.open(out_path, 'w', **drainage_meta) as dst:
             dst.write(drainage_area.astype(rasterio.float32), 1)
 
-    print(f"Drainage area raster created at {drainage_area_path}.")
+    print(f"Drainage area raster created at {out_path}.")
+    return out_path
 
-    # Step 2: Load Streams and Assign Drainage Area
-    try:
-        gdf = gpd.read_file(segmented_CL_path)
-        print("GeoPackage loaded successfully.")
-    except Exception as e:
-        print(f"Failed to read GeoPackage: {e}")
-        # Optionally, exit or handle the error
-        exit(1)
 
+def assign_drainage_area(gdf, drainage_area_path, buffer_distance=5):
+    """
+    Adds the maximum drainage area within a buffer of each stream segment as a 'DA' column
+    :param gdf: GeoDataFrame of stream segments
+    :param drainage_area_path: drainage area raster
+    :param buffer_distance: buffer distance in meters
+    :return: GeoDataFrame with the DA column
+    """
+    gdf = gdf.copy()
 
     # Open the drainage area raster
     with rasterio.open(drainage_area_path) as da_src:
@@ -86,7 +89,7 @@ def add_drainage_area_to_streams(flow_accum_path, segmented_CL_path, output_gpkg
                 
                 if valid_data.size > 0:
                     # Calculate the maximum drainage area within the buffer
-                    max_drainage_area = np.max(valid_data)
+                    max_drainage_area = float(np.max(valid_data))
                 else:
                     max_drainage_area = np.nan
             except Exception as e:
@@ -99,6 +102,32 @@ def add_drainage_area_to_streams(flow_accum_path, segmented_CL_path, output_gpkg
         # Add the new 'DA' column to the GeoDataFrame
         gdf['DA'] = drainage_areas
 
+    return gdf
+
+
+def add_drainage_area_to_streams(flow_accum_path, segmented_CL_path, output_gpkg = None, drainage_area_path = None):
+    # Step 1: Compute Drainage Area Raster
+    if drainage_area_path is None:
+        # Use a default path if not provided
+        drainage_area_path = os.path.splitext(flow_accum_path)[0] + "_da.tif"
+    drainage_area_raster(flow_accum_path, drainage_area_path)
+
+    # Step 2: Load Streams and Assign Drainage Area
+    if isinstance(segmented_CL_path, gpd.GeoDataFrame):
+        gdf = segmented_CL_path
+        if output_gpkg is None:
+            raise ValueError("output_gpkg is needed when the streams are given as a GeoDataFrame.")
+    else:
+        try:
+            gdf = read_vector(segmented_CL_path)
+            print("GeoPackage loaded successfully.")
+        except Exception as e:
+            print(f"Failed to read GeoPackage: {e}")
+            # Optionally, exit or handle the error
+            exit(1)
+
+    gdf = assign_drainage_area(gdf, drainage_area_path)
+
     # Step 3: Save the Updated GeoDataFrame to a Shapefile
     # Ensure the output directory exists
     if output_gpkg is None:
@@ -106,9 +135,10 @@ def add_drainage_area_to_streams(flow_accum_path, segmented_CL_path, output_gpkg
     output_dir = os.path.dirname(output_gpkg)
     os.makedirs(output_dir, exist_ok=True)
 
-    gdf.to_file(output_gpkg, driver="GPKG")
+    write_vector(gdf, output_gpkg, driver="GPKG")
 
     print(f"Drainage areas calculated and saved to {output_gpkg}.")
+    return output_gpkg
 
 if __name__ == "__main__":
     # Input file paths
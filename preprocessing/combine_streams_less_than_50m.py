@@ -3,8 +3,14 @@ from shapely.ops import linemerge
 from shapely.geometry import MultiLineString
 import os
 
-def combine_streams_less_than_50m(input_shapefile):
-    gdf = gpd.read_file(input_shapefile)
+from processing.vector_io import read_vector, write_vector
+
+def combine_streams_less_than_50m(input_shapefile, write=True):
+    # input_shapefile can also be a GeoDataFrame; with write=False the merged lines are returned instead of saved
+    if isinstance(input_shapefile, gpd.GeoDataFrame):
+        gdf = input_shapefile.reset_index(drop=True)
+    else:
+        gdf = read_vector(input_shapefile)
 
     # Set the minimum length threshold for joining lines
     min_length = 50  # meters
@@ -33,6 +39,9 @@ def combine_streams_less_than_50m(input_shapefile):
     # Create a new GeoDataFrame with the merged lines
     merged_gdf = gpd.GeoDataFrame(geometry=merged_lines, crs=gdf.crs)
 
+    if not write:
+        return merged_gdf
+
     # Save the output to a new shapefile
     if os.path.splitext(input_shapefile)[1] == ".shp":
         output_name = os.path.basename(input_shapefile).replace(".shp", "_merged.shp")
@@ -42,7 +51,7 @@ def combine_streams_less_than_50m(input_shapefile):
         output_name = "merged.shp"
     output_shapefile = os.path.join(os.path.dirname(input_shapefile), "VBET Inputs", output_name)
     os.makedirs(os.path.dirname(output_shapefile), exist_ok=True)
-    merged_gdf.to_file(output_shapefile)
+    write_vector(merged_gdf, output_shapefile)
 
     print(f"Merged shapefile saved to {output_shapefile}")
     return output_shapefile
@@ -4,11 +4,16 @@ from shapely.ops import linemerge
 import numpy as np
 import os
 
+from processing.vector_io import read_vector, write_vector
+
 
 def create_smooth_perpendicular_lines(centerline_path, line_length=60, spacing=5, window=20, output_path=None):
 
-    # Load the centerline from the geopackage
-    gdf = gpd.read_file(centerline_path)
+    # Load the centerline from the geopackage (or take a GeoDataFrame already in memory)
+    if isinstance(centerline_path, gpd.GeoDataFrame):
+        gdf = centerline_path
+    else:
+        gdf = read_vector(centerline_path)
     
     try:
         # Dissolve and merge the centerlines into one continuous geometry
@@ -67,5 +72,5 @@ def create_smooth_perpendicular_lines(centerline_path, line_length=60, spacing=5
     
     # Save the perpendicular lines to the output geopackage
     if output_path is not None:
-        perpendiculars_gdf.to_file(output_path, driver='GPKG')
+        write_vector(perpendiculars_gdf, output_path, driver='GPKG')
     return perpendiculars_gdf
\ No newline at end of file
@@ -0,0 +1,215 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+
+from processing.vector_io import read_vector, write_vector
+
+# bump to invalidate every cached artifact after a change the stage keys do not see (e.g. how artifacts are written)
+CACHE_VERSION = 1
+
+
+def code_key(func):
+    """
+    Identifies the code of a stage: the module and name of its function and a hash of the source of the module, so
+    editing the function or a helper next to it gives the stage a new key
+    :param func: stage function
+    :return: string
+    """
+    name = '{}.{}'.format(getattr(func, '__module__', None), getattr(func, '__qualname__', repr(func)))
+    try:
+        source = inspect.getsource(inspect.getmodule(func)).encode()
+    except (OSError, TypeError):
+        # no source file (e.g. a function defined interactively): fall back to the function's bytecode
+        code = getattr(func, '__code__', None)
+        source = code.co_code if code is not None else b''
+
+    return '{}:{}'.format(name, hashlib.sha1(source).hexdigest())
+
+
+class ArtifactCache:
+    """
+    Content addressed store for the outputs of preprocessing stages. An artifact is named by the hash of the stage,
+    its code, its parameters and the keys of its inputs; input files are keyed by the hash of their contents.
+    Changing an input file, a parameter or the code of a stage therefore changes the key of every stage downstream of
+    it, while stages whose inputs did not change find their artifact under the same key as before.
+    """
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: folder of the cache
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._digest_path = os.path.join(cache_dir, 'digests.json')
+        try:
+            with open(self._digest_path) as f:
+                self._digests = json.load(f)
+        except (OSError, ValueError):
+            self._digests = {}
+
+    def file_key(self, path):
+        """
+        Hashes the contents of a file (a shapefile with its sidecar files). Hashes are remembered by path, size and
+        modification time, so an unchanged file is not read again.
+        :param path: path to the file
+        :return: hex digest
+        """
+        stem, ext = os.path.splitext(path)
+        parts = [path]
+        if ext.lower() == '.shp':
+            parts += [stem + e for e in ('.shx', '.dbf', '.prj', '.cpg') if os.path.isfile(stem + e)]
+
+        stamp = [[os.path.abspath(p), os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in parts]
+        memo = self._digests.get(os.path.abspath(path))
+        if memo is not None and memo['stamp'] == stamp:
+            return memo['digest']
+
+        h = hashlib.sha1()
+        for p in parts:
+            with open(p, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        digest = h.hexdigest()
+        self._digests[os.path.abspath(path)] = {'stamp': stamp, 'digest': digest}
+        tmp = self._digest_path + '.tmp{}'.format(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self._digests, f)
+        os.replace(tmp, self._digest_path)
+
+        return digest
+
+    def stage_key(self, name, input_keys, params, code=None):
+        """
+        :param name: stage name
+        :param input_keys: keys of the stage inputs
+        :param params: dict of stage parameters (JSON serialisable)
+        :param code: key of the stage code (see code_key)
+        :return: hex digest naming the stage output
+        """
+        blob = json.dumps([CACHE_VERSION, name, code, list(input_keys), params], sort_keys=True, default=str)
+
+        return hashlib.sha1(blob.encode()).hexdigest()
+
+    def path(self, name, key, ext):
+        return os.path.join(self.cache_dir, '{}_{}{}'.format(name, key[:16], ext))
+
+
+class Pipeline:
+    """
+    Runs preprocessing stages against an artifact cache. Stage outputs are handed to the next stage in memory; each
+    output is also saved in the cache so a later run can skip the stage when its inputs and parameters are the same.
+    Cached outputs are only read back when a stage downstream of them has to run.
+    """
+    def __init__(self, cache):
+        """
+        :param cache: ArtifactCache
+        """
+        self.cache = cache
+        self.keys = {}
+        self.paths = {}
+        self.ran = {}
+        self._values = {}
+        self._readers = {}
+        self.timings = []
+
+    def add_file(self, name, path, read=None):
+        """
+        Adds an input file to the pipeline
+        :param name: name stages use to refer to the file
+        :param path: path to the file
+        :param read: function reading the file, called once when the first stage that needs it runs (None to hand
+        stages the path)
+        :return:
+        """
+        start = time.perf_counter()
+        self.keys[name] = self.cache.file_key(path)
+        self.paths[name] = path
+        self._readers[name] = read if read is not None else (lambda p: p)
+        self.timings.append((name, 'hashed', time.perf_counter() - start))
+
+        return
+
+    def get(self, name):
+        """
+        :param name: name of an input or stage
+        :return: the value of the input or the output of the stage (read from the cache on first use)
+        """
+        if name not in self._values:
+            self._values[name] = self._readers[name](self.paths[name])
+
+        return self._values[name]
+
+    def stage(self, name, func, inputs, params=None, ext='.gpkg', read=read_vector, write=write_vector):
+        """
+        Runs a stage unless its output for the same inputs, parameters and stage code is already in the cache
+        :param name: stage name
+        :param func: function taking the values of the inputs and the parameters as keyword arguments and returning
+        the output. If write is None the function writes its output itself, to the path passed as out_path.
+        :param inputs: names of the inputs and stages the stage depends on
+        :param params: dict of parameters
+        :param ext: extension of the cached artifact
+        :param read: function reading a cached artifact back into memory (None to hand on the path of the artifact)
+        :param write: function writing the output to the cache (value, path), None if func writes it
+        :return: True if the stage ran, False if its output came from the cache
+        """
+        params = params or {}
+        start = time.perf_counter()
+        key = self.cache.stage_key(name, [self.keys[i] for i in inputs], params, code_key(func))
+        path = self.cache.path(name, key, ext)
+        self.keys[name] = key
+        self.paths[name] = path
+        self._readers[name] = read if read is not None else (lambda p: p)
+
+        if os.path.isfile(path):
+            self.ran[name] = False
+        else:
+            # written under its final name (GeoPackage layers are named after the file) and moved in when complete
+            tmp_dir = os.path.join(self.cache.cache_dir, 'tmp{}'.format(os.getpid()))
+            os.makedirs(tmp_dir, exist_ok=True)
+            tmp = os.path.join(tmp_dir, os.path.basename(path))
+            args = [self.get(i) for i in inputs]
+            if write is None:
+                func(*args, out_path=tmp, **params)
+                os.replace(tmp, path)
+                self._values[name] = path
+            else:
+                value = func(*args, **params)
+                write(value, tmp)
+                os.replace(tmp, path)
+                self._values[name] = value
+            try:
+                os.rmdir(tmp_dir)
+            except OSError:
+                pass
+            self.ran[name] = True
+        self.timings.append((name, 'ran' if self.ran[name] else 'cached', time.perf_counter() - start))
+
+        return self.ran[name]
+
+    def export(self, name, dest):
+        """
+        Copies the cached output of a stage to a user facing path
+        :param name: stage name
+        :param dest: destination path
+        :return: dest
+        """
+        folder = os.path.dirname(dest)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        shutil.copyfile(self.paths[name], dest)
+
+        return dest
+
+    def report(self):
+        """
+        :return: list of lines with the status and time of each stage
+        """
+        lines = ['{:<28} {:>7} {:>9}'.format('stage', 'status', 'seconds')]
+        for name, status, seconds in self.timings:
+            lines.append('{:<28} {:>7} {:>9.2f}'.format(name, status, seconds))
+        lines.append('{} of {} stages ran, {:.2f} s in total'.format(
+            sum(self.ran.values()), len(self.ran), sum(t[2] for t in self.timings)))
+
+        return lines
@@ -4,6 +4,8 @@ from shapely.geometry import LineString, MultiLineString
 from shapely import ops
 from shapely.errors import TopologicalError
 
+from processing.vector_io import read_vector, write_vector
+
 def split_stream_by_lines(line_gpkg: str, splitter_lines_gpkg: str, output_gpkg: str = None, min_length: float = 50.0):
     """
     Splits lines by intersecting splitter lines and merges any resulting segments
@@ -19,26 +21,22 @@ def split_stream_by_lines(line_gpkg: str, splitter_lines_gpkg: str, output_gpkg:
     str or gpd.GeoDataFrame: Path to the output GeoPackage if provided, otherwise a GeoDataFrame of split lines.
     """
 
-    # Handle output GeoPackage existence
+    # An existing output is overwritten; reruns with unchanged inputs are skipped by the preprocessing cache
     if output_gpkg is not None:
-        if os.path.exists(output_gpkg):
-            print(f"Output GeoPackage already exists: {output_gpkg}")
-            return output_gpkg
-        else:
-            print(f"Output GeoPackage will be saved to: {output_gpkg}")
+        print(f"Output GeoPackage will be saved to: {output_gpkg}")
 
     # Read input lines to split
     if isinstance(line_gpkg, gpd.GeoDataFrame):
         lines_to_split = line_gpkg.copy()
     else:
-        lines_to_split = gpd.read_file(line_gpkg)
+        lines_to_split = read_vector(line_gpkg)
         print(f"Loaded {len(lines_to_split)} lines to split from {line_gpkg}")
 
     # Read splitter lines
     if isinstance(splitter_lines_gpkg, gpd.GeoDataFrame):
         splitter_lines = splitter_lines_gpkg.copy()
     else:
-        splitter_lines = gpd.read_file(splitter_lines_gpkg)
+        splitter_lines = read_vector(splitter_lines_gpkg)
         print(f"Loaded {len(splitter_lines)} splitter lines from {splitter_lines_gpkg}")
 
     # Validate input GeoDataFrames
@@ -66,14 +64,14 @@ def split_stream_by_lines(line_gpkg: str, splitter_lines_gpkg: str, output_gpkg:
     def split_line(line, splitter):
         try:
             split_result = ops.split(line, splitter)
-            return list(split_result)
+            return list(split_result.geoms)
         except TopologicalError as e:
             print(f"TopologicalError encountered while splitting line: {e}")
             return [line]
 
     # Prepare to collect split lines with their original line IDs
     split_records = []
-    for idx, line in lines_to_split.geometry.iteritems():
+    for idx, line in lines_to_split.geometry.items():
         if isinstance(line, (LineString, MultiLineString)):
             try:
                 split_geometries = split_line(line, splitter_union)
@@ -100,6 +98,10 @@ def split_stream_by_lines(line_gpkg: str, splitter_lines_gpkg: str, output_gpkg:
     # Optional: Retain original attributes by repeating or aggregating as needed
     # For simplicity, this example does not carry over attributes beyond 'original_id'
 
+    # linemerge takes single lines only, so the parts of a segment that could not be merged are passed separately
+    def join(*geoms):
+        return ops.linemerge([part for geom in geoms for part in getattr(geom, 'geoms', [geom])])
+
     # Function to merge short segments within each group
     def merge_short_segments(group, min_len):
         merged = []
@@ -110,7 +112,7 @@ def split_stream_by_lines(line_gpkg: str, splitter_lines_gpkg: str, output_gpkg:
             if length >= min_len:
                 if buffer:
                     # Merge buffer with current geom
-                    merged_geom = ops.linemerge([buffer, geom])
+                    merged_geom = join(buffer, geom)
                     merged.append(merged_geom)
                     buffer = None
                 else:
@@ -118,7 +120,7 @@ def split_stream_by_lines(line_gpkg: str, splitter_lines_gpkg: str, output_gpkg:
             else:
                 if buffer:
                     # Merge existing buffer with current geom
-                    buffer = ops.linemerge([buffer, geom])
+                    buffer = join(buffer, geom)
                 else:
                     buffer = geom
 
@@ -127,7 +129,7 @@ def split_stream_by_lines(line_gpkg: str, splitter_lines_gpkg: str, output_gpkg:
             if merged:
                 # Merge the remaining buffer with the last merged segment
                 last = merged.pop()
-                merged_geom = ops.linemerge([last, buffer])
+                merged_geom = join(last, buffer)
                 merged.append(merged_geom)
             else:
                 # If there are no merged segments yet, just append the buffer
@@ -155,7 +157,7 @@ def split_stream_by_lines(line_gpkg: str, splitter_lines_gpkg: str, output_gpkg:
 
     # Write the split lines to the output GeoPackage or return the GeoDataFrame
     if output_gpkg is not None:
-        final_split_gdf.to_file(output_gpkg, driver='GPKG')
+        write_vector(final_split_gdf, output_gpkg, driver='GPKG')
         print(f"Split lines saved to {output_gpkg}")
         return output_gpkg
     else:
@@ -0,0 +1,259 @@
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+import shapely
+
+from processing.cost import lpt_makespan
+
+SUMMARY_FIELDS = ('name', 'status', 'seconds', 'worker', 'dem', 'network', 'out', 'error')
+
+
+def load_manifest(path):
+    """
+    Reads a batch manifest. A JSON (or TOML) manifest holds a list of jobs under "jobs", each with network, dem, out
+    and optionally name and params, and parameters shared by all jobs under "defaults". A CSV manifest has network,
+    dem and out columns, an optional name column, and any other column is a parameter (values read as JSON where
+    possible).
+    :param path: path to the manifest
+    :return: list of job dicts with name and the complete VBET parameters
+    """
+    if path.lower().endswith('.csv'):
+        defaults = {}
+        raw = []
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                job = {'params': {}}
+                for key, value in row.items():
+                    if key in ('network', 'dem', 'out', 'name'):
+                        job[key] = value
+                    elif value != '':
+                        try:
+                            job['params'][key] = json.loads(value)
+                        except ValueError:
+                            job['params'][key] = value
+                raw.append(job)
+    else:
+        if path.lower().endswith('.toml'):
+            import tomllib
+            with open(path, 'rb') as f:
+                manifest = tomllib.load(f)
+        else:
+            with open(path) as f:
+                manifest = json.load(f)
+        defaults = manifest.get('defaults', {})
+        raw = manifest['jobs']
+
+    jobs = []
+    for k, job in enumerate(raw):
+        params = dict(defaults)
+        params.update(job.get('params', {}))
+        params.update({key: job[key] for key in ('network', 'dem', 'out')})
+        name = job.get('name') or os.path.splitext(os.path.basename(job['out']))[0] or 'job{}'.format(k)
+        # every job gets its own scratch folder, jobs run side by side
+        params['scratch'] = os.path.join(params.get('scratch', os.path.join(os.path.dirname(job['out']), 'scratch')),
+                                         name)
+        params.setdefault('rem_cache', os.path.join(os.path.dirname(params['scratch']), 'rem'))
+        params.setdefault('cost_model', os.path.join(os.path.dirname(params['scratch']), 'cost_model.json'))
+        jobs.append({'name': name, 'params': params})
+
+    return jobs
+
+
+def store_for(params, store_root):
+    """
+    :return: raster store folder for the DEM and drainage area raster of a job within the batch store folder
+    """
+    key = [os.path.abspath(str(params['dem']))]
+    if params.get('dr_area') is not None:
+        key.append(os.path.abspath(str(params['dr_area'])))
+
+    return os.path.join(store_root, hashlib.sha1('|'.join(key).encode()).hexdigest()[:12])
+
+
+def estimate_job(params):
+    """
+    Estimates the segment processing time of a job with the cost model from the buffer of each segment, without
+    starting VBET (segments are classed by the drainage area field, or all given the largest buffer without one)
+    :param params: VBET parameters of the job
+    :return: estimated seconds
+    """
+    import rasterio
+    from processing.cost import CostModel, profile_name
+    from processing.tiles import list_tiles
+    from processing.vector_io import read_vector
+
+    network = read_vector(params['network'])
+    tiles = list_tiles(params['dem'])
+    with rasterio.open(tiles[0] if tiles else params['dem']) as src:
+        dem_res = src.res[0]
+    model = CostModel(params.get('cost_model'), profile_name(params.get('short_circuit', False),
+                                                             params.get('low_memory', False),
+                                                             params.get('detrend_mode', 'segment'),
+                                                             params.get('output_mode', 'vector')))
+    da = network[params['da_field']] if params.get('da_field') in network.columns else None
+
+    total = 0.
+    for cls in ('lg', 'med', 'sm'):
+        if da is None:
+            sel = network.index if cls == 'lg' else []
+        elif cls == 'lg':
+            sel = network.index[da >= params['lg_da']]
+        elif cls == 'med':
+            sel = network.index[(da < params['lg_da']) & (da >= params['med_da'])]
+        else:
+            sel = network.index[da < params['med_da']]
+        if len(sel) == 0:
+            continue
+        bufs = network.loc[sel].geometry.buffer(params[cls + '_buf'], cap_style=1)
+        res = max(params.get(cls + '_res') or dem_res, dem_res)
+        total += float(np.sum(model.predict(bufs.area.values / (res * res), shapely.get_num_coordinates(bufs.values))))
+
+    return total
+
+
+def _init_worker():
+    # import the VBET stack once per worker, not once per job
+    import classVBET  # noqa: F401
+
+
+def run_job(job):
+    """
+    Runs one job of a batch in the calling process
+    :param job: job dict from load_manifest
+    :return: summary row dict
+    """
+    import classVBET
+
+    params = job['params']
+    row = {'name': job['name'], 'dem': params['dem'], 'network': params['network'], 'out': params['out'],
+           'worker': os.getpid(), 'error': ''}
+    start = time.perf_counter()
+    try:
+        vb = classVBET.VBET(**params)
+        if params.get('da_field') is None:
+            vb.add_da()
+        vb.valley_bottom()
+        row['status'] = 'ok'
+    except Exception as e:
+        row['status'] = 'failed'
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+        print(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+    row['seconds'] = round(time.perf_counter() - start, 2)
+
+    return row
+
+
+def _run_indexed(task):
+    k, job = task
+
+    return k, run_job(job)
+
+
+def run_batch(jobs, workers=1, store_root=None):
+    """
+    Runs the jobs of a batch in one pool of long lived worker processes, so the VBET stack is imported once per
+    worker rather than once per job. Jobs are started longest estimated processing time first (see estimate_job) so
+    no worker is left with a long job at the end, and relative elevation rasters are cached in one folder for all
+    jobs. With store_root every DEM is decoded once into a memory mapped raster store that all workers attach to.
+    :param jobs: list of job dicts from load_manifest
+    :param workers: number of worker processes (1 runs the jobs in this process)
+    :param store_root: optional folder for the raster stores of the batch's DEMs
+    :return: list of summary row dicts in manifest order
+    """
+    jobs = [dict(job, params=dict(job['params'])) for job in jobs]
+    costs = []
+    for job in jobs:
+        try:
+            costs.append(estimate_job(job['params']))
+        except Exception:
+            costs.append(0.)  # unreadable inputs, the job reports the error when it runs
+    # longest first, jobs sharing a DEM next to each other among equal estimates
+    order = sorted(range(len(jobs)), key=lambda k: (-costs[k], str(jobs[k]['params']['dem'])))
+    print('Estimated segment time {:.0f} s, about {:.0f} s on {} workers'.format(sum(costs),
+                                                                             lpt_makespan(costs, workers), workers))
+
+    if store_root is not None:
+        # decode every input once up front, the workers only attach to the stores
+        from processing.raster_store import build, build_slope
+        built = set()
+        for job in jobs:
+            params = job['params']
+            if 'raster_store' in params or not os.path.isfile(str(params['dem'])):
+                continue
+            params['raster_store'] = store_for(params, store_root)
+            if (params['raster_store'], params.get('stored_slope', False)) in built:
+                continue
+            print('Decoding {} into the batch raster store'.format(params['dem']))
+            build(params['dem'], params['raster_store'], 'dem')
+            if params.get('dr_area') is not None:
+                build(params['dr_area'], params['raster_store'], 'drainage_area')
+            if params.get('stored_slope', False):
+                build_slope(params['raster_store'])
+            built.add((params['raster_store'], params.get('stored_slope', False)))
+
+    for job in jobs:
+        # the scratch folders of the jobs are made one level below a shared root
+        os.makedirs(os.path.dirname(job['params']['scratch']), exist_ok=True)
+        os.makedirs(os.path.dirname(job['params']['out']) or '.', exist_ok=True)
+
+    rows = [None] * len(jobs)
+    start = time.perf_counter()
+
+    def finished(k):
+        # remaining time from the estimated cost of the jobs left, scaled by the rate seen so far
+        done = [j for j in range(len(jobs)) if rows[j] is not None]
+        done_cost = sum(costs[j] for j in done)
+        left = sum(costs) - done_cost
+        eta = left * (time.perf_counter() - start) / done_cost if done_cost > 0 else 0
+        print('Job {} {} in {:.1f} s ({} of {} done, about {:.0f} s left)'.format(
+            rows[k]['name'], rows[k]['status'], rows[k]['seconds'], len(done), len(jobs), eta))
+
+    if workers <= 1:
+        _init_worker()
+        for k in order:
+            rows[k] = run_job(jobs[k])
+            finished(k)
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+            for k, row in pool.imap_unordered(_run_indexed, [(k, jobs[k]) for k in order], chunksize=1):
+                rows[k] = row
+                finished(k)
+
+    return rows
+
+
+def write_summary(rows, path):
+    """
+    Writes the summary table of a batch as CSV
+    :param rows: summary rows from run_batch
+    :param path: output CSV path
+    :return:
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return
+
+
+def format_summary(rows):
+    """
+    :param rows: summary rows from run_batch
+    :return: the summary as an aligned text table
+    """
+    widths = {'name': max([4] + [len(str(r['name'])) for r in rows])}
+    lines = ['{:<{w}} {:>8} {:>9} {:>8}  {}'.format('name', 'status', 'seconds', 'worker', 'error', w=widths['name'])]
+    for r in rows:
+        lines.append('{:<{w}} {:>8} {:>9.2f} {:>8}  {}'.format(r['name'], r['status'], r['seconds'], r['worker'],
+                                                              r['error'], w=widths['name']))
+    ok = sum(r['status'] == 'ok' for r in rows)
+    lines.append('{} of {} jobs succeeded, {:.1f} s of job time'.format(ok, len(rows), sum(r['seconds'] for r in rows)))
+
+    return '\n'.join(lines)
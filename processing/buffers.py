@@ -0,0 +1,64 @@
+import sys
+
+import numpy as np
+
+
+class BufferPool:
+    """
+    Reuses preallocated arrays across segments. Each named buffer grows to the largest window seen so far and
+    smaller windows get a view of its leading elements, so steady state processing allocates no new full size arrays.
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def array(self, name, shape, dtype):
+        """
+        :param name: buffer name, one per array that must be alive at the same time
+        :param shape: shape of the array
+        :param dtype: numpy dtype of the array
+        :return: an uninitialised array view of the named buffer
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.size < size:
+            buf = np.empty(size, dtype=dtype)
+            self._buffers[name] = buf
+
+        return buf[:size].reshape(shape)
+
+    def nbytes(self):
+        return sum(b.nbytes for b in self._buffers.values())
+
+
+def pack_mask(mask):
+    """
+    Bit-packs a boolean array (8 cells per byte)
+    :param mask: boolean array
+    :return: tuple of (packed uint8 array, original shape)
+    """
+    return np.packbits(mask, axis=None), mask.shape
+
+
+def unpack_mask(packed, shape):
+    """
+    Restores a boolean array packed with pack_mask
+    :param packed: packed uint8 array
+    :param shape: original shape
+    :return: boolean array
+    """
+    return np.unpackbits(packed, count=int(np.prod(shape))).reshape(shape).view(bool)
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident memory of the process in MB, or None where the resource module is missing (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1e6 if sys.platform == 'darwin' else 1e3)
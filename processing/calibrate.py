@@ -0,0 +1,234 @@
+import hashlib
+import importlib
+import itertools
+import json
+import math
+import os
+
+import numpy as np
+import shapely
+
+from processing.batch import run_job
+from processing.vector_io import read_vector, write_vector
+
+BUFFERS = ('lg_buf', 'med_buf', 'sm_buf')
+
+
+def grid_candidates(grid):
+    """
+    :param grid: dict of parameter name: list of values
+    :return: list of dicts, one per combination of values
+    """
+    keys = list(grid.keys())
+
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+
+def param_key(values):
+    """
+    :param values: dict of parameter values
+    :return: string identifying the parameter tuple
+    """
+    return json.dumps(sorted(values.items()), default=str)
+
+
+def rung_sizes(n, rungs, eta, min_segments):
+    """
+    Number of segments each rung of the search is evaluated on, growing by eta per rung up to all n segments
+    :param n: number of segments near the template
+    :param rungs: number of rungs
+    :param eta: growth of the segment count (and reduction of the candidates) per rung
+    :param min_segments: smallest number of segments a rung is evaluated on
+    :return: increasing list of segment counts ending with n
+    """
+    sizes = [max(min(min_segments, n), math.ceil(n / eta ** (rungs - 1 - r))) for r in range(rungs)]
+
+    return sorted(set(sizes))
+
+
+def segments_near(network, template, distance, seed=0, classes=None):
+    """
+    Finds the segments within distance of the template, in a fixed random order: the first k segments of the order
+    are the subset a rung with k segments is evaluated on, so the subsets are nested and spread over the template.
+    With classes the order takes a segment of each class in turn, so even a small subset has segments that the
+    large, medium and small parameters apply to.
+    :param network: GeoDataFrame of network segments
+    :param template: template polygon
+    :param distance: search distance (the largest segment buffer)
+    :param seed: seed of the order
+    :param classes: optional Series of the size class of each segment
+    :return: list of index labels
+    """
+    near = network.index[network.geometry.distance(template) <= distance]
+    rng = np.random.default_rng(seed)
+    if classes is None:
+        return [near[k] for k in rng.permutation(len(near))]
+
+    groups = []
+    for _, labels in classes.loc[near].groupby(classes.loc[near]):
+        groups.append([labels.index[k] for k in rng.permutation(len(labels))])
+
+    return [group[k] for k in range(max(len(g) for g in groups)) for group in groups if k < len(group)]
+
+
+def size_classes(network, base):
+    """
+    :param network: GeoDataFrame of network segments
+    :param base: VBET parameters
+    :return: Series of 'large', 'medium' or 'small' per segment by drainage area, None without a drainage area field
+    """
+    field = base.get('da_field')
+    if field is None or field not in network.columns:
+        return None
+
+    return network[field].map(lambda da: 'large' if da >= base['lg_da'] else 'medium' if da >= base['med_da']
+                              else 'small')
+
+
+def network_avlen(base, work_dir):
+    """
+    Average segment length of the full network as a VBET run on it computes it (the length of the network over the
+    number of segments left after cleaning). Candidates run on subsets of the network are given this value, so their
+    hole filling threshold is the one of the run being calibrated rather than one that changes with the subset.
+    :param base: dict of VBET parameters
+    :param work_dir: folder for the metadata of the cleaning run
+    :return: average segment length
+    """
+    import classVBET
+    scratch = os.path.join(work_dir, 'scratch', 'network_full')
+    os.makedirs(scratch, exist_ok=True)
+    vb = classVBET.VBET(**dict(base, out=os.path.join(work_dir, 'network_full.gpkg'), scratch=scratch))
+    if vb.da_field is None:
+        vb.add_da()
+    vb.clean_network()
+    vb.md.close()
+
+    return int(vb.seglengths / len(vb.network))
+
+
+class ScoreCache:
+    """
+    Scores of the candidates already evaluated, keyed by the calibration setup, the parameter tuple and the number of
+    segments, so an interrupted or repeated search does not run them again
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.scores = json.load(f)
+        except (OSError, ValueError):
+            self.scores = {}
+
+    def get(self, key):
+        return self.scores.get(key)
+
+    def put(self, key, record):
+        self.scores[key] = record
+        tmp = self.path + '.tmp{}'.format(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.scores, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def score_region(out, template, region, compute_iou):
+    """
+    :param out: valley bottom output
+    :param template: template polygon
+    :param region: area the score is restricted to
+    :param compute_iou: IoU function of 2_quantify_poly_similarity
+    :return: intersection over union of the valley bottom and the template within the region
+    """
+    vb = shapely.union_all(read_vector(out).geometry.values)
+
+    return compute_iou(vb.intersection(region), template.intersection(region))
+
+
+def successive_halving(base, grid, template_path, work_dir, rungs=3, eta=3, min_segments=3, seed=0,
+                       cache_path=None):
+    """
+    Searches a parameter grid by successive halving. All candidates are first run on a few network segments near the
+    template and scored against it (intersection over union within the buffers of those segments); only the best
+    1/eta of them go on to the next rung, which runs on eta times as many segments, until the last rung runs the
+    survivors on every segment near the template. Scores are cached by parameter tuple and segment count.
+    :param base: dict of VBET parameters shared by all candidates
+    :param grid: dict of parameter name: list of values to search
+    :param template_path: template valley bottom polygon
+    :param work_dir: folder for the segment subsets, outputs, scratch and the score cache
+    :param rungs: number of rungs
+    :param eta: reduction of the candidates (and growth of the segments) per rung
+    :param min_segments: smallest number of segments a rung is evaluated on
+    :param seed: seed of the segment order
+    :param cache_path: score cache (default: calibration_cache.json in work_dir)
+    :return: dict with the best parameters, their score and output, the ranking of each rung and run counts
+    """
+    similarity = importlib.import_module('2_quantify_poly_similarity')
+    template = similarity.load_polygon(template_path)
+    for folder in (work_dir, os.path.join(work_dir, 'scratch')):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+    cache = ScoreCache(cache_path or os.path.join(work_dir, 'calibration_cache.json'))
+
+    pool = grid_candidates(grid)
+    network = read_vector(base['network'])
+    if base.get('avlen') is None:
+        base = dict(base, avlen=network_avlen(base, work_dir))
+    max_buf = max(max([c.get(b, base.get(b, 0)) for c in pool for b in BUFFERS]), 0)
+    order = segments_near(network, template, max_buf, seed, size_classes(network, base))
+    if len(order) == 0:
+        raise Exception('No network segments within {} m of the template {}'.format(max_buf, template_path))
+    sizes = rung_sizes(len(order), rungs, eta, min_segments)
+
+    # everything a score depends on apart from the candidate and the segment count
+    fixed = {k: v for k, v in base.items() if k not in ('out', 'scratch', 'rem_cache', 'cost_model')}
+    setup = hashlib.sha1(json.dumps([fixed, os.path.abspath(template_path), seed], sort_keys=True,
+                                    default=str).encode()).hexdigest()[:12]
+
+    history = []
+    runs = 0
+    for r, n in enumerate(sizes):
+        subset = network.loc[order[:n]]
+        subset_path = os.path.join(work_dir, 'network_{}_{}.gpkg'.format(setup, n))
+        if not os.path.isfile(subset_path):
+            write_vector(subset, subset_path)
+        region = shapely.union_all(subset.geometry.buffer(max_buf).values)
+        print('\nRung {} of {}: {} candidates on {} of {} segments'.format(r + 1, len(sizes), len(pool), n,
+                                                                           len(order)))
+
+        scored = []
+        for values in pool:
+            key = '{}|{}|{}'.format(setup, param_key(values), n)
+            record = cache.get(key)
+            if record is None:
+                tag = hashlib.sha1(key.encode()).hexdigest()[:10]
+                params = dict(base)
+                params.update(values)
+                params.update({'network': subset_path, 'out': os.path.join(work_dir, 'vb_{}.gpkg'.format(tag)),
+                               'scratch': os.path.join(work_dir, 'scratch', tag)})
+                params.setdefault('rem_cache', os.path.join(work_dir, 'rem'))
+                row = run_job({'name': tag, 'params': params})
+                runs += 1
+                iou = None
+                if row['status'] == 'ok':
+                    iou = score_region(params['out'], template, region, similarity.compute_iou)
+                record = {'params': values, 'segments': n, 'iou': iou, 'seconds': row['seconds'],
+                          'out': params['out'], 'error': row['error']}
+                cache.put(key, record)
+            scored.append(record)
+            print('  IoU {}  {}'.format('failed' if record['iou'] is None else '{:.4f}'.format(record['iou']),
+                                         param_key(values)))
+
+        # failed candidates rank last; candidates tied with the last one kept go on as well
+        scored.sort(key=lambda rec: -1 if rec['iou'] is None else rec['iou'], reverse=True)
+        history.append({'segments': n, 'ranking': scored})
+        if r < len(sizes) - 1:
+            keep = max(1, math.ceil(len(pool) / eta))
+            cutoff = scored[keep - 1]['iou']
+            pool = [rec['params'] for k, rec in enumerate(scored)
+                    if k < keep or (cutoff is not None and rec['iou'] == cutoff)]
+
+    best = history[-1]['ranking'][0]
+    if best['iou'] is None:
+        raise Exception('Every candidate failed on the last rung, see {}'.format(cache.path))
+
+    return {'params': best['params'], 'iou': best['iou'], 'out': best['out'], 'rungs': history, 'runs': runs,
+            'evaluations': sum(len(h['ranking']) for h in history), 'grid': len(grid_candidates(grid))}
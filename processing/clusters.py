@@ -0,0 +1,126 @@
+import threading
+
+from rasterio.windows import Window, union
+
+
+def window_size(window):
+    return int(window.height) * int(window.width)
+
+
+def plan_clusters(windows, max_cells):
+    """
+    Groups the windows of consecutive segments into clusters read as one block. A window joins the cluster before it
+    while the union of their windows holds no more cells than the windows read one by one (so the block never
+    decodes more than the separate reads would) and no more than max_cells.
+    :param windows: list of (key, Window) in the order the windows are read
+    :param max_cells: largest number of cells in a cluster block
+    :return: list of (union window, list of keys)
+    """
+    clusters = []
+    block, keys, cells = None, [], 0
+    for key, window in windows:
+        if block is not None:
+            merged = union(block, window)
+            if window_size(merged) <= min(max_cells, cells + window_size(window)):
+                block, cells = merged, cells + window_size(window)
+                keys.append(key)
+                continue
+            clusters.append((block, keys))
+        block, keys, cells = window, [key], window_size(window)
+    if block is not None:
+        clusters.append((block, keys))
+
+    return clusters
+
+
+class ClusterReader:
+    """
+    Serves the DEM windows of clustered segments from one block read per cluster. The block is read by the first
+    member that needs it and dropped once every member has been served, so with clusters of consecutive segments
+    only the blocks around the segments in flight are held. A member that fails before its read is released instead,
+    so its block is still dropped. Counts the bytes decoded against the bytes the members' own reads would have
+    decoded.
+    """
+    def __init__(self, clusters, itemsize):
+        """
+        :param clusters: list of (union window, list of keys) from plan_clusters
+        :param itemsize: bytes per DEM cell
+        """
+        self.itemsize = itemsize
+        self.blocks = {}
+        self.windows = [w for w, _ in clusters]
+        self.sizes = [len(keys) for _, keys in clusters]
+        self.remaining = list(self.sizes)
+        self.served = set()  # keys served from their block or released
+        self.locks = [threading.Lock() for _ in clusters]
+        self.cluster_of = {key: k for k, (_, keys) in enumerate(clusters) for key in keys}
+        self.bytes_read = 0
+        self.bytes_single = 0
+        self._lock = threading.Lock()
+
+    def read(self, key, window, read):
+        """
+        :param key: key of the segment
+        :param window: window of the segment on the DEM grid
+        :param read: function reading a window of the DEM (for the calling thread)
+        :return: 2-D array of the window
+        """
+        k = self.cluster_of.get(key)
+        height, width = int(window.height), int(window.width)
+        inside = False
+        if k is not None:
+            outer = self.windows[k]
+            r0, c0 = int(window.row_off - outer.row_off), int(window.col_off - outer.col_off)
+            inside = r0 >= 0 and c0 >= 0 and r0 + height <= outer.height and c0 + width <= outer.width
+            inside = inside and key not in self.served
+        if not inside:
+            # not a clustered segment, a window the plan did not cover or a segment read again
+            self.release(key)
+            arr = read(window)
+            with self._lock:
+                self.bytes_read += arr.nbytes
+                self.bytes_single += arr.nbytes
+            return arr
+
+        with self.locks[k]:
+            block = self.blocks.get(k)
+            if block is None:
+                block = read(Window(outer.col_off, outer.row_off, outer.width, outer.height))
+                self.blocks[k] = block
+                with self._lock:
+                    self.bytes_read += block.nbytes
+            self._serve(k, key)
+        with self._lock:
+            self.bytes_single += height * width * self.itemsize
+
+        return block[r0:r0 + height, c0:c0 + width].copy()
+
+    def release(self, key):
+        """
+        Counts a segment as served without reading its window from the block (e.g. it failed before its read), so the
+        block of its cluster is dropped once the other members are served. Only the first release or read of a
+        segment counts.
+        :param key: key of the segment
+        """
+        k = self.cluster_of.get(key)
+        if k is None:
+            return
+        with self.locks[k]:
+            self._serve(k, key)
+
+    def _serve(self, k, key):
+        # called holding the lock of cluster k
+        if key in self.served:
+            return
+        self.served.add(key)
+        self.remaining[k] -= 1
+        if self.remaining[k] <= 0:
+            self.blocks.pop(k, None)
+
+    def report(self):
+        saved = 1 - self.bytes_read / self.bytes_single if self.bytes_single > 0 else 0
+        clusters = sum(1 for n in self.sizes if n > 1)
+
+        return 'Clustered reads: {} segments in {} multi-segment clusters, {:.1f} MB decoded instead of {:.1f} MB ' \
+               '({:.0%} less)'.format(len(self.cluster_of), clusters, self.bytes_read / 1e6, self.bytes_single / 1e6,
+                                      saved)
@@ -0,0 +1,202 @@
+import contextlib
+import heapq
+import json
+import os
+import time
+
+import numpy as np
+import shapely
+
+# uncalibrated coefficients (seconds, seconds per buffer cell, seconds per buffer vertex); only their ratios matter
+# until timings have been recorded, the progress bar rescales them by the observed rate
+DEFAULT_COEF = [0.01, 2e-6, 1e-5]
+
+# progress bar advanced by estimated cost: the percentage and remaining time are weighted by cost, not item count
+COST_BAR = '{l_bar}{bar}| [{elapsed}<{remaining}]'
+
+
+def profile_name(short_circuit=False, low_memory=False, detrend_mode='segment', output_mode='vector'):
+    """
+    :return: name of the set of timings for a combination of VBET processing options
+    """
+    compute = 'short_circuit' if short_circuit else 'low_memory' if low_memory else 'default'
+
+    return '{}_{}_{}'.format(compute, detrend_mode, output_mode)
+
+
+def segment_features(buf, res):
+    """
+    :param buf: segment buffer polygon
+    :param res: processing cell size
+    :return: tuple of (number of cells in the buffer, number of buffer vertices)
+    """
+    return buf.area / (res * res), int(shapely.get_num_coordinates(buf))
+
+
+@contextlib.contextmanager
+def file_lock(path, timeout=60, stale=30):
+    """
+    Holds an exclusive lock file (created with O_EXCL, so it also works between nodes on a shared file system) while
+    the block runs
+    :param path: lock file
+    :param timeout: seconds to wait for the lock before giving up
+    :param stale: age in seconds after which a lock is taken to be left by a process that died while holding it
+    """
+    start = time.time()
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(path).st_mtime > stale:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue  # released meanwhile
+            if time.time() - start > timeout:
+                raise TimeoutError('Timed out waiting for lock {}'.format(path))
+            time.sleep(0.05)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class CostModel:
+    """
+    Estimates the time to process a segment as a linear function of the number of cells in its buffer and the
+    number of vertices of the buffer polygon. The coefficients are fitted (non negative least squares) to segment
+    timings recorded by earlier runs. Timings are kept per profile, as the cost of a cell depends on the processing
+    mode of the run.
+    """
+    def __init__(self, path=None, profile='default', max_samples=5000):
+        """
+        :param path: JSON file of recorded timings and fitted coefficients (None for an uncalibrated model)
+        :param profile: name of the set of timings to use
+        :param max_samples: number of most recent timings kept per profile
+        """
+        self.path = path
+        self.profile = profile
+        self.max_samples = max_samples
+        self.coef = list(DEFAULT_COEF)
+        self.samples = []
+        self.new_samples = []
+        if path is not None and os.path.isfile(path):
+            entry = self._read().get(profile)
+            if entry is not None:
+                self.coef = entry['coef']
+                self.samples = entry['samples']
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @property
+    def calibrated(self):
+        return len(self.samples) >= 3
+
+    def predict(self, pixels, vertices):
+        """
+        :return: estimated seconds
+        """
+        return self.coef[0] + self.coef[1] * pixels + self.coef[2] * vertices
+
+    def record(self, pixels, vertices, seconds):
+        self.new_samples.append([pixels, vertices, seconds])
+
+    def fit(self):
+        """
+        Fits the coefficients to the recorded timings (kept unchanged with fewer than 3 timings)
+        :return:
+        """
+        from scipy.optimize import nnls
+
+        samples = (self.samples + self.new_samples)[-self.max_samples:]
+        if len(samples) < 3:
+            return
+        arr = np.array(samples, dtype=np.float64)
+        a = np.column_stack([np.ones(len(arr)), arr[:, 0], arr[:, 1]])
+        # scale the columns so the fit is well conditioned
+        scale = np.maximum(np.abs(a).max(axis=0), 1e-12)
+        coef, _ = nnls(a / scale, arr[:, 2])
+        self.coef = list(coef / scale)
+
+        return
+
+    def error(self):
+        """
+        :return: median relative error of the predictions for the recorded timings
+        """
+        samples = self.samples + self.new_samples
+        if len(samples) == 0:
+            return None
+        arr = np.array(samples, dtype=np.float64)
+        pred = self.predict(arr[:, 0], arr[:, 1])
+
+        return float(np.median(np.abs(pred - arr[:, 2]) / np.maximum(arr[:, 2], 1e-6)))
+
+    def save(self):
+        """
+        Adds the timings recorded since loading to the file (keeping those saved meanwhile by other runs), refits the
+        coefficients and writes the file, holding a lock file so that concurrent runs do not lose timings
+        :return:
+        """
+        if self.path is None:
+            return
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        with file_lock(self.path + '.lock'):
+            models = self._read()
+            entry = models.get(self.profile, {'samples': []})
+            self.samples = (entry['samples'] + self.new_samples)[-self.max_samples:]
+            self.new_samples = []
+            self.fit()
+            models[self.profile] = {'coef': self.coef, 'samples': self.samples}
+
+            tmp = self.path + '.tmp{}'.format(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(models, f)
+            os.replace(tmp, self.path)
+
+        return
+
+    def report(self):
+        err = self.error()
+        return ('Cost model ({}): {:.3g} s + {:.3g} s per 1000 cells + {:.3g} s per 100 vertices, fitted to {} segment '
+                'timings{}'.format(self.profile, self.coef[0], self.coef[1] * 1000, self.coef[2] * 100,
+                                   len(self.samples) + len(self.new_samples),
+                                   '' if err is None else ', median error {:.0%}'.format(err)))
+
+
+def lpt_order(costs):
+    """
+    Longest processing time first: the positions of the costs from the largest to the smallest
+    :param costs: list of estimated costs
+    :return: list of positions
+    """
+    return sorted(range(len(costs)), key=lambda k: -costs[k])
+
+
+def lpt_makespan(costs, workers):
+    """
+    Estimated wall time of running jobs in longest processing time first order on a number of workers, each worker
+    taking the next job when it finishes one
+    :param costs: list of estimated costs
+    :param workers: number of workers
+    :return: estimated wall time
+    """
+    loads = [0.] * max(int(workers), 1)
+    for k in lpt_order(costs):
+        heapq.heappush(loads, heapq.heappop(loads) + costs[k])
+
+    return max(loads)
@@ -0,0 +1,97 @@
+import numpy as np
+import rasterio
+from shapely.geometry import box
+from shapely.ops import unary_union
+import hashlib
+import os
+
+from processing.vector_io import read_vector, write_vector
+
+
+def segment_id(geom):
+    """
+    Identifies a network segment by its geometry, which survives the network being renumbered when it is saved
+    :param geom: segment geometry
+    :return: hex digest
+    """
+    return hashlib.sha1(geom.wkb).hexdigest()[:16]
+
+
+def changed_region(old_dem, new_dem):
+    """
+    Compares two DEMs on the same grid block by block
+    :param old_dem: path to the DEM of the earlier run
+    :param new_dem: path to the patched DEM
+    :return: union of the bounds of the changed cells of each block (None if the DEMs are identical)
+    """
+    boxes = []
+    with rasterio.open(old_dem) as old, rasterio.open(new_dem) as new:
+        if old.shape != new.shape or old.transform != new.transform:
+            raise Exception('DEMs must be on the same grid to find the changed region')
+        for _, window in new.block_windows(1):
+            a = old.read(1, window=window)
+            b = new.read(1, window=window)
+            diff = a != b
+            if np.issubdtype(a.dtype, np.floating):
+                diff &= ~(np.isnan(a) & np.isnan(b))
+            if not diff.any():
+                continue
+            # bounding box of the changed cells within the block
+            rows = np.flatnonzero(diff.any(axis=1))
+            cols = np.flatnonzero(diff.any(axis=0))
+            changed = rasterio.windows.Window(window.col_off + cols[0], window.row_off + rows[0],
+                                              cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+            boxes.append(box(*rasterio.windows.bounds(changed, new.transform)))
+
+    if len(boxes) == 0:
+        return None
+
+    return unary_union(boxes)
+
+
+def read_store(path):
+    """
+    Reads the per-segment results saved by an earlier run
+    :param path: path to the segment store
+    :return: GeoDataFrame indexed by segment id with the fp_area and the valley bottom (including the minimum buffer)
+    of each segment
+    """
+    if not os.path.isfile(path):
+        raise Exception('No segment store at {}, run once with segment_store: True first'.format(path))
+
+    return read_vector(path).set_index('seg_id')
+
+
+def write_store(path, store):
+    """
+    :param path: path to the segment store
+    :param store: GeoDataFrame indexed by segment id
+    :return:
+    """
+    write_vector(store.reset_index(), path)
+
+    return
+
+
+def splice(previous, rebuilt, zone):
+    """
+    Replaces the part of a valley bottom inside a zone
+    :param previous: list of valley bottom polygons of the earlier run
+    :param rebuilt: list of valley bottom polygons rebuilt around the zone
+    :param zone: polygon around the changed segments
+    :return: list of polygons; polygons of the earlier run that do not reach into the zone are returned unchanged
+    """
+    kept = []
+    touched = []
+    for poly in previous:
+        if poly.intersects(zone):
+            touched.append(poly.difference(zone))
+        else:
+            kept.append(poly)
+    inside = [poly.intersection(zone) for poly in rebuilt if poly.intersects(zone)]
+
+    merged = unary_union(touched + inside)
+    if merged.is_empty:
+        return kept
+
+    return kept + list(getattr(merged, 'geoms', [merged]))
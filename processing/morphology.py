@@ -0,0 +1,107 @@
+import numpy as np
+
+ENGINES = ('skimage', 'fast')
+
+
+def crop_to_mask(mask, pad):
+    """
+    Finds the bounding box of the True cells of a mask, grown by pad cells and clipped to the array
+    :param mask: 2-D boolean array with at least one True cell
+    :param pad: number of cells to add on each side
+    :return: tuple of (row slice, column slice)
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    r0 = max(rows[0] - pad, 0)
+    r1 = min(rows[-1] + pad + 1, mask.shape[0])
+    c0 = max(cols[0] - pad, 0)
+    c1 = min(cols[-1] + pad + 1, mask.shape[1])
+
+    return slice(r0, r1), slice(c0, c1)
+
+
+def binary_closing(mask, size):
+    """
+    Binary closing with a size x size square, decomposed into 1-D passes. Cells beyond the array edge are background
+    for the dilation and foreground for the erosion, as in skimage.morphology.binary_closing.
+    :param mask: 2-D boolean array
+    :param size: edge length of the square footprint (odd)
+    :return: 2-D boolean array
+    """
+    from scipy import ndimage
+    row = np.ones((1, size), dtype=bool)
+    col = np.ones((size, 1), dtype=bool)
+    out = ndimage.binary_dilation(mask, structure=row)
+    out = ndimage.binary_dilation(out, structure=col)
+    out = ndimage.binary_erosion(out, structure=row, border_value=1)
+    out = ndimage.binary_erosion(out, structure=col, border_value=1)
+
+    return out
+
+
+def fill_small_holes(mask, thresh, crop=None):
+    """
+    Fills background regions smaller than thresh cells (4-connected) with a single labelling pass. A mask cropped
+    from a larger array whose cells outside the crop are all background is labelled with a one cell background margin
+    on the edges that are interior to the larger array. The margin joins the regions that meet outside the crop as
+    the outside does, and the cells of each strip outside the crop (above, below, left and right of it) are counted
+    with the region its margin belongs to and filled with it.
+    :param mask: 2-D boolean array, modified in place
+    :param thresh: hole size (cells) below which should be filled
+    :param crop: optional tuple of (row slice, column slice, larger array) the mask was cropped from; the crop and the
+    filled strips are written into the larger array
+    :return: the filled mask, or the larger array if crop is given
+    """
+    from scipy import ndimage
+    if crop is None:
+        labels, n = ndimage.label(~mask)
+        sizes = np.bincount(labels.ravel(), minlength=n + 1)
+        strips = ()
+    else:
+        rows, cols, out = crop
+        pad = ((int(rows.start > 0), int(rows.stop < out.shape[0])), (int(cols.start > 0), int(cols.stop < out.shape[1])))
+        padded, n = ndimage.label(np.pad(~mask, pad, constant_values=True))
+        labels = padded[pad[0][0]:padded.shape[0] - pad[0][1], pad[1][0]:padded.shape[1] - pad[1][1]]
+        sizes = np.bincount(labels.ravel(), minlength=n + 1)
+        # each strip outside the crop with the label of one of its margin cells
+        strips = ((out[:rows.start, :], padded[0, 0]), (out[rows.stop:, :], padded[-1, 0]),
+                  (out[rows, :cols.start], padded[pad[0][0], 0]), (out[rows, cols.stop:], padded[pad[0][0], -1]))
+        strips = [(strip, label) for strip, label in strips if strip.size > 0]
+        for strip, label in strips:
+            sizes[label] += strip.size
+    if n > 0:
+        small = sizes < thresh
+        small[0] = False  # label 0 is the foreground
+        mask[small[labels]] = True
+        for strip, label in strips:
+            if small[label]:
+                strip[...] = True
+    if crop is None:
+        return mask
+
+    out[rows, cols] = mask
+
+    return out
+
+
+def fill_mask(mask, thresh, closing=7):
+    """
+    Fills in holes and gaps in a boolean array. The work is cropped to the bounding box of the mask (grown enough
+    that the closing sees the same neighbourhood as on the full array), the closing uses a decomposed footprint and
+    small holes are removed once after the closing. Holes that were small before the closing can only shrink or split
+    when closing, so the hole removal before the closing is not needed.
+    :param mask: 2-D boolean array
+    :param thresh: hole size (cells) below which should be filled
+    :param closing: edge length of the square closing footprint
+    :return: 2-D boolean array with holes filled
+    """
+    out = np.zeros(mask.shape, dtype=bool)
+    if not mask.any():
+        out[...] = mask.size < thresh  # the whole array is one hole
+        return out
+
+    rows, cols = crop_to_mask(mask, closing)
+    closed = binary_closing(mask[rows, cols], closing)
+    fill_small_holes(closed, thresh, (rows, cols, out))
+
+    return out
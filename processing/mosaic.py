@@ -0,0 +1,168 @@
+import numpy as np
+import rasterio
+from rasterio.features import rasterize
+from rasterio.enums import Resampling
+from rasterio.transform import array_bounds
+from rasterio.warp import reproject
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import box
+from shapely.strtree import STRtree
+import os
+
+from processing.polygonize import polygonize
+
+
+class ValleyBottomMosaic:
+    """
+    A global uint8 valley bottom raster aligned to the DEM grid. Segment masks are ORed into it as they finish, and
+    it is polygonized once at the end instead of polygonizing every segment and unioning the polygons. The cells
+    are held in a memory mapped file in the scratch folder so the mosaic does not have to fit in memory.
+    """
+    def __init__(self, dem, scratch, block_rows=1024):
+        """
+        :param dem: path to the DEM the mosaic is aligned to
+        :param scratch: folder for the memory mapped cells
+        :param block_rows: number of rows processed at once when rasterizing, polygonizing and saving
+        """
+        with rasterio.open(dem) as src:
+            self.transform = src.transform
+            self.crs = src.crs
+            self.height = src.height
+            self.width = src.width
+        self.block_rows = block_rows
+        self.cell_area = abs(self.transform[0] * self.transform[4])
+
+        self.path = os.path.join(scratch, 'vb_mosaic.u8')
+        self.data = np.memmap(self.path, dtype=np.uint8, mode='w+', shape=(self.height, self.width))
+
+    def window_offsets(self, transform):
+        """
+        :param transform: affine transform of a window on the DEM grid
+        :return: tuple of (row offset, column offset) of the window in the mosaic
+        """
+        col_off = int(round((transform[2] - self.transform[2]) / self.transform[0]))
+        row_off = int(round((transform[5] - self.transform[5]) / self.transform[4]))
+
+        return row_off, col_off
+
+    def burn(self, mask, transform):
+        """
+        ORs a segment mask into the mosaic
+        :param mask: 2-D boolean array on the DEM grid, or on a coarser grid aligned to the DEM
+        :param transform: affine transform of the mask
+        :return: number of DEM cells in the mask
+        """
+        return self.burn_parts([(mask, transform)])
+
+    def burn_parts(self, parts):
+        """
+        ORs the masks of one segment (one per sub-window of a split segment) into the mosaic. Every mask is resampled
+        and placed before any is burned, so a segment that fails leaves the mosaic as it was (a burn cannot be undone,
+        since the cells may also belong to other segments).
+        :param parts: list of (2-D boolean array, affine transform), as for burn
+        :return: number of DEM cells in the masks
+        """
+        placed = []
+        cells = 0
+        for mask, transform in parts:
+            if transform[0] != self.transform[0]:
+                mask, transform = self.to_dem_grid(mask, transform)
+            r0, c0 = self.window_offsets(transform)
+            r1 = min(r0 + mask.shape[0], self.height)
+            c1 = min(c0 + mask.shape[1], self.width)
+            sub = mask[max(-r0, 0):r1 - r0, max(-c0, 0):c1 - c0]
+            placed.append((slice(max(r0, 0), r1), slice(max(c0, 0), c1), sub))
+            cells += int(np.count_nonzero(mask))
+        for rows, cols, sub in placed:
+            self.data[rows, cols] |= sub
+
+        return cells
+
+    def to_dem_grid(self, mask, transform):
+        """
+        Resamples a mask processed at a coarser resolution back to DEM cells (nearest neighbour)
+        :param mask: 2-D boolean array
+        :param transform: affine transform of the mask
+        :return: tuple of (2-D boolean array on the DEM grid, affine transform of the array)
+        """
+        bounds = array_bounds(mask.shape[0], mask.shape[1], transform)
+        window = from_bounds(*bounds, transform=self.transform).round_offsets().round_lengths()
+        dem_transform = rasterio.windows.transform(window, self.transform)
+        out = np.zeros((window.height, window.width), dtype=np.uint8)
+        reproject(mask.astype(np.uint8), out, src_transform=transform, src_crs=self.crs, dst_transform=dem_transform,
+                  dst_crs=self.crs, resampling=Resampling.nearest)
+
+        return out.astype(bool), dem_transform
+
+    def blocks(self):
+        for r0 in range(0, self.height, self.block_rows):
+            r1 = min(r0 + self.block_rows, self.height)
+            yield r0, r1, rasterio.windows.transform(Window(0, r0, self.width, r1 - r0), self.transform)
+
+    def burn_shapes(self, geoms):
+        """
+        Rasterizes polygons (e.g. the minimum buffers) into the mosaic one block at a time
+        :param geoms: list of shapely polygons
+        :return:
+        """
+        if len(geoms) == 0:
+            return
+        tree = STRtree(geoms)
+        for r0, r1, block_transform in self.blocks():
+            bounds = rasterio.windows.bounds(Window(0, r0, self.width, r1 - r0), self.transform)
+            hits = tree.query(box(*bounds))
+            if len(hits) == 0:
+                continue
+            block = rasterize([geoms[k] for k in hits], out_shape=(r1 - r0, self.width), transform=block_transform,
+                              fill=0, default_value=1, dtype=np.uint8)
+            self.data[r0:r1, :] |= block
+
+        return
+
+    def burn_raster(self, path):
+        """
+        ORs the valley bottom cells of a raster saved by an earlier run on the same DEM into the mosaic
+        :param path: path to a valley bottom GeoTIFF written by save
+        :return:
+        """
+        with rasterio.open(path) as src:
+            for r0, r1, _ in self.blocks():
+                self.data[r0:r1, :] |= src.read(1, window=Window(0, r0, self.width, r1 - r0)) == 1
+
+        return
+
+    def polygonize(self):
+        """
+        Converts the valley bottom cells to polygons one block at a time. Polygons from neighbouring blocks share
+        edges and are joined when the valley bottom is dissolved.
+        :return: list of shapely polygons
+        """
+        polys = []
+        for r0, r1, block_transform in self.blocks():
+            block = np.asarray(self.data[r0:r1, :])
+            if not block.any():
+                continue
+            polys.extend(polygonize(block == 1, block_transform)[0])
+
+        return polys
+
+    def save(self, path):
+        """
+        Saves the mosaic as a GeoTIFF valley bottom raster (1 valley bottom, 0 elsewhere)
+        :param path: output GeoTIFF path
+        :return:
+        """
+        profile = {'driver': 'GTiff', 'height': self.height, 'width': self.width, 'count': 1, 'dtype': 'uint8',
+                   'crs': self.crs, 'transform': self.transform, 'nodata': 0, 'compress': 'deflate',
+                   'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+        with rasterio.open(path, 'w', **profile) as dst:
+            for r0, r1, _ in self.blocks():
+                dst.write(np.asarray(self.data[r0:r1, :]), 1, window=Window(0, r0, self.width, r1 - r0))
+
+        return
+
+    def close(self):
+        self.data.flush()
+        del self.data
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,30 @@
+from itertools import chain
+
+import numpy as np
+import shapely
+from rasterio.features import shapes
+
+
+def polygonize(mask, transform):
+    """
+    Traces the connected True cells of a mask to polygons. The rings traced by rasterio are gathered into one
+    coordinate array and built into shapely polygons in two vectorized calls, instead of a GeoJSON feature and a
+    shapely conversion per polygon. The polygons are the same as shape() of each traced geometry.
+    :param mask: 2-D boolean array
+    :param transform: affine transform of the array
+    :return: tuple of (list of shapely polygons, area of the True cells)
+    """
+    mask = np.ascontiguousarray(mask, dtype=bool)
+    count = int(np.count_nonzero(mask))
+    if count == 0:
+        return [], 0
+
+    polys = [geom['coordinates'] for geom, _ in shapes(mask.view(np.uint8), mask=mask, transform=transform)]
+    rings = list(chain.from_iterable(polys))
+    coords = np.array(list(chain.from_iterable(rings)), dtype=float)
+    ring_index = np.repeat(np.arange(len(rings)), [len(r) for r in rings])
+    poly_index = np.repeat(np.arange(len(polys)), [len(p) for p in polys])
+    # the first ring of each polygon is its shell, the others its holes
+    geoms = shapely.polygons(shapely.linearrings(coords, indices=ring_index), indices=poly_index)
+
+    return list(geoms), count * abs(transform.determinant)
@@ -0,0 +1,195 @@
+import queue
+import threading
+import time
+from tqdm import tqdm
+
+from processing.cost import COST_BAR
+
+_DONE = object()
+
+
+class _Skipped:
+    """
+    Stands in the window queue for an item whose read failed, so the progress bar still advances past it
+    """
+    def __init__(self, item):
+        self.item = item
+
+
+class PrefetchPipeline:
+    """
+    Overlaps reading, computing and writing of segment windows. Reader threads read upcoming windows into a bounded
+    queue while the calling thread computes the current one, and a writer thread takes finished results off a second
+    bounded queue. GDAL releases the GIL while reading so reads proceed during computation.
+
+    Stalls are counted on each side of the queues: readers stalled on a full queue mean computation is the
+    bottleneck, computation stalled on an empty queue means reading is the bottleneck, and computation stalled on
+    a full output queue means writing is the bottleneck.
+    """
+    def __init__(self, read, compute, write, depth=2, readers=1, on_error=None, weight=None):
+        """
+        :param read: function taking an item and returning a window (called on reader threads)
+        :param compute: function taking a window and returning a result (called on the calling thread)
+        :param write: function taking a result (called on the writer thread)
+        :param depth: maximum number of windows (and results) held in each queue
+        :param readers: number of reader threads
+        :param on_error: optional function taking (stage name, item/window/result, exception) called when reading,
+        computing or writing one item fails. The pipeline then carries on with the next item instead of stopping.
+        :param weight: optional function taking an item or window and returning its estimated cost. The progress bar
+        then advances by cost rather than by item, so its remaining time is weighted by the cost of what is left.
+        """
+        self.read = read
+        self.compute = compute
+        self.write = write
+        self.on_error = on_error
+        self.weight = weight
+        self.depth = max(int(depth), 1)
+        self.readers = max(int(readers), 1)
+
+        self.stalls = {'read': 0, 'compute': 0, 'write': 0}
+        self.stall_time = {'read': 0., 'compute': 0., 'write': 0.}
+        self.read_error = None
+        self.write_error = None
+        self._lock = threading.Lock()
+
+    def _put(self, q, item, side):
+        try:
+            q.put(item, block=False)
+        except queue.Full:
+            start = time.perf_counter()
+            q.put(item)
+            with self._lock:
+                self.stalls[side] += 1
+                self.stall_time[side] += time.perf_counter() - start
+
+    def _get(self, q, side):
+        try:
+            return q.get(block=False)
+        except queue.Empty:
+            start = time.perf_counter()
+            item = q.get()
+            with self._lock:
+                self.stalls[side] += 1
+                self.stall_time[side] += time.perf_counter() - start
+            return item
+
+    def _reader(self, items, windows, stop):
+        while not stop.is_set():
+            with self._lock:
+                item = next(items, _DONE)
+            if item is _DONE:
+                break
+            try:
+                window = self.read(item)
+            except Exception as e:
+                with self._lock:
+                    if self.on_error is None:
+                        self.read_error = e
+                    else:
+                        self.on_error('read', item, e)
+                if self.on_error is None:
+                    stop.set()
+                    break
+                window = _Skipped(item)
+            self._put(windows, window, 'read')
+        windows.put(_DONE)
+
+    def _writer(self, results):
+        while True:
+            result = results.get()
+            if result is _DONE:
+                break
+            if self.write_error is not None:
+                continue  # drain the queue so computation is not blocked
+            try:
+                self.write(result)
+            except Exception as e:
+                if self.on_error is not None:
+                    with self._lock:
+                        self.on_error('write', result, e)
+                    continue
+                self.write_error = e
+
+    def _progress(self, items):
+        if self.weight is None:
+            return tqdm(total=len(items))
+
+        return tqdm(total=sum(self.weight(item) for item in items), smoothing=0, bar_format=COST_BAR)
+
+    def run(self, items):
+        """
+        Runs the pipeline over all items. Without an on_error function reading stops at the first read error (as in
+        the serial loop) and write errors are raised once the pipeline has drained.
+        :param items: sequence of items passed to the read function
+        :return:
+        """
+        items_iter = iter(items)
+        windows = queue.Queue(maxsize=self.depth)
+        results = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        readers = [threading.Thread(target=self._reader, args=(items_iter, windows, stop), daemon=True)
+                   for _ in range(self.readers)]
+        writer = threading.Thread(target=self._writer, args=(results,), daemon=True)
+        for t in readers:
+            t.start()
+        writer.start()
+
+        finished = 0
+        try:
+            with self._progress(items) as progress:
+                while finished < len(readers):
+                    window = self._get(windows, 'compute')
+                    if window is _DONE:
+                        finished += 1
+                        continue
+                    if isinstance(window, _Skipped):
+                        progress.update(self.weight(window.item) if self.weight is not None else 1)
+                        continue
+                    if self.write_error is not None:
+                        stop.set()
+                        continue
+                    try:
+                        result = self.compute(window)
+                    except Exception as e:
+                        if self.on_error is None:
+                            raise
+                        with self._lock:
+                            self.on_error('compute', window, e)
+                        progress.update(self.weight(window) if self.weight is not None else 1)
+                        continue
+                    self._put(results, result, 'write')
+                    progress.update(self.weight(window) if self.weight is not None else 1)
+        except BaseException:
+            # unblock the reader threads before handing the error back
+            stop.set()
+            while finished < len(readers):
+                if windows.get() is _DONE:
+                    finished += 1
+            raise
+        finally:
+            results.put(_DONE)
+
+        for t in readers:
+            t.join()
+        writer.join()
+
+        if self.read_error is not None:
+            print(f"Error reading or masking DEM: {self.read_error}")
+        if self.write_error is not None:
+            raise self.write_error
+
+        return
+
+    def bottleneck(self):
+        side = max(self.stall_time, key=self.stall_time.get)
+        if self.stall_time[side] == 0:
+            return 'none'
+
+        return {'read': 'compute', 'compute': 'read', 'write': 'write'}[side]
+
+    def report(self):
+        return ('Prefetch pipeline (depth {}, {} reader threads): reader stalls {} ({:.1f} s), compute stalls {} '
+                '({:.1f} s), writer stalls {} ({:.1f} s), bottleneck: {}'.format(
+                    self.depth, self.readers, self.stalls['read'], self.stall_time['read'], self.stalls['compute'],
+                    self.stall_time['compute'], self.stalls['write'], self.stall_time['write'], self.bottleneck()))
@@ -0,0 +1,81 @@
+import numpy as np
+
+from processing.slope import sobel_slope
+
+EMPTY = 'empty'
+SATURATED = 'saturated'
+
+
+def vertex_plane(arr, transform, ndval, seg_geom):
+    """
+    Fits a trend plane to the lowest cell around every other vertex of a segment, read straight from a (coarse)
+    array rather than with zonal statistics
+    :param arr: 2-D DEM array
+    :param transform: affine transform of the array
+    :param ndval: NoData value
+    :param seg_geom: segment geometry
+    :return: plane coefficients (column, row, intercept) in array coordinates, or None if fewer than 3 vertices
+    have data
+    """
+    from scipy import ndimage
+    xs = np.asarray(seg_geom.xy[0][::2])
+    ys = np.asarray(seg_geom.xy[1][::2])
+    cols = ((xs - transform[2]) / transform[0]).astype(int)
+    rows = ((ys - transform[5]) / transform[4]).astype(int)
+    inside = (rows >= 0) & (rows < arr.shape[0]) & (cols >= 0) & (cols < arr.shape[1])
+    rows, cols = rows[inside], cols[inside]
+
+    lowest = np.where(arr == ndval, np.inf, arr)
+    lowest = ndimage.minimum_filter(lowest, size=3, mode='nearest')
+    zs = lowest[rows, cols]
+    ok = np.isfinite(zs)
+    if ok.sum() < 3:
+        return None
+
+    from scipy.linalg import lstsq
+
+    A = np.column_stack([cols[ok], rows[ok], np.ones(ok.sum())])
+
+    return lstsq(A, zs[ok])[0]
+
+
+def classify(arr, transform, ndval, seg_geom, slope_thresh, depth_thresh, margin=0.25, saturation=0.98):
+    """
+    Decides from a coarse DEM window whether a segment's valley bottom is almost certainly empty or almost certainly
+    fills its whole buffer
+    :param arr: 2-D coarse DEM array, NoData outside the segment buffer
+    :param transform: affine transform of the array
+    :param ndval: NoData value
+    :param seg_geom: segment geometry
+    :param slope_thresh: slope threshold of the segment
+    :param depth_thresh: depth threshold of the segment
+    :param margin: relative tolerance applied to both thresholds (loosened to call a segment empty, tightened to call
+    it saturated)
+    :param saturation: fraction of the buffer cells that must pass the tightened thresholds to call it saturated
+    :return: EMPTY, SATURATED or None when the segment needs the full resolution pipeline
+    """
+    valid = arr != ndval
+    if not valid.any():
+        return EMPTY
+
+    fit = vertex_plane(arr, transform, ndval, seg_geom)
+    if fit is None:
+        return None
+    rows, cols = np.indices(arr.shape)
+    rel = arr - (fit[0] * cols + fit[1] * rows + fit[2])
+
+    slope = sobel_slope(arr.astype(np.float32), transform[0], -transform[4], ndval)
+    no_slope = slope == ndval  # neighbourhood reaches NoData, could go either way
+
+    loose = valid & (no_slope | (slope <= slope_thresh * (1 + margin)))
+    loose &= (rel <= depth_thresh * (1 + margin)) & (rel > -depth_thresh * margin)
+    if not loose.any():
+        return EMPTY
+
+    interior = valid & ~no_slope
+    strict = interior & (slope <= slope_thresh * (1 - margin)) & (slope > 0)
+    strict &= (rel <= depth_thresh * (1 - margin)) & (rel > 0)
+    if interior.any() and strict.sum() >= saturation * interior.sum():
+        return SATURATED
+
+    return None
@@ -0,0 +1,172 @@
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.windows import Window
+import argparse
+import json
+import os
+
+from processing.slope import sobel_slope
+from processing.tiles import list_tiles
+
+
+class StoredRaster:
+    """
+    A raster decoded once into a memory mapped .npy file. Every process that attaches to it maps the same file, so the
+    cells are shared through the page cache (memory stays flat as workers are added) and windows are taken by slicing
+    instead of decoding the raster again.
+    """
+    def __init__(self, store_dir, name):
+        """
+        :param store_dir: folder of the store
+        :param name: name of the raster in the store (e.g. 'dem', 'slope', 'drainage_area')
+        """
+        npy, meta = store_paths(store_dir, name)
+        with open(meta) as f:
+            self.meta = json.load(f)
+        self.data = np.load(npy, mmap_mode='r')
+        self.path = npy
+        self.transform = Affine(*self.meta['transform'])
+        self.crs = CRS.from_wkt(self.meta['crs']) if self.meta['crs'] else None
+        self.nodata = self.meta['nodata']
+        self.res = (self.transform[0], -self.transform[4])
+        self.height, self.width = self.data.shape
+        self.dtypes = (str(self.data.dtype),)
+
+    def read(self, window):
+        """
+        :param window: window inside the raster (integer offsets and size)
+        :return: 2-D array, a copy of the window
+        """
+        r0, c0 = int(window.row_off), int(window.col_off)
+
+        return np.array(self.data[r0:r0 + int(window.height), c0:c0 + int(window.width)])
+
+    def nbytes(self):
+        return self.data.nbytes
+
+
+def store_paths(store_dir, name):
+    return os.path.join(store_dir, name + '.npy'), os.path.join(store_dir, name + '.json')
+
+
+def source_stamp(path, sources=None):
+    """
+    :param path: path to the raster
+    :param sources: optional list of the tiles behind a VRT (whose own modification time does not change when a
+    tile is patched)
+    :return: list identifying the version of the raster
+    """
+    stamp = []
+    for f in [path] + list(sources or []):
+        stat = os.stat(f)
+        stamp.extend([os.path.abspath(f), stat.st_size, stat.st_mtime])
+
+    return stamp
+
+
+def is_current(store_dir, name, source, sources=None):
+    """
+    :return: True if the store holds the raster decoded from the current version of source (and of its tiles)
+    """
+    npy, meta = store_paths(store_dir, name)
+    if not os.path.isfile(npy) or not os.path.isfile(meta):
+        return False
+    with open(meta) as f:
+        return json.load(f).get('source') == source_stamp(source, sources)
+
+
+def _write_meta(meta_path, transform, crs, nodata, source):
+    tmp = meta_path + '.tmp{}'.format(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'transform': list(transform)[:6], 'crs': crs.to_wkt() if crs else None, 'nodata': nodata,
+                   'source': source}, f)
+    os.replace(tmp, meta_path)
+
+
+def build(raster, store_dir, name, block_rows=1024, sources=None):
+    """
+    Decodes a raster into the store one block of rows at a time (skipped if the store already holds the current
+    version of the raster). Files are written under temporary names and moved into place, so workers building the
+    same store at the same time do not see partial files.
+    :param raster: path to the raster (band 1 is stored)
+    :param store_dir: folder of the store
+    :param name: name of the raster in the store
+    :param block_rows: number of rows decoded at once
+    :param sources: tiles behind a VRT raster (default: the tiles the VRT lists)
+    :return: StoredRaster
+    """
+    if sources is None and raster.lower().endswith('.vrt'):
+        sources = list_tiles(raster)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+    if not is_current(store_dir, name, raster, sources):
+        npy, meta = store_paths(store_dir, name)
+        tmp = npy + '.tmp{}.npy'.format(os.getpid())
+        with rasterio.open(raster) as src:
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype=src.dtypes[0], shape=(src.height, src.width))
+            for r0 in range(0, src.height, block_rows):
+                rows = min(block_rows, src.height - r0)
+                out[r0:r0 + rows] = src.read(1, window=Window(0, r0, src.width, rows))
+            out.flush()
+            del out
+            os.replace(tmp, npy)
+            _write_meta(meta, src.transform, src.crs, src.nodata, source_stamp(raster, sources))
+
+    return StoredRaster(store_dir, name)
+
+
+def build_slope(store_dir, dem_name='dem', name='slope', block_rows=1024):
+    """
+    Computes the slope (degrees, float32) of a stored DEM into the store one block of rows at a time, each block read
+    with a one row halo so the result is the same as computing it on the whole DEM
+    :param store_dir: folder of the store
+    :param dem_name: name of the stored DEM
+    :param name: name of the slope raster in the store
+    :param block_rows: number of rows computed at once
+    :return: StoredRaster
+    """
+    dem = StoredRaster(store_dir, dem_name)
+    source = dem.meta['source'] + ['slope']
+    npy, meta = store_paths(store_dir, name)
+    if os.path.isfile(meta):
+        with open(meta) as f:
+            if json.load(f).get('source') == source and os.path.isfile(npy):
+                return StoredRaster(store_dir, name)
+
+    nodata = dem.nodata if dem.nodata is not None else -9999.
+    tmp = npy + '.tmp{}.npy'.format(os.getpid())
+    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(dem.height, dem.width))
+    for r0 in range(0, dem.height, block_rows):
+        r1 = min(r0 + block_rows, dem.height)
+        h0, h1 = max(r0 - 1, 0), min(r1 + 1, dem.height)
+        arr = np.array(dem.data[h0:h1], dtype=np.float32)
+        out[r0:r1] = sobel_slope(arr, dem.res[0], dem.res[1], nodata)[r0 - h0:r1 - h0]
+    out.flush()
+    del out
+    os.replace(tmp, npy)
+    _write_meta(meta, dem.transform, dem.crs, nodata, source)
+
+    return StoredRaster(store_dir, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode rasters once into a memory mapped store shared by VBET runs')
+    parser.add_argument('store', help='folder of the store')
+    parser.add_argument('--dem', required=True, help='DEM (or VRT of DEM tiles)')
+    parser.add_argument('--da', help='drainage area raster')
+    parser.add_argument('--slope', action='store_true', help='also store the slope of the DEM')
+    args = parser.parse_args()
+
+    stored = [build(args.dem, args.store, 'dem')]
+    if args.da:
+        stored.append(build(args.da, args.store, 'drainage_area'))
+    if args.slope:
+        stored.append(build_slope(args.store))
+    for s in stored:
+        print('{}: {} x {} cells, {:.1f} MB'.format(s.path, s.height, s.width, s.nbytes() / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import numpy as np
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from shapely.geometry import box
+import hashlib
+import os
+
+REFERENCES = ('plane', 'centerline')
+
+
+def rem_key(dem, network, max_buf, reference, sources=None):
+    """
+    Builds a cache key for a relative elevation raster from everything it depends on
+    :param dem: path to the DEM
+    :param network: GeoDataFrame of network segments
+    :param max_buf: largest segment buffer
+    :param reference: 'plane' or 'centerline'
+    :param sources: optional list of the tiles behind a VRT DEM
+    :return: hex digest
+    """
+    h = hashlib.sha1()
+    stat = os.stat(dem)
+    h.update('{}|{}|{}|{}|{}'.format(os.path.abspath(dem), stat.st_size, stat.st_mtime, max_buf, reference).encode())
+    for tile in sources or []:
+        stat = os.stat(tile)
+        h.update('{}|{}|{}'.format(tile, stat.st_size, stat.st_mtime).encode())
+    for geom in network.geometry:
+        h.update(geom.wkb)
+
+    return h.hexdigest()[:16]
+
+
+def build_rem(dem, network, fits, max_buf, path, reference='plane', tile_size=2048):
+    """
+    Computes one relative elevation raster for the whole DEM. Each cell within max_buf of the network is allocated
+    to its nearest segment (Euclidean allocation) and its elevation is expressed relative to that segment's fitted
+    trend plane, or to the elevation of the nearest centerline cell. Cells further than max_buf from the network are
+    NoData. The raster is computed tile by tile, each tile with a halo of max_buf so the allocation is seamless.
+    :param dem: path to the DEM
+    :param network: GeoDataFrame of network segments
+    :param fits: list of plane coefficients (column, row, intercept) in DEM array coordinates, one per segment in
+    network order (only used for the 'plane' reference)
+    :param max_buf: largest segment buffer
+    :param path: output GeoTIFF path
+    :param reference: 'plane' or 'centerline'
+    :param tile_size: tile edge length in cells
+    :return: path
+    """
+    with rasterio.open(dem) as src:
+        ndval = src.nodata if src.nodata is not None else -9999.
+        profile = {'driver': 'GTiff', 'height': src.height, 'width': src.width, 'count': 1, 'dtype': 'float32',
+                   'crs': src.crs, 'transform': src.transform, 'nodata': ndval, 'tiled': True,
+                   'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate', 'BIGTIFF': 'IF_SAFER'}
+        res_x, res_y = src.res
+        halo = int(np.ceil(max_buf / min(res_x, res_y))) + 1
+        ids = list(range(1, len(network) + 1))
+        coef = np.array(fits, dtype=np.float64) if reference == 'plane' else None
+
+        tmp = path + '.tmp{}'.format(os.getpid())
+        with rasterio.open(tmp, 'w', **profile) as dst:
+            for r0 in range(0, src.height, tile_size):
+                for c0 in range(0, src.width, tile_size):
+                    core = Window(c0, r0, min(tile_size, src.width - c0), min(tile_size, src.height - r0))
+                    er0, ec0 = max(r0 - halo, 0), max(c0 - halo, 0)
+                    er1 = min(r0 + core.height + halo, src.height)
+                    ec1 = min(c0 + core.width + halo, src.width)
+                    ext = Window(ec0, er0, ec1 - ec0, er1 - er0)
+                    ext_transform = rasterio.windows.transform(ext, src.transform)
+
+                    out = np.full((core.height, core.width), ndval, dtype=np.float32)
+                    bounds = rasterio.windows.bounds(ext, src.transform)
+                    near = network.sindex.query(box(*bounds))
+                    if len(near) > 0:
+                        seg_ids = rasterize([(network.geometry.iloc[k], ids[k]) for k in near],
+                                            out_shape=(ext.height, ext.width), transform=ext_transform, fill=0,
+                                            all_touched=True, dtype=np.int32)
+                        if seg_ids.any():
+                            out = _tile_rem(src.read(1, window=ext), seg_ids, ndval, (res_y, res_x), max_buf,
+                                            coef, reference, core, r0 - er0, c0 - ec0)
+                    dst.write(out, 1, window=core)
+    os.replace(tmp, path)
+
+    return path
+
+
+def _tile_rem(elev, seg_ids, ndval, sampling, max_buf, coef, reference, core, dr, dc):
+    """
+    Relative elevations for the core of one tile
+    :param elev: elevations of the tile and its halo
+    :param seg_ids: 1-based network positions of the segments burned into the tile and its halo (0 off network)
+    :param core: window of the tile core in the DEM
+    :param dr: row offset of the core within the tile and its halo
+    :param dc: column offset of the core within the tile and its halo
+    """
+    from scipy import ndimage
+    dist, (rows, cols) = ndimage.distance_transform_edt(seg_ids == 0, sampling=sampling, return_indices=True)
+    rows = rows[dr:dr + core.height, dc:dc + core.width]
+    cols = cols[dr:dr + core.height, dc:dc + core.width]
+    dist = dist[dr:dr + core.height, dc:dc + core.width]
+    z = elev[dr:dr + core.height, dc:dc + core.width].astype(np.float64)
+
+    if reference == 'plane':
+        seg = seg_ids[rows, cols] - 1
+        grid_r, grid_c = np.indices(z.shape)
+        grid_r += core.row_off
+        grid_c += core.col_off
+        trend = coef[seg, 0] * grid_c + coef[seg, 1] * grid_r + coef[seg, 2]
+    else:
+        trend = elev[rows, cols].astype(np.float64)
+
+    out = (z - trend).astype(np.float32)
+    invalid = (dist > max_buf) | (z == ndval) | ~np.isfinite(z)
+    if reference == 'centerline':
+        invalid |= elev[rows, cols] == ndval
+    out[invalid] = ndval
+
+    return out
+
+
+def grid_window(transform, shape, grid_transform):
+    """
+    Finds the window of an array within a raster on the same grid
+    :param transform: affine transform of the array
+    :param shape: (rows, columns) of the array
+    :param grid_transform: affine transform of the raster
+    :return: rasterio Window
+    """
+    col_off = int(round((transform[2] - grid_transform[2]) / grid_transform[0]))
+    row_off = int(round((transform[5] - grid_transform[5]) / grid_transform[4]))
+
+    return Window(col_off, row_off, shape[1], shape[0])
@@ -0,0 +1,424 @@
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import box
+from shapely.ops import unary_union
+import argparse
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+import classVBET
+from processing.cost import lpt_order
+from processing.vector_io import read_vector, write_vector
+
+QUEUE_STATES = ('pending', 'running', 'done', 'failed')
+
+# a running task whose file has not been touched for this long belongs to a worker that died and is requeued
+LEASE_SECONDS = 600
+
+
+def _connected_components(network, snap=0.01):
+    """
+    Groups network segments that share end points into connected sub-networks (sub-basins)
+    :param network: GeoDataFrame of single part line segments
+    :param snap: distance within which two end points are considered the same node
+    :return: list of lists of network index values, one list per connected component
+    """
+    parent = {i: i for i in network.index}
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    nodes = {}
+    for i in network.index:
+        coords = network.loc[i].geometry.coords
+        for x, y in (coords[0], coords[-1]):
+            key = (round(x / snap), round(y / snap))
+            if key in nodes:
+                a, b = find(i), find(nodes[key])
+                if a != b:
+                    parent[a] = b
+            else:
+                nodes[key] = i
+
+    groups = {}
+    for i in network.index:
+        groups.setdefault(find(i), []).append(i)
+
+    return list(groups.values())
+
+
+def _tile_groups(network, index, tile_size):
+    """
+    Splits a set of segments into square tiles based on the location of each segment's midpoint
+    :param network: GeoDataFrame of line segments
+    :param index: network index values to split
+    :param tile_size: tile edge length in map units
+    :return: list of lists of network index values, one list per occupied tile
+    """
+    tiles = {}
+    for i in index:
+        pt = network.loc[i].geometry.interpolate(0.5, normalized=True)
+        key = (int(np.floor(pt.x / tile_size)), int(np.floor(pt.y / tile_size)))
+        tiles.setdefault(key, []).append(i)
+
+    return [tiles[k] for k in sorted(tiles)]
+
+
+def plan_shards(params, shard_dir, method='basins', max_segments=500, tile_size=None, halo=None):
+    """
+    Splits the stream network of a VBET run into spatially contiguous shards and writes a manifest
+    :param params: dictionary of VBET parameters for the whole network (as used in 1_run_VBET.py)
+    :param shard_dir: directory to hold the shard networks, outputs and the task queue
+    :param method: 'basins' to shard by connected sub-networks, 'tiles' to shard by a square grid
+    :param max_segments: maximum number of core segments in a shard; larger sub-basins are tiled
+    :param tile_size: tile edge length in map units (derived from max_segments if None)
+    :param halo: distance around each shard's core segments from which neighbouring segments are also processed
+    (defaults to twice the largest segment buffer)
+    :return: path to the manifest
+    """
+    if method not in ('basins', 'tiles'):
+        raise ValueError(f"Unsupported shard method '{method}'. Supported methods: 'basins', 'tiles'.")
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # validate inputs and clean the network once for the whole run
+    vb = classVBET.VBET(**params)
+    if vb.da_field is None:
+        vb.add_da()
+    vb.clean_network()
+    network = vb.network
+    avlen = int(vb.seglengths / len(network))
+    max_buf = max(vb.lg_buf, vb.med_buf, vb.sm_buf)
+    if halo is None:
+        halo = 2 * max_buf
+
+    # shared cost model, so every shard calibrates it and the plan can estimate the cost of each shard
+    params = dict(params)
+    params.setdefault('cost_model', os.path.join(shard_dir, 'cost_model.json'))
+    vb.cost_model = params['cost_model']
+    vb.estimate_costs(list(zip(network.index, network['Drain_Area'], network.geometry)))
+
+    if tile_size is None:
+        minx, miny, maxx, maxy = network.total_bounds
+        n_tiles = max(len(network) / max_segments, 1)
+        tile_size = max(np.sqrt((maxx - minx) * (maxy - miny) / n_tiles), halo)
+
+    if method == 'basins':
+        groups = []
+        for comp in _connected_components(network):
+            if len(comp) > max_segments:
+                groups.extend(_tile_groups(network, comp, tile_size))
+            else:
+                groups.append(comp)
+    else:
+        groups = _tile_groups(network, network.index, tile_size)
+
+    shards = []
+    for n, core in enumerate(groups):
+        core_region = unary_union(network.loc[core].geometry.buffer(halo))
+        nearby = network.sindex.query(core_region, predicate='intersects')
+        sub = network.iloc[nearby].copy()
+
+        name = 'shard_{:04d}'.format(n)
+        sdir = os.path.join(shard_dir, name)
+        os.makedirs(sdir, exist_ok=True)
+        write_vector(sub, os.path.join(sdir, 'network.gpkg'))
+
+        shards.append({'id': name,
+                       'network': os.path.join(sdir, 'network.gpkg'),
+                       'out': os.path.join(sdir, 'vb.gpkg'),
+                       'scratch': os.path.join(sdir, 'scratch'),
+                       'n_core': len(core),
+                       'n_halo': len(sub) - len(core),
+                       'cost': round(sum(vb.segment_costs[i] for i in sub.index), 3),
+                       'bounds': list(sub.geometry.buffer(max_buf).total_bounds)})
+
+    shard_params = {k: v for k, v in params.items() if k not in ('network', 'out', 'scratch')}
+    shard_params.update({'da_field': 'Drain_Area', 'dr_area': None, 'avlen': avlen})
+
+    manifest = {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'method': method,
+                'halo': halo,
+                'out': params['out'],
+                'params': shard_params,
+                'shards': shards}
+    manifest_path = os.path.join(shard_dir, 'manifest.json')
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    costs = [shard['cost'] for shard in shards]
+    largest = shards[lpt_order(costs)[0]]['id'] if len(shards) > 0 else None
+    vb.md.writelines('\nSharded into {} shards in {} \n'.format(len(shards), shard_dir))
+    vb.md.writelines('\nEstimated segment time {:.0f} s, largest shard {} \n'.format(sum(costs), largest))
+    vb.md.close()
+    print(f'Planned {len(shards)} shards for {len(network)} segments, manifest saved to {manifest_path}')
+    print('Estimated segment time {:.0f} s ({}), largest shard {} ({:.0f} s)'.format(
+        sum(costs), 'calibrated' if vb.cost.calibrated else 'uncalibrated', largest, max(costs, default=0)))
+
+    return manifest_path
+
+
+def read_manifest(shard_dir):
+    with open(os.path.join(shard_dir, 'manifest.json')) as f:
+        return json.load(f)
+
+
+def enqueue_shards(shard_dir):
+    """
+    Creates a directory based task queue with one pending task per shard in the manifest
+    :param shard_dir: directory holding the manifest
+    :return: number of tasks queued
+    """
+    manifest = read_manifest(shard_dir)
+    for state in QUEUE_STATES:
+        os.makedirs(os.path.join(shard_dir, 'queue', state), exist_ok=True)
+
+    queued = 0
+    for shard in manifest['shards']:
+        task = shard['id'] + '.json'
+        if any(os.path.exists(os.path.join(shard_dir, 'queue', s, task)) for s in QUEUE_STATES):
+            continue
+        with open(os.path.join(shard_dir, 'queue', 'pending', task), 'w') as f:
+            json.dump(shard, f, indent=2)
+        queued += 1
+
+    print(f'Queued {queued} shard tasks')
+
+    return queued
+
+
+def run_shard(manifest, shard):
+    """
+    Runs VBET on a single shard
+    :param manifest: the shard manifest dictionary
+    :param shard: the manifest entry for the shard
+    :return:
+    """
+    params = dict(manifest['params'])
+    params.update({'network': shard['network'], 'out': shard['out'], 'scratch': shard['scratch']})
+    vb = classVBET.VBET(**params)
+    vb.valley_bottom()
+
+    return
+
+
+@contextlib.contextmanager
+def heartbeat(path, interval):
+    """
+    Touches a claimed task file every interval seconds while the shard runs, so other workers can tell a live task
+    from one whose worker died
+    :param path: task file in the 'running' folder
+    :param interval: seconds between touches
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                os.utime(path)
+            except OSError:
+                return  # the task was requeued or finished
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def requeue(shard_dir, lease=LEASE_SECONDS):
+    """
+    Moves running tasks whose lease has expired (their file has not been touched by the worker's heartbeat for lease
+    seconds, e.g. because the node crashed) back to 'pending'
+    :param shard_dir: directory holding the manifest and queue
+    :param lease: seconds after the last heartbeat at which a task is considered abandoned
+    :return: list of the requeued tasks
+    """
+    running = os.path.join(shard_dir, 'queue', 'running')
+    requeued = []
+    for task in sorted(os.listdir(running)):
+        path = os.path.join(running, task)
+        try:
+            if time.time() - os.stat(path).st_mtime < lease:
+                continue
+            os.rename(path, os.path.join(shard_dir, 'queue', 'pending', task))
+        except OSError:
+            continue  # finished or requeued by another worker meanwhile
+        requeued.append(task)
+    if len(requeued) > 0:
+        print('Requeued {} abandoned shard tasks: {}'.format(len(requeued), requeued))
+
+    return requeued
+
+
+def run_worker(shard_dir, max_tasks=None, lease=LEASE_SECONDS):
+    """
+    Claims and runs pending shard tasks until the queue is empty. Tasks are claimed by renaming the task file into
+    the 'running' folder so several workers (on one or many nodes) can share a queue on a common file system. The
+    shard with the largest estimated cost is claimed first (longest processing time first), so no worker is left
+    with a large shard at the end while the others sit idle. A claimed task is touched by a heartbeat while it runs,
+    and tasks whose heartbeat stopped for lease seconds are requeued before each claim.
+    :param shard_dir: directory holding the manifest and queue
+    :param max_tasks: stop after this many tasks (None to run until the queue is empty)
+    :param lease: seconds without a heartbeat after which a running task is requeued
+    :return: number of tasks run
+    """
+    manifest = read_manifest(shard_dir)
+    queue = os.path.join(shard_dir, 'queue')
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    costs = {shard['id'] + '.json': shard.get('cost', 0) for shard in manifest['shards']}
+
+    n = 0
+    while max_tasks is None or n < max_tasks:
+        requeue(shard_dir, lease)
+        pending = sorted(os.listdir(os.path.join(queue, 'pending')), key=lambda t: (-costs.get(t, 0), t))
+        if len(pending) == 0:
+            break
+
+        claimed = None
+        for task in pending:
+            try:
+                # touched before the move, so the claimed task does not look abandoned
+                os.utime(os.path.join(queue, 'pending', task))
+                os.rename(os.path.join(queue, 'pending', task), os.path.join(queue, 'running', task))
+                claimed = task
+                break
+            except OSError:
+                continue  # another worker claimed it first
+        if claimed is None:
+            continue
+
+        running = os.path.join(queue, 'running', claimed)
+        with open(running) as f:
+            shard = json.load(f)
+        print(f"Worker {worker} running {shard['id']}")
+        shard['worker'] = worker
+        start = time.time()
+        with heartbeat(running, max(lease / 10., 0.1)):
+            try:
+                run_shard(manifest, shard)
+                state = 'done'
+            except Exception:
+                shard['error'] = traceback.format_exc()
+                state = 'failed'
+        shard['seconds'] = round(time.time() - start, 2)
+
+        with open(os.path.join(queue, state, claimed), 'w') as f:
+            json.dump(shard, f, indent=2)
+        try:
+            os.remove(running)
+        except OSError:
+            pass  # requeued while it ran (its heartbeat was late), the other run's result is the same
+        n += 1
+
+    return n
+
+
+def merge_shards(shard_dir, out=None, seam_tolerance=None, allow_partial=False):
+    """
+    Unions the shard valley bottoms and closes small gaps along the seams where shards overlap
+    :param shard_dir: directory holding the manifest and queue
+    :param out: path for the merged valley bottom (defaults to the 'out' of the original run)
+    :param seam_tolerance: distance used to close gaps in the overlap zones (defaults to the minimum buffer)
+    :param allow_partial: merge the finished shards even if some have not completed
+    :return: path to the merged valley bottom
+    """
+    manifest = read_manifest(shard_dir)
+    out = out or manifest['out']
+    if seam_tolerance is None:
+        seam_tolerance = manifest['params']['min_buf']
+
+    missing = [s['id'] for s in manifest['shards'] if not os.path.isfile(s['out'])]
+    if len(missing) > 0 and not allow_partial:
+        raise Exception('Shards {} have not finished, run the remaining tasks or set allow_partial'.format(missing))
+
+    print('Merging shard valley bottoms')
+    polys = []
+    extents = []
+    crs = None
+    for shard in manifest['shards']:
+        if shard['id'] in missing:
+            continue
+        vb = read_vector(shard['out'])
+        crs = vb.crs
+        polys.extend(vb.geometry)
+        extents.append(box(*shard['bounds']))
+    merged = unary_union(polys)
+
+    # zones covered by more than one shard
+    overlaps = []
+    for a in range(len(extents)):
+        for b in range(a + 1, len(extents)):
+            if extents[a].intersects(extents[b]):
+                overlaps.append(extents[a].intersection(extents[b]))
+    if len(overlaps) > 0:
+        zones = unary_union(overlaps)
+        seams = merged.intersection(zones).buffer(seam_tolerance).buffer(-seam_tolerance)
+        merged = merged.union(seams.intersection(zones))
+
+    vbf = gpd.GeoDataFrame(index=[0], crs=crs, geometry=[merged])
+    vbf = vbf.explode(ignore_index=True)
+    vbf['Area_km2'] = vbf.geometry.area / 1000000.
+
+    if not os.path.isdir(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out))
+    write_vector(vbf, out, driver='GPKG')
+    print(f'Saved merged valley bottom to {out}')
+
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run VBET over a sharded stream network')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('plan', help='split the network into shards and queue them')
+    p.add_argument('params', help='JSON file of VBET parameters')
+    p.add_argument('shard_dir')
+    p.add_argument('--method', default='basins', choices=['basins', 'tiles'])
+    p.add_argument('--max-segments', type=int, default=500)
+    p.add_argument('--tile-size', type=float, default=None)
+    p.add_argument('--halo', type=float, default=None)
+
+    w = sub.add_parser('worker', help='run queued shard tasks')
+    w.add_argument('shard_dir')
+    w.add_argument('--max-tasks', type=int, default=None)
+    w.add_argument('--lease', type=float, default=LEASE_SECONDS)
+
+    r = sub.add_parser('requeue', help='move running tasks whose worker stopped back to pending')
+    r.add_argument('shard_dir')
+    r.add_argument('--lease', type=float, default=LEASE_SECONDS)
+
+    m = sub.add_parser('merge', help='merge finished shard outputs')
+    m.add_argument('shard_dir')
+    m.add_argument('--out', default=None)
+    m.add_argument('--seam-tolerance', type=float, default=None)
+    m.add_argument('--allow-partial', action='store_true')
+
+    args = parser.parse_args()
+    if args.command == 'plan':
+        with open(args.params) as f:
+            params = json.load(f)
+        plan_shards(params, args.shard_dir, method=args.method, max_segments=args.max_segments,
+                    tile_size=args.tile_size, halo=args.halo)
+        enqueue_shards(args.shard_dir)
+    elif args.command == 'worker':
+        run_worker(args.shard_dir, max_tasks=args.max_tasks, lease=args.lease)
+    elif args.command == 'requeue':
+        requeue(args.shard_dir, lease=args.lease)
+    else:
+        merge_shards(args.shard_dir, out=args.out, seam_tolerance=args.seam_tolerance,
+                     allow_partial=args.allow_partial)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import numpy as np
+
+BACKENDS = ('convolve', 'sobel', 'mask')
+
+
+def convolve_slope(arr, xres, yres):
+    """
+    Finds the slope using partial derivative method with two full 2-D convolutions (the original VBET slope)
+    :param arr: 2-D DEM array
+    :param xres: cell size in x
+    :param yres: cell size in y
+    :return: a 2-D float64 array of slope in degrees. Cells outside the array are taken as an elevation of 1 and
+    NoData cells are treated as elevations.
+    """
+    from scipy.signal import convolve2d  # slow to import, only needed by this backend
+
+    x = np.array([[-1 / (8 * xres), 0, 1 / (8 * xres)],
+                  [-2 / (8 * xres), 0, 2 / (8 * xres)],
+                  [-1 / (8 * xres), 0, 1 / (8 * xres)]])
+    y = np.array([[1 / (8 * yres), 2 / (8 * yres), 1 / (8 * yres)],
+                  [0, 0, 0],
+                  [-1 / (8 * yres), -2 / (8 * yres), -1 / (8 * yres)]])
+
+    x_grad = convolve2d(arr, x, mode='same', boundary='fill', fillvalue=1)
+    y_grad = convolve2d(arr, y, mode='same', boundary='fill', fillvalue=1)
+    slope = np.arctan(np.sqrt(x_grad ** 2 + y_grad ** 2)) * (180. / np.pi)
+
+    return slope
+
+
+def valid_cells(arr, ndval):
+    """
+    Finds the cells whose whole 3x3 neighbourhood is inside the array and holds data
+    :param arr: 2-D DEM array
+    :param ndval: NoData value
+    :return: 2-D boolean array
+    """
+    from scipy import ndimage
+    valid = np.isfinite(arr)
+    if ndval is not None:
+        valid &= arr != ndval
+
+    # separable 3x3 erosion, cells beyond the array edge count as NoData
+    valid = ndimage.binary_erosion(valid, structure=np.ones((1, 3), dtype=bool), border_value=0)
+    valid = ndimage.binary_erosion(valid, structure=np.ones((3, 1), dtype=bool), border_value=0)
+
+    return valid
+
+
+def sobel_gradients(arr, xres, yres):
+    """
+    Finds the x and y elevation gradients with separable Sobel filters (same weights as convolve_slope)
+    :param arr: 2-D DEM array
+    :param xres: cell size in x
+    :param yres: cell size in y
+    :return: tuple of (x gradient, y gradient) arrays, float32 for float32 input
+    """
+    from scipy import ndimage
+    dtype = np.float32 if arr.dtype == np.float32 else np.float64
+    x_grad = ndimage.sobel(arr, axis=1, output=dtype, mode='nearest')
+    x_grad *= dtype(1 / (8 * xres))
+    y_grad = ndimage.sobel(arr, axis=0, output=dtype, mode='nearest')
+    y_grad *= dtype(1 / (8 * yres))
+
+    return x_grad, y_grad
+
+
+def sobel_slope(arr, xres, yres, ndval):
+    """
+    Finds the slope in degrees with separable Sobel filters, ignoring NoData
+    :param arr: 2-D DEM array
+    :param xres: cell size in x
+    :param yres: cell size in y
+    :param ndval: NoData value
+    :return: a 2-D array of slope in degrees with NoData where a cell's neighbourhood has NoData or leaves the array
+    """
+    x_grad, y_grad = sobel_gradients(arr, xres, yres)
+    slope = np.hypot(x_grad, y_grad, out=x_grad)
+    del y_grad
+    np.arctan(slope, out=slope)
+    slope *= slope.dtype.type(180. / np.pi)
+    slope[~valid_cells(arr, ndval)] = ndval if ndval is not None else np.nan
+
+    return slope
+
+
+def slope_mask(arr, xres, yres, ndval, thresh, out=None):
+    """
+    Finds the cells with 0 < slope <= thresh without computing the slope itself, by comparing the squared gradient
+    against tan(thresh) squared
+    :param arr: 2-D DEM array
+    :param xres: cell size in x
+    :param yres: cell size in y
+    :param ndval: NoData value
+    :param thresh: slope threshold in degrees
+    :param out: optional boolean array to write the result into
+    :return: 2-D boolean array, False where a cell's neighbourhood has NoData or leaves the array
+    """
+    x_grad, y_grad = sobel_gradients(arr, xres, yres)
+    x_grad *= x_grad
+    y_grad *= y_grad
+    x_grad += y_grad
+    del y_grad
+
+    if out is None:
+        out = np.empty(arr.shape, dtype=bool)
+    np.less_equal(x_grad, np.tan(np.radians(thresh)) ** 2, out=out)
+    out &= x_grad > 0
+    out &= valid_cells(arr, ndval)
+
+    return out
@@ -0,0 +1,111 @@
+import numpy as np
+import shapely
+
+METHODS = ('chaikin', 'bulk')
+
+
+def chaikin_rings(coords, ring_offsets, refinements):
+    """
+    Chaikin corner cutting on many rings at once, with the same weights as VBET.chaikins_corner_cutting (the first
+    and last vertex of each ring are kept, so closed rings stay closed)
+    :param coords: (n, 2) array of the vertices of all rings, one ring after another
+    :param ring_offsets: array of the index of the first vertex of each ring, followed by n
+    :param refinements: number of refinements (each doubles the number of vertices)
+    :return: tuple of (smoothed vertices, ring offsets of the smoothed vertices)
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+    for _ in range(refinements):
+        starts = ring_offsets[:-1][np.diff(ring_offsets) > 0]
+        ends = ring_offsets[1:][np.diff(ring_offsets) > 0] - 1
+
+        prev = np.roll(coords, 1, axis=0)
+        prev[starts] = coords[starts]
+        nxt = np.roll(coords, -1, axis=0)
+        nxt[ends] = coords[ends]
+
+        out = np.empty((coords.shape[0] * 2, 2), dtype=np.float64)
+        out[0::2] = coords * 0.75 + prev * 0.25
+        out[1::2] = coords * 0.75 + nxt * 0.25
+        out[2 * starts] = coords[starts]
+        out[2 * ends + 1] = coords[ends]
+        coords = out
+        ring_offsets = ring_offsets * 2
+
+    return coords, ring_offsets
+
+
+def budget_refinements(n_vertices, refinements, vertex_budget=None):
+    """
+    :param n_vertices: number of vertices before smoothing
+    :param refinements: requested number of refinements
+    :param vertex_budget: optional maximum number of vertices after the refinements
+    :return: the number of refinements that keeps the vertex count within the budget
+    """
+    if vertex_budget is None or n_vertices == 0:
+        return refinements
+    fit = int(np.floor(np.log2(max(vertex_budget / n_vertices, 1))))
+
+    return min(refinements, fit)
+
+
+def polygonal_parts(geoms):
+    """
+    :param geoms: array of geometries
+    :return: array of the non-empty polygons in the geometries, made valid
+    """
+    parts = shapely.get_parts(shapely.get_parts(shapely.make_valid(geoms)))
+    parts = parts[shapely.get_type_id(parts) == 3]
+
+    return parts[~shapely.is_empty(parts)]
+
+
+def fit_budget(polygons, vertex_budget, tolerance=None):
+    """
+    Simplifies polygons with an increasing tolerance (doubled each step) until they have at most vertex_budget
+    vertices. A budget below four vertices per ring cannot be met; the polygons are then simplified as far as they go.
+    :param polygons: array of polygons
+    :param vertex_budget: maximum number of vertices
+    :param tolerance: tolerance already applied, the first step doubles it (default: a quarter of the mean edge)
+    :return: tuple of (array of polygons, tolerance used or None if the polygons were within the budget)
+    """
+    n = int(shapely.get_num_coordinates(polygons).sum())
+    if vertex_budget is None or n <= vertex_budget:
+        return polygons, None
+    tolerance = tolerance or shapely.length(polygons).sum() / n / 4
+    simplified = polygons
+    for _ in range(64):
+        tolerance *= 2
+        previous = n
+        simplified = shapely.simplify(polygons, tolerance, preserve_topology=True)
+        n = int(shapely.get_num_coordinates(simplified).sum())
+        if n <= vertex_budget or n == previous:
+            break
+
+    return simplified, tolerance
+
+
+def smooth_polygons(polygons, refinements=5, vertex_budget=None, tolerance=None):
+    """
+    Smooths the exterior and interior rings of polygons in bulk: Chaikin corner cutting on the ragged array of all
+    ring vertices, with the number of refinements capped by a vertex budget, followed by an optional
+    simplification to an error tolerance. Holes are smoothed apart from their shell and can cross it, so the result
+    is made valid. If the polygons are still over the budget (because they had more vertices than the budget before
+    smoothing) they are simplified until they fit (see fit_budget).
+    :param polygons: list of shapely polygons
+    :param refinements: number of Chaikin refinements
+    :param vertex_budget: optional maximum number of vertices in the result
+    :param tolerance: optional simplification tolerance (map units) applied after smoothing
+    :return: list of smoothed polygons
+    """
+    if len(polygons) == 0:
+        return []
+    geom_type, coords, (ring_offsets, geom_offsets) = shapely.to_ragged_array(polygons)
+    k = budget_refinements(coords.shape[0], refinements, vertex_budget)
+    coords, ring_offsets = chaikin_rings(coords, ring_offsets, k)
+    smoothed = polygonal_parts(shapely.from_ragged_array(geom_type, coords, (ring_offsets, geom_offsets)))
+    if tolerance is not None:
+        smoothed = shapely.simplify(smoothed, tolerance, preserve_topology=True)
+    smoothed, _ = fit_budget(smoothed, vertex_budget, tolerance)
+
+    return list(smoothed)
@@ -0,0 +1,108 @@
+import numpy as np
+import time
+
+
+class Stage:
+    """
+    One filter of the per-segment stage graph. The stage is given the rows and columns of the window that still hold
+    candidate cells and returns a boolean mask of the cells in that box that pass it.
+    """
+    def __init__(self, name, evaluate, cost=1.):
+        """
+        :param name: name of the stage (used for the counters)
+        :param evaluate: function taking (row slice, column slice) and returning a 2-D boolean array of that size
+        :param cost: relative cost used to order the stages until they have been timed
+        """
+        self.name = name
+        self.evaluate = evaluate
+        self.cost = cost
+
+
+class StageGraph:
+    """
+    Evaluates the filters of a segment lazily. The filters are ANDed together, so they can run in any order: the
+    stages are ordered by their time per run divided by the fraction of cells they reject (cheap and selective first),
+    evaluation stops as soon as no candidate cells remain, and each stage only sees the bounding box of the cells that
+    passed the stages before it. Counters are kept per stage name across segments.
+    """
+    def __init__(self, warmup=5):
+        """
+        :param warmup: number of runs of every stage before the measured times replace the relative costs
+        """
+        self.warmup = warmup
+        self.counters = {}
+
+    def counter(self, name):
+        if name not in self.counters:
+            self.counters[name] = {'runs': 0, 'skipped': 0, 'cells': 0, 'cropped': 0, 'passed': 0, 'seconds': 0.}
+
+        return self.counters[name]
+
+    def rank(self, stage):
+        c = self.counter(stage.name)
+        if c['cells'] == 0:
+            return stage.cost
+        rejected = 1 - c['passed'] / c['cells']
+
+        return (c['seconds'] / c['runs']) / max(rejected, 0.01)
+
+    def order(self, stages):
+        """
+        :param stages: list of Stage
+        :return: the stages ordered cheapest and most selective first
+        """
+        if min(self.counter(s.name)['runs'] for s in stages) < self.warmup:
+            return sorted(stages, key=lambda s: s.cost)
+
+        return sorted(stages, key=self.rank)
+
+    def run(self, stages, candidates, skip=()):
+        """
+        Evaluates the filters of one segment
+        :param stages: list of Stage
+        :param candidates: 2-D boolean array of the cells that can be valley bottom at all (modified in place)
+        :param skip: names of later stages to count as skipped if the filters leave no candidate cells
+        :return: the candidates array with the cells that failed a filter set to False, or None if none remain
+        """
+        ordered = self.order(stages)
+        for k, stage in enumerate(ordered):
+            rows = np.flatnonzero(candidates.any(axis=1))
+            if len(rows) == 0:
+                for later in ordered[k:]:
+                    self.counter(later.name)['skipped'] += 1
+                for name in skip:
+                    self.counter(name)['skipped'] += 1
+                return None
+            cols = np.flatnonzero(candidates.any(axis=0))
+            box = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+
+            start = time.perf_counter()
+            passed = stage.evaluate(*box)
+            c = self.counter(stage.name)
+            c['seconds'] += time.perf_counter() - start
+            c['runs'] += 1
+            c['cells'] += passed.size
+            c['cropped'] += candidates.size - passed.size
+            candidates[box] &= passed
+            c['passed'] += int(np.count_nonzero(candidates[box]))
+
+        if not candidates.any():
+            for name in skip:
+                self.counter(name)['skipped'] += 1
+            return None
+
+        return candidates
+
+    def report(self):
+        """
+        :return: one line per stage with the number of segments it ran on and was skipped for, the share of window
+        cells that cropping kept it from evaluating and its total time
+        """
+        lines = []
+        for name, c in self.counters.items():
+            total = c['cells'] + c['cropped']
+            cropped = ', cells cropped away {:.0%}'.format(c['cropped'] / total) if total else ''
+            lines.append('{}: ran {}, skipped {}{}, {:.1f} s'.format(name, c['runs'], c['skipped'], cropped,
+                                                                     c['seconds']))
+
+        return lines
@@ -0,0 +1,106 @@
+import math
+
+import numpy as np
+import shapely
+from affine import Affine
+from shapely.ops import substring
+
+
+def window_cells(geom, res):
+    """
+    :param geom: geometry
+    :param res: cell size
+    :return: number of cells in the bounding window of the geometry
+    """
+    minx, miny, maxx, maxy = geom.bounds
+
+    return (math.ceil((maxx - minx) / res) + 1) * (math.ceil((maxy - miny) / res) + 1)
+
+
+def split_segment(line, distance, res, budget, overlap=None):
+    """
+    Splits a segment whose buffer has a bounding window of more than budget cells into pieces along its centerline.
+    Each piece comes with a context line, the piece extended by overlap along the centerline at both ends, whose
+    buffer is the sub-window the piece is processed in. The context gives the slope kernel, the trend plane and the
+    hole filling the cells they need around the piece; the result of a sub-window is then only kept for the cells
+    nearest to its piece (see owned_cells), so the pieces stitch together without seams or double counting.
+    :param line: segment centerline
+    :param distance: buffer distance of the segment
+    :param res: processing cell size
+    :param budget: maximum number of cells in a sub-window
+    :param overlap: distance the context extends beyond the piece (default: the buffer distance)
+    :return: tuple of (list of context lines, list of pieces), or None if the segment buffer fits the budget
+    """
+    buf = line.buffer(distance, cap_style=1)
+    if window_cells(buf, res) <= budget:
+        return None
+    if overlap is None:
+        overlap = distance
+    length = line.length
+
+    # each sub-window holds at least its share of the buffer area, so there are at least this many pieces
+    n = max(2, math.ceil(buf.area / res ** 2 / budget))
+    while True:
+        step = length / n
+        cuts = [(k * step, (k + 1) * step) for k in range(n)]
+        contexts = [substring(line, max(a - overlap, 0), min(b + overlap, length)) for a, b in cuts]
+        # pieces shorter than the buffer distance do not make the windows much smaller
+        if all(window_cells(c.buffer(distance), res) <= budget for c in contexts) or step <= distance:
+            break
+        n += 1
+
+    # the trend plane is fitted to every other vertex, so short contexts get extra vertices
+    contexts = [shapely.segmentize(c, max(c.length / 10, res)) for c in contexts]
+    pieces = [substring(line, a, b) for a, b in cuts]
+
+    return contexts, pieces
+
+
+def owned_cells(mask, transform, tree, k):
+    """
+    Keeps the cells of a sub-window's valley bottom that are nearer to the sub-window's piece than to any other
+    piece of the segment
+    :param mask: 2-D boolean valley bottom array of the sub-window (changed in place)
+    :param transform: affine transform of the array
+    :param tree: STRtree of the segment's pieces
+    :param k: index of the sub-window's piece in the tree
+    :return: mask
+    """
+    rows, cols = np.nonzero(mask)
+    if len(rows) == 0:
+        return mask
+    xs, ys = transform * (cols + 0.5, rows + 0.5)
+    nearest = tree.query_nearest(shapely.points(xs, ys), all_matches=False)
+    keep = np.zeros(len(rows), dtype=bool)
+    keep[nearest[0]] = nearest[1] == k
+    mask[rows[~keep], cols[~keep]] = False
+
+    return mask
+
+
+def mosaic_parts(parts):
+    """
+    Places the valley bottom arrays of a split segment's sub-windows on one array covering all of them, so that the
+    segment is traced as one mask. Tracing the sub-windows separately and merging the polygons covers the same cells
+    but starts the rings at other vertices, which changes what the later simplification of the valley bottom keeps.
+    :param parts: list of (2-D array of 1s and NoData, affine transform)
+    :return: tuple of (2-D uint8 array of 1s and 0s, affine transform), or None if the sub-windows are not on one grid
+    (sub-windows resampled to a coarser cell size each have their own grid)
+    """
+    t0 = parts[0][1]
+    offsets = []
+    for arr, t in parts:
+        col, row = ~t0 * (t.c, t.f)
+        if t[:2] + t[3:5] != t0[:2] + t0[3:5] or not np.allclose([col, row], np.round([col, row])):
+            return None
+        offsets.append((int(round(row)), int(round(col))))
+    r0 = min(r for r, _ in offsets)
+    c0 = min(c for _, c in offsets)
+    height = max(r + arr.shape[0] for (r, _), (arr, _) in zip(offsets, parts)) - r0
+    width = max(c + arr.shape[1] for (_, c), (arr, _) in zip(offsets, parts)) - c0
+
+    out = np.zeros((height, width), dtype=np.uint8)
+    for (r, c), (arr, _) in zip(offsets, parts):
+        out[r - r0:r - r0 + arr.shape[0], c - c0:c - c0 + arr.shape[1]] |= (arr == 1)
+
+    return out, t0 * Affine.translation(c0, r0)
@@ -0,0 +1,208 @@
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from shapely.geometry import box
+from shapely.strtree import STRtree
+from collections import OrderedDict
+import xml.etree.ElementTree as ET
+import glob
+import os
+import threading
+
+TILE_EXTENSIONS = ('.tif', '.tiff', '.img')
+GDAL_TYPES = {'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32',
+              'int32': 'Int32', 'float32': 'Float32', 'float64': 'Float64'}
+
+
+def list_tiles(dem):
+    """
+    Lists the tiles of a tiled DEM collection
+    :param dem: path to a DEM, a directory of tiles, a list of tile paths or a VRT
+    :return: list of tile paths, or None if dem is a single DEM
+    """
+    if isinstance(dem, (list, tuple)):
+        return [os.path.abspath(t) for t in dem]
+    if os.path.isdir(dem):
+        return sorted(os.path.abspath(t) for t in glob.glob(os.path.join(dem, '*'))
+                      if t.lower().endswith(TILE_EXTENSIONS))
+    if dem.lower().endswith('.vrt'):
+        tiles = []
+        for source in ET.parse(dem).getroot().iter('SourceFilename'):
+            path = source.text
+            if source.get('relativeToVRT') == '1':
+                path = os.path.join(os.path.dirname(os.path.abspath(dem)), path)
+            if path not in tiles:
+                tiles.append(path)
+        return tiles
+
+    return None
+
+
+class TileIndex:
+    """
+    A footprint index over the tiles of a DEM collection that share a cell size and grid. Windows on the grid of
+    the whole collection are read from only the tiles they touch, through a bounded pool of open datasets per thread,
+    so the mosaic never has to be built.
+    """
+    def __init__(self, tiles, max_open=16):
+        """
+        :param tiles: list of tile paths
+        :param max_open: maximum number of tiles held open at once by each thread
+        """
+        if len(tiles) == 0:
+            raise Exception('No DEM tiles found')
+        self.paths = list(tiles)
+        self.max_open = max(int(max_open), 1)
+
+        footprints = []
+        self.windows = []
+        for path in self.paths:
+            with rasterio.open(path) as src:
+                if len(footprints) == 0:
+                    self.res = src.res
+                    self.crs = src.crs
+                    self.nodata = src.nodata
+                    self.dtype = src.dtypes[0]
+                elif src.res != self.res or src.dtypes[0] != self.dtype or src.crs != self.crs:
+                    raise Exception('DEM tile {} does not have the cell size, data type and coordinate reference '
+                                    'system of {}'.format(path, self.paths[0]))
+                footprints.append(src.bounds)
+
+        left = min(b.left for b in footprints)
+        top = max(b.top for b in footprints)
+        right = max(b.right for b in footprints)
+        bottom = min(b.bottom for b in footprints)
+        self.transform = rasterio.transform.from_origin(left, top, self.res[0], self.res[1])
+        self.width = int(round((right - left) / self.res[0]))
+        self.height = int(round((top - bottom) / self.res[1]))
+        self.bounds = (left, bottom, right, top)
+
+        for path, b in zip(self.paths, footprints):
+            col = (b.left - left) / self.res[0]
+            row = (top - b.top) / self.res[1]
+            if abs(col - round(col)) > 1e-6 or abs(row - round(row)) > 1e-6:
+                raise Exception('DEM tile {} is not aligned with the grid of the other tiles'.format(path))
+            self.windows.append(Window(int(round(col)), int(round(row)), int(round((b.right - b.left) / self.res[0])),
+                                       int(round((b.top - b.bottom) / self.res[1]))))
+
+        self.tree = STRtree([box(*b) for b in footprints])
+        self._local = threading.local()
+        self._pools = []
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.opens = 0
+
+    def tiles_for(self, window):
+        """
+        :param window: window on the grid of the collection
+        :return: positions of the tiles the window touches, in collection order
+        """
+        left, bottom, right, top = rasterio.windows.bounds(window, self.transform)
+        hits = self.tree.query(box(left, bottom, right, top))
+        touching = []
+        for k in sorted(hits):
+            w = self.windows[k]
+            if w.col_off < window.col_off + window.width and window.col_off < w.col_off + w.width and \
+                    w.row_off < window.row_off + window.height and window.row_off < w.row_off + w.height:
+                touching.append(k)
+
+        return touching
+
+    def handle(self, k):
+        """
+        Returns an open dataset for a tile from the calling thread's pool, closing the least recently used tile when
+        the pool is full
+        :param k: position of the tile
+        :return: open rasterio dataset
+        """
+        pool = getattr(self._local, 'pool', None)
+        if pool is None:
+            pool = OrderedDict()
+            self._local.pool = pool
+            with self._lock:
+                self._pools.append(pool)
+        if k in pool:
+            pool.move_to_end(k)
+            return pool[k]
+        if len(pool) >= self.max_open:
+            _, oldest = pool.popitem(last=False)
+            oldest.close()
+        pool[k] = rasterio.open(self.paths[k])
+        with self._lock:
+            self.opens += 1
+
+        return pool[k]
+
+    def read(self, window):
+        """
+        Reads a window on the grid of the collection. Cells not covered by any tile are NoData, and where tiles
+        overlap later tiles are drawn over earlier ones except where they hold NoData (as in the VRT).
+        :param window: window on the grid of the collection (integer offsets and size)
+        :return: 2-D array
+        """
+        height, width = int(window.height), int(window.width)
+        fill = self.nodata if self.nodata is not None else 0
+        out = np.full((height, width), fill, dtype=self.dtype)
+        for k in self.tiles_for(window):
+            w = self.windows[k]
+            r0 = max(window.row_off, w.row_off)
+            r1 = min(window.row_off + height, w.row_off + w.height)
+            c0 = max(window.col_off, w.col_off)
+            c1 = min(window.col_off + width, w.col_off + w.width)
+            arr = self.handle(k).read(1, window=Window(c0 - w.col_off, r0 - w.row_off, c1 - c0, r1 - r0))
+            dst = out[r0 - window.row_off:r1 - window.row_off, c0 - window.col_off:c1 - window.col_off]
+            if self.nodata is None:
+                dst[...] = arr
+            else:
+                data = arr != self.nodata
+                dst[data] = arr[data]
+            with self._lock:
+                self.reads += 1
+
+        return out
+
+    def write_vrt(self, path):
+        """
+        Writes a VRT of the collection (rewritten only when its content changes, so its modification time stays the
+        same between runs on the same tiles)
+        :param path: output VRT path
+        :return: path
+        """
+        root = ET.Element('VRTDataset', rasterXSize=str(self.width), rasterYSize=str(self.height))
+        ET.SubElement(root, 'SRS').text = self.crs.to_wkt()
+        ET.SubElement(root, 'GeoTransform').text = ', '.join(repr(v) for v in self.transform.to_gdal())
+        band = ET.SubElement(root, 'VRTRasterBand', dataType=GDAL_TYPES[self.dtype], band='1')
+        if self.nodata is not None:
+            ET.SubElement(band, 'NoDataValue').text = repr(self.nodata)
+        for tile, w in zip(self.paths, self.windows):
+            source = ET.SubElement(band, 'ComplexSource')
+            ET.SubElement(source, 'SourceFilename', relativeToVRT='0').text = tile
+            ET.SubElement(source, 'SourceBand').text = '1'
+            ET.SubElement(source, 'SrcRect', xOff='0', yOff='0', xSize=str(w.width), ySize=str(w.height))
+            ET.SubElement(source, 'DstRect', xOff=str(w.col_off), yOff=str(w.row_off), xSize=str(w.width),
+                          ySize=str(w.height))
+            if self.nodata is not None:
+                ET.SubElement(source, 'NODATA').text = repr(self.nodata)
+        content = ET.tostring(root, encoding='unicode')
+
+        if os.path.isfile(path):
+            with open(path) as f:
+                if f.read() == content:
+                    return path
+        with open(path, 'w') as f:
+            f.write(content)
+
+        return path
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools:
+                for src in pool.values():
+                    src.close()
+                pool.clear()
+            self._pools = []
+        self._local = threading.local()
+
+    def report(self):
+        return 'DEM tiles: {} tiles, {} tile reads, {} tile opens (at most {} open per thread)'.format(
+            len(self.paths), self.reads, self.opens, self.max_open)
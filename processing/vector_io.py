@@ -0,0 +1,74 @@
+import functools
+import os
+
+import geopandas as gpd
+
+PARQUET = ('.parquet', '.geoparquet')
+DRIVERS = {'.gpkg': 'GPKG', '.shp': 'ESRI Shapefile', '.geojson': 'GeoJSON', '.json': 'GeoJSON'}
+
+
+def is_parquet(path):
+    return os.path.splitext(str(path))[1].lower() in PARQUET
+
+
+@functools.lru_cache(maxsize=None)
+def _available(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+
+    return True
+
+
+def parquet_supported():
+    """
+    :return: True if GeoParquet layers can be read and written (pyarrow is installed)
+    """
+    return _available('pyarrow')
+
+
+def engine_options():
+    """
+    Options for whole-layer reads and writes: through pyogrio, moving the layer as Arrow record batches when pyarrow
+    is installed, otherwise through Fiona feature by feature
+    :return: dict of keyword arguments for geopandas read_file and to_file
+    """
+    if not _available('pyogrio'):
+        return {}
+
+    return {'engine': 'pyogrio', 'use_arrow': _available('pyarrow')}
+
+
+def read_vector(path, **kwargs):
+    """
+    Reads a vector layer (GeoParquet, or any format GDAL reads) into a GeoDataFrame in one bulk read
+    :param path: path to the layer
+    :param kwargs: further arguments for geopandas (e.g. layer, columns)
+    :return: GeoDataFrame
+    """
+    if is_parquet(path):
+        return gpd.read_parquet(path, **kwargs)
+
+    return gpd.read_file(path, **engine_options(), **kwargs)
+
+
+def write_vector(gdf, path, driver=None):
+    """
+    Writes a GeoDataFrame (or GeoSeries) in one bulk write, as GeoParquet if the path ends in .parquet or
+    .geoparquet, otherwise with the driver for the extension (GeoPackage if unknown)
+    :param gdf: GeoDataFrame or GeoSeries
+    :param path: output path
+    :param driver: OGR driver name (None to take it from the extension); not used for GeoParquet paths
+    :return: path
+    """
+    if isinstance(gdf, gpd.GeoSeries):
+        gdf = gpd.GeoDataFrame(geometry=gdf)
+    if is_parquet(path):
+        gdf.to_parquet(path)
+    else:
+        if driver is None:
+            driver = DRIVERS.get(os.path.splitext(str(path))[1].lower(), 'GPKG')
+        gdf.to_file(path, driver=driver, **engine_options())
+
+    return path
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import LineString
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+X0, Y0 = 500000.0, 4400000.0
+
+
+def write_dem(path, height=200, width=300, res=1.0, seed=0):
+    """
+    Writes a synthetic DEM of a meandering valley along x, with a flat floor about 40 cells wide
+    :return: path
+    """
+    rows, cols = np.mgrid[0:height, 0:width]
+    centerline = height / 2 + 15 * np.sin(cols / 30.)
+    dist = np.abs(rows - centerline)
+    z = 1000 + cols * 0.02 + np.where(dist < 20, 0.02 * dist, 0.4 + 0.35 * (dist - 20))
+    z += np.random.RandomState(seed).normal(0, 0.05, z.shape)
+    profile = dict(driver='GTiff', height=height, width=width, count=1, dtype='float32', crs='EPSG:32613',
+                   transform=from_origin(X0, Y0, res, res), nodata=-9999)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(z.astype('float32'), 1)
+
+    return path
+
+
+def write_network(path, height=200, width=300, step=20):
+    """
+    Writes the valley centerline of write_dem split into segments, with drainage areas of all three size classes
+    :return: path
+    """
+    xs = np.arange(2, width - 2, 3.0)
+    ys = height / 2 + 15 * np.sin(xs / 30.)
+    pts = [(X0 + x + 0.5, Y0 - y - 0.5) for x, y in zip(xs, ys)]
+    segs = [LineString(pts[k:k + step + 1]) for k in range(0, len(pts) - 1, step) if len(pts[k:k + step + 1]) > 3]
+    da = [300, 300, 120, 120] + [10] * max(len(segs) - 4, 0)
+    gpd.GeoDataFrame({'DA': da[:len(segs)]}, geometry=segs, crs='EPSG:32613').to_file(path)
+
+    return path
+
+
+@pytest.fixture
+def vbet_params(tmp_path):
+    """
+    VBET parameters for a run on the synthetic DEM and network in a temporary folder
+    """
+    return dict(network=write_network(str(tmp_path / 'network.gpkg')), dem=write_dem(str(tmp_path / 'dem.tif')),
+                out=str(tmp_path / 'out' / 'vb.gpkg'), scratch=str(tmp_path / 'scratch'),
+                lg_da=250, med_da=100, lg_slope=3, med_slope=4, sm_slope=6, lg_buf=40, med_buf=30, sm_buf=20,
+                min_buf=4, dr_area=None, da_field='DA', lg_depth=1.5, med_depth=1.2, sm_depth=1)
@@ -0,0 +1,30 @@
+import csv
+import json
+import os
+
+from processing.batch import load_manifest, run_batch, write_summary
+
+
+def test_batch_with_broken_job(vbet_params, tmp_path):
+    defaults = {k: v for k, v in vbet_params.items() if k not in ('network', 'dem', 'out', 'scratch')}
+    manifest = {'defaults': defaults,
+                'jobs': [{'name': 'good', 'network': vbet_params['network'], 'dem': vbet_params['dem'],
+                          'out': str(tmp_path / 'good' / 'vb.gpkg')},
+                         {'name': 'broken', 'network': vbet_params['network'], 'dem': str(tmp_path / 'missing.tif'),
+                          'out': str(tmp_path / 'broken' / 'vb.gpkg')}]}
+    path = str(tmp_path / 'batch.json')
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+
+    rows = run_batch(load_manifest(path), workers=2)
+    summary = str(tmp_path / 'summary.csv')
+    write_summary(rows, summary)
+
+    with open(summary, newline='') as f:
+        written = {row['name']: row for row in csv.DictReader(f)}
+    assert set(written) == {'good', 'broken'}
+    assert written['good']['status'] == 'ok' and written['good']['error'] == ''
+    assert os.path.isfile(written['good']['out'])
+    assert written['broken']['status'] == 'failed' and 'missing.tif' in written['broken']['error']
+    # the jobs ran in the pool's worker processes
+    assert all(int(row['worker']) != os.getpid() for row in written.values())
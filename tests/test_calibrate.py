@@ -0,0 +1,29 @@
+import geopandas as gpd
+from shapely.geometry import box
+
+from processing import calibrate
+from processing.vector_io import read_vector
+
+
+def test_subset_runs_use_full_network_avlen(vbet_params, tmp_path, monkeypatch):
+    network = read_vector(vbet_params['network'])
+    template = str(tmp_path / 'template.gpkg')
+    gpd.GeoDataFrame(geometry=[box(*network.total_bounds).buffer(10)], crs=network.crs).to_file(template)
+    expected = calibrate.network_avlen(vbet_params, str(tmp_path / 'avlen'))
+
+    seen = []
+
+    def run_job(job):
+        seen.append((len(read_vector(job['params']['network'])), job['params'].get('avlen')))
+        return {'status': 'failed', 'seconds': 0, 'error': 'not run'}
+
+    monkeypatch.setattr(calibrate, 'run_job', run_job)
+    try:
+        calibrate.successive_halving(vbet_params, {'lg_slope': [2, 3, 4]}, template, str(tmp_path / 'work'),
+                                     rungs=2, eta=3, min_segments=2)
+    except Exception:
+        pass  # every candidate 'failed'
+
+    sizes = set(n for n, _ in seen)
+    assert len(sizes) > 1 and max(sizes) == len(network)
+    assert all(avlen == expected for _, avlen in seen)
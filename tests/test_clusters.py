@@ -0,0 +1,53 @@
+import numpy as np
+from rasterio.windows import Window
+
+from processing.clusters import ClusterReader, plan_clusters
+
+DEM = np.arange(100 * 100, dtype=np.float32).reshape(100, 100)
+
+
+def counting_read(reads):
+    def read(window):
+        reads.append(window)
+        return DEM[int(window.row_off):int(window.row_off + window.height),
+                   int(window.col_off):int(window.col_off + window.width)]
+    return read
+
+
+def overlapping_windows():
+    return [(k, Window(10 * k, 0, 30, 30)) for k in range(3)]
+
+
+def test_one_block_read_per_cluster():
+    windows = overlapping_windows()
+    reader = ClusterReader(plan_clusters(windows, 10000), DEM.itemsize)
+    reads = []
+    for key, window in windows:
+        np.testing.assert_array_equal(reader.read(key, window, counting_read(reads)), DEM[0:30, 10 * key:10 * key + 30])
+
+    assert len(reads) == 1 and reader.blocks == {}
+
+
+def test_failed_member_releases_block():
+    windows = overlapping_windows()
+    reader = ClusterReader(plan_clusters(windows, 10000), DEM.itemsize)
+    reads = []
+    reader.read(0, windows[0][1], counting_read(reads))
+    reader.release(1)  # segment 1 failed before its read
+    reader.release(0)  # releasing a served segment again does not count
+    assert len(reader.blocks) == 1
+    reader.read(2, windows[2][1], counting_read(reads))
+
+    assert len(reads) == 1 and reader.blocks == {}
+
+
+def test_read_after_release_reads_window():
+    windows = overlapping_windows()
+    reader = ClusterReader(plan_clusters(windows, 10000), DEM.itemsize)
+    reads = []
+    for key in range(3):
+        reader.release(key)
+    arr = reader.read(1, windows[1][1], counting_read(reads))
+
+    np.testing.assert_array_equal(arr, DEM[0:30, 10:40])
+    assert reads == [windows[1][1]] and reader.blocks == {}
@@ -0,0 +1,39 @@
+import json
+import multiprocessing
+import os
+import time
+
+from processing.cost import CostModel, file_lock
+
+
+def save_timings(path, k, n):
+    model = CostModel(path)
+    for j in range(n):
+        model.record(1000 * k + j, 10, 0.1)
+        model.save()
+
+
+def test_concurrent_saves_keep_all_timings(tmp_path):
+    path = str(tmp_path / 'cost_model.json')
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=save_timings, args=(path, k, 10)) for k in range(6)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    with open(path) as f:
+        samples = json.load(f)['default']['samples']
+    assert len(samples) == 60
+    assert not os.path.exists(path + '.lock')
+
+
+def test_stale_lock_is_broken(tmp_path):
+    lock = str(tmp_path / 'cost_model.json.lock')
+    open(lock, 'w').close()
+    old = time.time() - 120
+    os.utime(lock, (old, old))
+
+    with file_lock(lock, timeout=1, stale=60):
+        assert os.path.exists(lock)
+    assert not os.path.exists(lock)
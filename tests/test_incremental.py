@@ -0,0 +1,41 @@
+import shutil
+
+import rasterio
+from shapely.geometry import box
+
+import classVBET
+from processing.vector_io import read_vector
+
+
+def run(params, **kwargs):
+    classVBET.VBET(**dict(params, **kwargs)).valley_bottom()
+
+    return read_vector(params['out']).unary_union
+
+
+def test_incremental_run_matches_full_run(vbet_params, tmp_path):
+    first = run(vbet_params, segment_store=True)
+
+    # widen the valley floor on one side of the second segment
+    old_dem = str(tmp_path / 'dem_old.tif')
+    shutil.copyfile(vbet_params['dem'], old_dem)
+    with rasterio.open(vbet_params['dem'], 'r+') as dst:
+        z = dst.read(1)
+        z[125:140, 70:100] = z[100, 70:100] + 0.3
+        dst.write(z, 1)
+        patch = box(*rasterio.windows.bounds(rasterio.windows.Window(70, 125, 30, 15), dst.transform))
+
+    spliced = run(vbet_params, segment_store=True, previous_dem=old_dem)
+    full_params = dict(vbet_params, out=str(tmp_path / 'full' / 'vb.gpkg'), scratch=str(tmp_path / 'full_scratch'))
+    full = run(full_params)
+
+    assert not spliced.equals(first)
+    # the segments whose buffers touch the patch are recomputed, the output beyond their reach is left as it was
+    outside = patch.buffer(2 * vbet_params['lg_buf'] + 20)
+    assert spliced.difference(outside).symmetric_difference(first.difference(outside)).area < 1e-6
+    # around the change the splice is the full rerun
+    near = patch.buffer(vbet_params['lg_buf'])
+    assert spliced.intersection(near).symmetric_difference(full.intersection(near)).area < 1e-3
+    # further out a full rerun simplifies the merged valley bottom slightly differently, the splice stays close to it
+    assert spliced.symmetric_difference(full).area < 0.25 * first.symmetric_difference(full).area
+    assert spliced.symmetric_difference(full).area < 0.01 * full.area
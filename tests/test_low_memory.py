@@ -0,0 +1,27 @@
+import tracemalloc
+
+import pytest
+
+import classVBET
+from processing.vector_io import read_vector
+
+
+@pytest.mark.parametrize('memory_stats', [False, True])
+def test_tracing_only_with_memory_stats(vbet_params, memory_stats):
+    vb = classVBET.VBET(**vbet_params, low_memory=True, memory_stats=memory_stats)
+    tracing = []
+    compute = vb.segment_valley_bottom_low_memory
+
+    def traced(window):
+        tracing.append(tracemalloc.is_tracing())
+        return compute(window)
+
+    vb.segment_valley_bottom_low_memory = traced
+    vb.valley_bottom()
+
+    assert len(tracing) > 0 and set(tracing) == {memory_stats}
+    assert not tracemalloc.is_tracing()
+    network = read_vector(vb.network_out)
+    assert ('peak_mb' in network.columns) == memory_stats
+    if memory_stats:
+        assert (network['peak_mb'] > 0).all()
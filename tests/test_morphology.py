@@ -0,0 +1,76 @@
+import inspect
+
+import numpy as np
+import pytest
+import skimage.morphology as mo
+
+from processing.morphology import fill_mask, fill_small_holes
+
+
+def remove_small_holes(mask, thresh):
+    """
+    skimage filling of the holes smaller than thresh cells (area_threshold before skimage 0.26, where it became the
+    inclusive max_size)
+    """
+    if 'max_size' in inspect.signature(mo.remove_small_holes).parameters:
+        return mo.remove_small_holes(mask, max_size=thresh - 1, connectivity=1)
+
+    return mo.remove_small_holes(mask, thresh, 1)
+
+
+def skimage_fill(mask, thresh, closing):
+    """
+    The skimage hole filling of VBET.fill_mask
+    """
+    b = remove_small_holes(mask, thresh)
+    c = mo.binary_closing(b, footprint=np.ones((closing, closing)))
+
+    return remove_small_holes(c, thresh)
+
+
+def random_mask(rng, shape):
+    """
+    Random blobs in a random part of the array, so the crop of fill_mask touches different sets of edges
+    """
+    mask = np.zeros(shape, dtype=bool)
+    r0, c0 = rng.integers(0, shape[0] // 2), rng.integers(0, shape[1] // 2)
+    r1, c1 = rng.integers(r0 + 2, shape[0] + 1), rng.integers(c0 + 2, shape[1] + 1)
+    mask[r0:r1, c0:c1] = rng.random((r1 - r0, c1 - c0)) < rng.uniform(0.3, 0.8)
+
+    return mask
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_fill_mask_matches_skimage(seed):
+    rng = np.random.default_rng(seed)
+    mask = random_mask(rng, (int(rng.integers(20, 80)), int(rng.integers(20, 80))))
+    if not mask.any():
+        mask[0, 0] = True
+    thresh, closing = int(rng.integers(2, 400)), int(rng.choice([1, 3, 5, 7]))
+
+    np.testing.assert_array_equal(fill_mask(mask, thresh, closing), skimage_fill(mask, thresh, closing))
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_fill_small_holes_matches_skimage(seed):
+    rng = np.random.default_rng(seed)
+    mask = rng.random((int(rng.integers(5, 60)), int(rng.integers(5, 60)))) < rng.uniform(0.3, 0.8)
+    thresh = int(rng.integers(1, 50))
+
+    np.testing.assert_array_equal(fill_small_holes(mask.copy(), thresh), remove_small_holes(mask, thresh))
+
+
+def test_crop_with_separate_outside_strips():
+    # the crop spans the full width, so the background above and below it are separate regions
+    mask = np.zeros((30, 10), dtype=bool)
+    mask[10:20, :] = True
+    mask[12:18, 3:7] = False
+
+    np.testing.assert_array_equal(fill_mask(mask, 140, 1), skimage_fill(mask, 140, 1))
+
+
+@pytest.mark.parametrize('thresh', [50, 51])
+def test_empty_mask(thresh):
+    mask = np.zeros((5, 10), dtype=bool)
+
+    np.testing.assert_array_equal(fill_mask(mask, thresh, 3), skimage_fill(mask, thresh, 3))
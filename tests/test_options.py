@@ -0,0 +1,15 @@
+import pytest
+
+import classVBET
+
+
+def test_short_circuit_and_low_memory_are_exclusive(vbet_params):
+    with pytest.raises(ValueError):
+        classVBET.VBET(**vbet_params, short_circuit=True, low_memory=True)
+
+
+def test_parquet_output_needs_pyarrow(vbet_params, monkeypatch):
+    monkeypatch.setattr(classVBET, 'parquet_supported', lambda: False)
+    vbet_params['out'] = vbet_params['out'].replace('.gpkg', '.parquet')
+    with pytest.raises(Exception, match='pyarrow'):
+        classVBET.VBET(**vbet_params)
@@ -0,0 +1,37 @@
+import importlib
+import sys
+
+from preprocessing.pipeline import ArtifactCache, Pipeline
+
+STAGE = '''
+def copy_text(path, out_path):
+    with open(path) as src, open(out_path, 'w') as dst:
+        dst.write(src.read(){})
+'''
+
+
+def write_stage(folder, suffix):
+    with open(folder / 'stage_module.py', 'w') as f:
+        f.write(STAGE.format(suffix))
+    sys.modules.pop('stage_module', None)
+    importlib.invalidate_caches()
+
+    return importlib.import_module('stage_module').copy_text
+
+
+def run(tmp_path, func):
+    pipe = Pipeline(ArtifactCache(str(tmp_path / 'cache')))
+    pipe.add_file('text', str(tmp_path / 'in.txt'))
+    ran = pipe.stage('copy', func, ['text'], ext='.txt', read=None, write=None)
+    with open(pipe.paths['copy']) as f:
+        return ran, f.read()
+
+
+def test_changed_stage_code_reruns(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'in.txt').write_text('abc')
+
+    assert run(tmp_path, write_stage(tmp_path, '')) == (True, 'abc')
+    assert run(tmp_path, write_stage(tmp_path, '')) == (False, 'abc')
+    assert run(tmp_path, write_stage(tmp_path, '.upper()')) == (True, 'ABC')
+    sys.modules.pop('stage_module', None)
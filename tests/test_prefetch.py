@@ -0,0 +1,56 @@
+import io
+import time
+
+from tqdm import tqdm
+
+import classVBET
+from processing.prefetch import PrefetchPipeline
+from processing.vector_io import read_vector
+
+
+def fail_on(bad, func):
+    def run(item):
+        if item in bad:
+            raise RuntimeError('failed on {}'.format(item))
+        return func(item)
+    return run
+
+
+def run_pipeline(pipeline, items):
+    bar = tqdm(total=len(items), file=io.StringIO())
+    pipeline._progress = lambda _: bar
+    pipeline.run(items)
+
+    return bar.n
+
+
+def test_failed_items_advance_progress():
+    written, errors = [], []
+    pipeline = PrefetchPipeline(fail_on({3}, lambda i: i), fail_on({6}, lambda w: w * 2), written.append, depth=2,
+                                readers=2, on_error=lambda stage, item, e: errors.append((stage, item)))
+
+    assert run_pipeline(pipeline, list(range(10))) == 10
+    assert sorted(written) == [2 * i for i in range(10) if i not in (3, 6)]
+    assert sorted(errors) == [('compute', 6), ('read', 3)]
+
+
+def test_stall_counters():
+    slow_compute = PrefetchPipeline(lambda i: i, lambda w: time.sleep(0.01) or w, lambda r: None, depth=1)
+    run_pipeline(slow_compute, list(range(10)))
+    assert slow_compute.stalls['read'] > 0 and slow_compute.bottleneck() == 'compute'
+
+    slow_read = PrefetchPipeline(lambda i: time.sleep(0.01) or i, lambda w: w, lambda r: None, depth=1)
+    run_pipeline(slow_read, list(range(10)))
+    assert slow_read.stalls['compute'] > 0 and slow_read.bottleneck() == 'read'
+
+
+def test_prefetch_matches_serial(vbet_params, tmp_path):
+    serial = classVBET.VBET(**vbet_params)
+    serial.valley_bottom()
+    prefetch_params = dict(vbet_params, out=str(tmp_path / 'prefetch' / 'vb.gpkg'),
+                           scratch=str(tmp_path / 'prefetch_scratch'))
+    prefetch = classVBET.VBET(**prefetch_params, prefetch=2, read_threads=2)
+    prefetch.valley_bottom()
+
+    assert prefetch.fp_areas == serial.fp_areas
+    assert read_vector(prefetch_params['out']).unary_union.equals(read_vector(vbet_params['out']).unary_union)
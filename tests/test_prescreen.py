@@ -0,0 +1,41 @@
+import geopandas as gpd
+from shapely.geometry import LineString
+
+import classVBET
+from conftest import X0, Y0
+from processing.prescreen import EMPTY, classify
+from processing.vector_io import read_vector
+
+# a segment on the hillside above the valley of the synthetic DEM, where every cell is about 19 degrees steep
+HILLSIDE = LineString([(X0 + 40 + 3 * k + 0.5, Y0 - 30.5 - k % 2) for k in range(20)])
+
+
+def coarse_classify(vb, seg_geom, da, factor=2):
+    src = vb.dem_handle()
+    slope_thresh, depth_thresh, _ = vb.segment_thresholds(da)
+    arr, transform = vb.read_resampled(src, seg_geom.buffer(vb.segment_distance(da)), src.res[0] * factor)
+
+    return classify(arr[0], transform, src.nodata, seg_geom, slope_thresh, depth_thresh)
+
+
+def test_classify(vbet_params):
+    vb = classVBET.VBET(**vbet_params)
+    vb.avlen = 60
+
+    assert coarse_classify(vb, HILLSIDE, 10) == EMPTY
+    for geom, da in zip(vb.network.geometry, vb.network['DA']):
+        assert coarse_classify(vb, geom, da) != EMPTY
+
+
+def test_prescreen_skips_hillside_segment(vbet_params, tmp_path):
+    network = read_vector(vbet_params['network'])
+    hillside = gpd.GeoDataFrame({'DA': [10]}, geometry=[HILLSIDE], crs=network.crs)
+    path = str(tmp_path / 'network_hillside.gpkg')
+    gpd.pd.concat([network, hillside], ignore_index=True).to_file(path)
+
+    vb = classVBET.VBET(**dict(vbet_params, network=path), prescreen=2)
+    vb.valley_bottom()
+
+    assert vb.prescreened[EMPTY] == 1
+    assert vb.fp_areas[len(network)] == 0
+    assert all(vb.fp_areas[i] > 0 for i in range(len(network)))
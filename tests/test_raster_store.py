@@ -0,0 +1,32 @@
+import os
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from processing.raster_store import build
+from processing.tiles import TileIndex
+
+
+def write_tile(path, x0, value):
+    profile = dict(driver='GTiff', height=10, width=10, count=1, dtype='float32', crs='EPSG:32613',
+                   transform=from_origin(x0, 1000, 1, 1), nodata=-9999)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(np.full((10, 10), value, dtype='float32'), 1)
+
+
+def test_store_follows_patched_tiles(tmp_path):
+    tiles = [str(tmp_path / 'a.tif'), str(tmp_path / 'b.tif')]
+    write_tile(tiles[0], 0, 1)
+    write_tile(tiles[1], 10, 2)
+    vrt = TileIndex(tiles).write_vrt(str(tmp_path / 'dem.vrt'))
+    store = str(tmp_path / 'store')
+    assert build(vrt, store, 'dem').read(rasterio.windows.Window(0, 0, 20, 10))[0, -1] == 2
+
+    # patching a tile leaves the VRT untouched
+    vrt_mtime = os.stat(vrt).st_mtime
+    write_tile(tiles[1], 10, 5)
+    os.utime(tiles[1], (vrt_mtime + 10, vrt_mtime + 10))
+    assert TileIndex(tiles).write_vrt(vrt) == vrt and os.stat(vrt).st_mtime == vrt_mtime
+
+    assert build(vrt, store, 'dem').read(rasterio.windows.Window(0, 0, 20, 10))[0, -1] == 5
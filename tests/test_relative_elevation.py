@@ -0,0 +1,54 @@
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask, rasterize
+from scipy import ndimage
+
+import classVBET
+from processing.relative_elevation import build_rem
+
+
+def network_fits(vb):
+    """
+    Cleaned network of a global detrending run and the trend plane of each segment
+    """
+    vb.clean_network()
+    with rasterio.open(vb.dem) as src:
+        vb.dem_res = src.res[0]
+        fits = [vb.detrend_fit(vb.dem, src.transform, src.nodata, geom) for geom in vb.network.geometry]
+
+    return fits
+
+
+def read(path):
+    with rasterio.open(path) as src:
+        return src.read(1), src.nodata, src.transform
+
+
+def test_tiled_rem_matches_single_tile(vbet_params, tmp_path):
+    vb = classVBET.VBET(**vbet_params, detrend_mode='global')
+    fits = network_fits(vb)
+    single = build_rem(vb.dem, vb.network, fits, 40, str(tmp_path / 'single.tif'), tile_size=4096)
+    tiled = build_rem(vb.dem, vb.network, fits, 40, str(tmp_path / 'tiled.tif'), tile_size=64)
+
+    np.testing.assert_array_equal(read(tiled)[0], read(single)[0])
+
+
+def test_global_rem_matches_segment_detrending(vbet_params, tmp_path):
+    vb = classVBET.VBET(**vbet_params, detrend_mode='global')
+    fits = network_fits(vb)
+    rem, ndval, transform = read(build_rem(vb.dem, vb.network, fits, 40, str(tmp_path / 'rem.tif')))
+    ids = rasterize([(geom, k + 1) for k, geom in enumerate(vb.network.geometry)], out_shape=rem.shape,
+                    transform=transform, all_touched=True, dtype=np.int32)
+    buffers = vb.segment_buffers()
+
+    for k, (i, geom) in enumerate(vb.network.geometry.items()):
+        # depths of segment mode, where the trend plane is fitted to this segment only
+        depth = vb.detrend(vb.dem, geom)
+        inside = ~geometry_mask([buffers[i]], out_shape=rem.shape, transform=transform) & (rem != ndval)
+        # cells clearly nearer to this segment than to any other are allocated to it
+        own = inside & (ndimage.distance_transform_edt(ids != k + 1) + 1.5 <
+                        ndimage.distance_transform_edt((ids == 0) | (ids == k + 1)))
+        assert own.sum() > 100
+        np.testing.assert_allclose(rem[own], depth[own], atol=1e-3)
+        # cells nearer to a neighbour are detrended with its plane, which stays close to this one
+        assert np.median(np.abs(rem[inside] - depth[inside])) < 0.01
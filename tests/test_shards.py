@@ -0,0 +1,51 @@
+import json
+import os
+import time
+
+from processing import shards
+from processing.vector_io import read_vector
+
+
+def test_plan_shards(vbet_params, tmp_path):
+    shard_dir = str(tmp_path / 'shards')
+    manifest_path = shards.plan_shards(vbet_params, shard_dir, method='tiles', max_segments=2, tile_size=100)
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    assert len(manifest['shards']) > 1
+    assert sum(shard['n_core'] for shard in manifest['shards']) == 5
+    for shard in manifest['shards']:
+        assert os.path.isfile(shard['network'])
+        assert shard['cost'] >= 0
+
+
+def test_plan_run_merge(vbet_params, tmp_path):
+    shard_dir = str(tmp_path / 'shards')
+    shards.plan_shards(vbet_params, shard_dir, method='tiles', max_segments=2, tile_size=100)
+    n = shards.enqueue_shards(shard_dir)
+
+    assert shards.run_worker(shard_dir) == n
+    assert len(os.listdir(os.path.join(shard_dir, 'queue', 'done'))) == n
+    assert os.listdir(os.path.join(shard_dir, 'queue', 'failed')) == []
+
+    out = shards.merge_shards(shard_dir)
+    merged = read_vector(out)
+    assert len(merged) > 0 and merged.geometry.area.sum() > 0
+    # the merged valley bottom covers the network
+    assert merged.unary_union.buffer(1).contains(read_vector(vbet_params['network']).unary_union)
+
+
+def test_requeue_abandoned_task(vbet_params, tmp_path):
+    shard_dir = str(tmp_path / 'shards')
+    shards.plan_shards(vbet_params, shard_dir, method='tiles', max_segments=2, tile_size=100)
+    shards.enqueue_shards(shard_dir)
+    queue = os.path.join(shard_dir, 'queue')
+    task = sorted(os.listdir(os.path.join(queue, 'pending')))[0]
+    # a worker claimed the task and its node died
+    os.rename(os.path.join(queue, 'pending', task), os.path.join(queue, 'running', task))
+    old = time.time() - 120
+    os.utime(os.path.join(queue, 'running', task), (old, old))
+
+    assert shards.requeue(shard_dir, lease=300) == []
+    assert shards.requeue(shard_dir, lease=60) == [task]
+    assert task in os.listdir(os.path.join(queue, 'pending'))
@@ -0,0 +1,23 @@
+import numpy as np
+import shapely
+from shapely.geometry import Point, Polygon
+
+from processing.smoothing import smooth_polygons
+
+
+def test_smoothed_hole_crossing_shell_is_repaired():
+    # the corner cut of the shell at (10, 0) passes inside the hole next to it
+    shell = [(0, 0), (10, 0), (10, 10), (0, 10)]
+    hole = [(9, 0.2), (9.8, 0.2), (9.8, 1), (9, 1)]
+    smoothed = smooth_polygons([Polygon(shell, [hole])], refinements=1)
+
+    assert len(smoothed) > 0 and all(p.is_valid and p.geom_type == 'Polygon' for p in smoothed)
+
+
+def test_vertex_budget_met_when_input_exceeds_it():
+    polygons = [Point(x * 100, 0).buffer(20, quad_segs=64) for x in range(5)]
+    n = int(shapely.get_num_coordinates(polygons).sum())
+    smoothed = smooth_polygons(polygons, refinements=5, vertex_budget=n // 4)
+
+    assert int(shapely.get_num_coordinates(smoothed).sum()) <= n // 4
+    assert np.isclose(sum(p.area for p in smoothed), sum(p.area for p in polygons), rtol=0.05)
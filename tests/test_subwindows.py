@@ -0,0 +1,65 @@
+import numpy as np
+import shapely
+from affine import Affine
+from shapely.geometry import LineString
+
+import classVBET
+from processing.subwindows import mosaic_parts, owned_cells, split_segment, window_cells
+from processing.vector_io import read_vector
+
+LINE = LineString([(0, 0), (100, 30), (200, 0), (300, 40)])
+
+
+def test_split_segment_within_budget():
+    assert split_segment(LINE, 20, 1, window_cells(LINE.buffer(20), 1)) is None
+
+
+def test_split_segment_pieces():
+    budget = 12000
+    contexts, pieces = split_segment(LINE, 20, 1, budget)
+
+    assert len(pieces) == len(contexts) > 1
+    assert all(window_cells(c.buffer(20, cap_style=1), 1) <= budget for c in contexts)
+    # the pieces run along the whole centerline, end to end
+    assert np.isclose(sum(p.length for p in pieces), LINE.length)
+    for a, b in zip(pieces[:-1], pieces[1:]):
+        assert a.coords[-1] == b.coords[0]
+    # each context holds its piece
+    assert all(c.buffer(1e-6).contains(p) for c, p in zip(contexts, pieces))
+
+
+def test_owned_cells_partition():
+    contexts, pieces = split_segment(LINE, 20, 1, 12000)
+    tree = shapely.STRtree(pieces)
+    transform = Affine(1, 0, -20, 0, -1, 60)
+    owned = [owned_cells(np.ones((100, 340), dtype=bool), transform, tree, k) for k in range(len(pieces))]
+
+    # every cell is kept by exactly one piece
+    np.testing.assert_array_equal(np.sum(owned, axis=0), 1)
+
+
+def run_vbet(params, **kwargs):
+    vb = classVBET.VBET(**dict(params, **kwargs))
+    vb.valley_bottom()
+
+    return read_vector(params['out']).unary_union
+
+
+def test_global_detrend_split_matches_unsplit(vbet_params, tmp_path):
+    unsplit = run_vbet(vbet_params, detrend_mode='global')
+    split_params = dict(vbet_params, out=str(tmp_path / 'split' / 'vb.gpkg'), scratch=str(tmp_path / 'split_scratch'))
+    split = run_vbet(split_params, detrend_mode='global', window_budget=3000)
+
+    assert split.area > 0
+    assert split.equals(unsplit)
+
+
+def test_mosaic_parts():
+    a = np.ones((2, 3), dtype=np.uint8)
+    b = np.array([[1, 0], [0, 1]], dtype=np.uint8)
+    mosaic, transform = mosaic_parts([(a, Affine(2, 0, 10, 0, -2, 20)), (b, Affine(2, 0, 14, 0, -2, 16))])
+
+    np.testing.assert_array_equal(mosaic, [[1, 1, 1, 0], [1, 1, 1, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
+    assert transform == Affine(2, 0, 10, 0, -2, 20)
+    # sub-windows resampled to their own grids are not mosaicked
+    assert mosaic_parts([(a, Affine(2, 0, 10, 0, -2, 20)), (b, Affine(2, 0, 11, 0, -2, 16))]) is None
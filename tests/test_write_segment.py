@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from affine import Affine
+
+import classVBET
+from processing.mosaic import ValleyBottomMosaic
+
+
+def split_result(res=1, shift=0):
+    """
+    Result of a segment split into two sub-windows, each with a square of valley bottom (shift moves the second
+    sub-window off the grid of the first)
+    """
+    parts = []
+    for x in (500010, 500040 + shift):
+        filled = np.zeros((20, 20), dtype=np.uint8)
+        filled[5:15, 5:15] = 1
+        parts.append((filled, Affine(res, 0, x, 0, -res, 4399890)))
+
+    return 0, parts, None
+
+
+def fail_on_call(n, func):
+    """
+    Wraps func so that its n-th call raises
+    """
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == n:
+            raise RuntimeError('failed on call {}'.format(n))
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def test_failed_write_leaves_no_polygons(vbet_params, monkeypatch):
+    vb = classVBET.VBET(**vbet_params)
+    vb.fp_areas = {}
+    before = list(vb.polygons)
+    monkeypatch.setattr(classVBET, 'polygonize', fail_on_call(2, classVBET.polygonize))
+    with pytest.raises(RuntimeError):
+        vb.write_segment(split_result(shift=0.5))
+    vb.quarantine_segment('write', (0,), RuntimeError('failed'))
+
+    assert vb.polygons == before
+    assert 0 not in vb.segment_polys and 0 not in vb.fp_areas
+
+
+def test_failed_write_leaves_mosaic_unchanged(vbet_params, monkeypatch):
+    vb = classVBET.VBET(**vbet_params)
+    vb.fp_areas = {}
+    vb.mosaic = ValleyBottomMosaic(vbet_params['dem'], vbet_params['scratch'])
+    monkeypatch.setattr(vb.mosaic, 'to_dem_grid', fail_on_call(2, vb.mosaic.to_dem_grid))
+    with pytest.raises(RuntimeError):
+        vb.write_segment(split_result(res=2))
+
+    assert not np.asarray(vb.mosaic.data).any()
+
+
+def test_write_split_segment(vbet_params):
+    vb = classVBET.VBET(**vbet_params)
+    vb.fp_areas = {}
+    n = len(vb.polygons)
+    vb.write_segment(split_result())
+
+    assert len(vb.polygons) == n + 2 and vb.segment_polys[0] == vb.polygons[n:]
+    assert vb.fp_areas[0] == 200
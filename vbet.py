@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Command line entry point for VBET
+
+    python vbet.py preprocess preprocess.json
+    python vbet.py run run.json [--set sm_slope=5 ...] [--dry-run]
+    python vbet.py sweep sweep.json [--dry-run]
+    python vbet.py calibrate calibrate.json [--rungs 3] [--eta 3] [--dry-run]
+    python vbet.py batch manifest.json [--workers 4] [--store store_dir] [--summary summary.csv] [--dry-run]
+    python vbet.py score template.gpkg test1.gpkg test2.gpkg
+
+Configs are JSON (or TOML on Python 3.11+). A run config holds the VBET parameters, either at the top level or
+under "params". A sweep config holds the shared parameters under "params", lists of values to try under "sweep" and
+optionally an "out_template" for the output of each run, formatted with the parameters of the run (e.g.
+"out/vb_slope_{sm_slope}_depth_{sm_depth}.gpkg"). A calibrate config is a sweep config with a "template" valley
+bottom: the grid is searched by successive halving against the template (see processing/calibrate.py). A batch manifest lists jobs (network, dem, out and params) run
+in one pool of worker processes; see processing/batch.py.
+
+Only the standard library is imported at start up; geopandas, rasterio and the rest of the stack are imported by
+the command that needs them, so validating configs and printing help stay fast. --timing reports the start up time
+and the time spent importing each command's dependencies.
+"""
+import time
+
+_START = time.perf_counter()
+
+import argparse
+import importlib
+import itertools
+import json
+import os
+import sys
+
+REQUIRED = ('network', 'dem', 'out', 'scratch', 'lg_da', 'med_da', 'lg_slope', 'med_slope', 'sm_slope', 'lg_buf',
+            'med_buf', 'sm_buf', 'min_buf', 'dr_area', 'da_field', 'lg_depth', 'med_depth', 'sm_depth')
+
+timing = False
+
+
+def report(label, start):
+    if timing:
+        print('[timing] {}: {:.3f} s'.format(label, time.perf_counter() - start), file=sys.stderr)
+
+
+def lazy_import(name):
+    """
+    Imports a module the first time a command needs it (and times the import with --timing)
+    :param name: module name
+    :return: module
+    """
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    report('import {}'.format(name), start)
+
+    return module
+
+
+def load_config(path):
+    """
+    :param path: path to a JSON or TOML config
+    :return: dict
+    """
+    if path.lower().endswith('.toml'):
+        import tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_overrides(overrides):
+    """
+    :param overrides: list of key=value strings, values are read as JSON where possible (numbers, null, lists)
+    :return: dict
+    """
+    params = {}
+    for item in overrides or []:
+        key, _, value = item.partition('=')
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+
+    return params
+
+
+def check_params(params):
+    """
+    Checks a set of VBET parameters without importing VBET
+    :param params: dict of VBET parameters
+    :return: list of problems (empty if the parameters look runnable)
+    """
+    problems = ['missing parameter {}'.format(k) for k in REQUIRED if k not in params]
+    for key in ('network', 'dem', 'dr_area'):
+        path = params.get(key)
+        if isinstance(path, str) and not os.path.exists(path):
+            problems.append('{} {} does not exist'.format(key, path))
+    if params.get('da_field') is None and params.get('dr_area') is None:
+        problems.append('either da_field or dr_area is needed')
+
+    return problems
+
+
+def run_params(params):
+    """
+    Runs VBET with a set of parameters (adding drainage area to the network first if there is no da_field)
+    :param params: dict of VBET parameters
+    :return:
+    """
+    classVBET = lazy_import('classVBET')
+    start = time.perf_counter()
+    vb = classVBET.VBET(**params)
+    if params.get('da_field') is None:
+        vb.add_da()
+    vb.valley_bottom()
+    report('run {}'.format(params['out']), start)
+
+
+def sweep_params(config):
+    """
+    Expands a sweep config into the parameters of each run
+    :param config: dict with "params", "sweep" and optionally "out_template"
+    :return: list of dicts of VBET parameters
+    """
+    base = config.get('params', {})
+    grid = config.get('sweep', {})
+    keys = list(grid.keys())
+    template = config.get('out_template')
+
+    runs = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        params = dict(base)
+        params.update(zip(keys, values))
+        if template is not None:
+            params['out'] = template.format(**params)
+        else:
+            stem, ext = os.path.splitext(base['out'])
+            params['out'] = stem + ''.join('_{}_{}'.format(k, v) for k, v in zip(keys, values)) + (ext or '.gpkg')
+        runs.append(params)
+
+    return runs
+
+
+def cmd_preprocess(args):
+    config = load_config(args.config)
+    if args.dry_run:
+        print(json.dumps(config, indent=2))
+        return 0
+    preprocess = lazy_import('0_preprocess_VBET').preprocess
+    out = preprocess(config['input_stream_vector'], config['flow_accumulation_raster'], config['output_dir'],
+                     config.get('stream_spacing', 20), config.get('name', 'Bennett'), config.get('cache_dir'))
+    print('Segmented streams: {}'.format(out))
+
+    return 0
+
+
+def cmd_run(args):
+    config = load_config(args.config)
+    params = dict(config.get('params', config))
+    params.update(parse_overrides(args.set))
+    problems = check_params(params)
+    if len(problems) > 0:
+        print('\n'.join(problems), file=sys.stderr)
+        return 1
+    if args.dry_run:
+        print(json.dumps(params, indent=2))
+        return 0
+    run_params(params)
+
+    return 0
+
+
+def cmd_sweep(args):
+    runs = sweep_params(load_config(args.config))
+    for params in runs:
+        problems = check_params(params)
+        if len(problems) > 0:
+            print('\n'.join(problems), file=sys.stderr)
+            return 1
+    if args.dry_run:
+        for params in runs:
+            print(params['out'])
+        return 0
+    for k, params in enumerate(runs):
+        print('\nSweep run {} of {}: {}'.format(k + 1, len(runs), params['out']))
+        run_params(params)
+
+    return 0
+
+
+def cmd_calibrate(args):
+    config = load_config(args.config)
+    runs = sweep_params(config)
+    for params in runs:
+        problems = check_params(params)
+        if len(problems) > 0:
+            print('\n'.join(problems), file=sys.stderr)
+            return 1
+    if not os.path.isfile(config.get('template', '')):
+        print('template {} does not exist'.format(config.get('template')), file=sys.stderr)
+        return 1
+    rungs = args.rungs or config.get('rungs', 3)
+    eta = args.eta or config.get('eta', 3)
+    work_dir = config.get('work_dir') or os.path.join(os.path.dirname(config['params']['out']), 'calibration')
+    if args.dry_run:
+        n = len(runs)
+        for r in range(rungs):
+            print('rung {}: {} candidates'.format(r + 1, n))
+            n = max(1, -(-n // eta))
+        print('work folder: {}'.format(work_dir))
+        return 0
+    calibrate = lazy_import('processing.calibrate')
+    start = time.perf_counter()
+    result = calibrate.successive_halving(config['params'], config['sweep'], config['template'], work_dir, rungs,
+                                          eta, config.get('min_segments', 3), config.get('seed', 0))
+    best = os.path.join(work_dir, 'best_params.json')
+    with open(best, 'w') as f:
+        json.dump(dict(config['params'], **result['params']), f, indent=2)
+    print('\nBest parameters: {} (IoU {:.4f}), output {}'.format(json.dumps(result['params']), result['iou'],
+                                                                  result['out']))
+    print('{} candidate evaluations ({} new runs) for a grid of {}, {:.1f} s; parameters written to {}'.format(
+        result['evaluations'], result['runs'], result['grid'], time.perf_counter() - start, best))
+
+    return 0
+
+
+def cmd_batch(args):
+    batch = lazy_import('processing.batch')
+    jobs = batch.load_manifest(args.manifest)
+    for job in jobs:
+        problems = check_params(job['params'])
+        if len(problems) > 0:
+            print('{}: {}'.format(job['name'], '; '.join(problems)), file=sys.stderr)
+            return 1
+    if args.dry_run:
+        for job in jobs:
+            print('{}: {}'.format(job['name'], job['params']['out']))
+        return 0
+    start = time.perf_counter()
+    rows = batch.run_batch(jobs, args.workers, args.store)
+    summary = args.summary or os.path.splitext(args.manifest)[0] + '_summary.csv'
+    batch.write_summary(rows, summary)
+    print('\n' + batch.format_summary(rows))
+    print('Batch finished in {:.1f} s, summary written to {}'.format(time.perf_counter() - start, summary))
+
+    return 0 if all(r['status'] == 'ok' for r in rows) else 1
+
+
+def cmd_score(args):
+    tests = list(args.tests)
+    template = args.template
+    if args.config is not None:
+        config = load_config(args.config)
+        template = config.get('template', template)
+        tests += config.get('tests', [])
+    similarity = lazy_import('2_quantify_poly_similarity')
+    best = similarity.find_most_similar(template, tests, metric='iou')
+    print('\nMost similar GeoPackage:')
+    print(best)
+
+    return 0
+
+
+def main(argv=None):
+    global timing
+    parser = argparse.ArgumentParser(prog='vbet', description='Valley Bottom Extraction Tool')
+    parser.add_argument('--timing', action='store_true', help='report start up and import times')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('preprocess', help='segment a stream network and add drainage area')
+    p.add_argument('config', help='JSON or TOML config with input_stream_vector, flow_accumulation_raster, '
+                                  'output_dir and optionally stream_spacing and name')
+    p.add_argument('--dry-run', action='store_true', help='print the config and stop')
+    p.set_defaults(func=cmd_preprocess)
+
+    p = commands.add_parser('run', help='run VBET once')
+    p.add_argument('config', help='JSON or TOML config of VBET parameters')
+    p.add_argument('--set', nargs='*', metavar='KEY=VALUE', help='override parameters of the config')
+    p.add_argument('--dry-run', action='store_true', help='check the parameters, print them and stop')
+    p.set_defaults(func=cmd_run)
+
+    p = commands.add_parser('sweep', help='run VBET for every combination of parameter values')
+    p.add_argument('config', help='JSON or TOML config with params, sweep and optionally out_template')
+    p.add_argument('--dry-run', action='store_true', help='check the runs, print their outputs and stop')
+    p.set_defaults(func=cmd_sweep)
+
+    p = commands.add_parser('calibrate', help='search a parameter grid for the best match with a template')
+    p.add_argument('config', help='JSON or TOML config with params, sweep, template and optionally work_dir, rungs, '
+                                  'eta, min_segments and seed')
+    p.add_argument('--rungs', type=int, help='number of rungs of the search (default 3)')
+    p.add_argument('--eta', type=int, help='candidates kept per rung is 1/eta (default 3)')
+    p.add_argument('--dry-run', action='store_true', help='check the candidates, print the plan and stop')
+    p.set_defaults(func=cmd_calibrate)
+
+    p = commands.add_parser('batch', help='run the jobs of a manifest in one pool of worker processes')
+    p.add_argument('manifest', help='JSON, TOML or CSV manifest of jobs')
+    p.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    p.add_argument('--store', help='folder for raster stores, each DEM is decoded once and shared by all jobs')
+    p.add_argument('--summary', help='summary CSV (default: <manifest>_summary.csv)')
+    p.add_argument('--dry-run', action='store_true', help='check the jobs, print their outputs and stop')
+    p.set_defaults(func=cmd_batch)
+
+    p = commands.add_parser('score', help='compare valley bottoms with a template by intersection over union')
+    p.add_argument('template', nargs='?', help='template GeoPackage')
+    p.add_argument('tests', nargs='*', help='GeoPackages to compare')
+    p.add_argument('--config', help='JSON or TOML config with template and tests')
+    p.set_defaults(func=cmd_score)
+
+    args = parser.parse_args(argv)
+    timing = args.timing
+    report('start up', _START)
+
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())